@@ -10,14 +10,17 @@
 
 import logging
 from itertools import chain, filterfalse, islice, zip_longest
+from uuid import UUID
 
 from connexion import NoContent
 from connexion.exceptions import ProblemException
-from flask import current_app, request
+from flask import Response, current_app, request
 from flask.views import MethodView
+from requests.exceptions import HTTPError, RequestException
+from wireguard_tools import WireguardKey
 
 from .client_info import ClientInfo
-from .cloudlets import Cloudlet
+from .cloudlets import Cloudlet, CloudletBusy
 from .deployment_recipe import DeploymentRecipe
 from .matchers import tier1_best_match
 
@@ -68,27 +71,83 @@ class DeployView(MethodView):
             for cloudlet in candidates
         ]
 
-        # gather the results,
+        # gather the results, remembering when busy cloudlets want us back
+        responses, busy = [], []
+        for pending in requests:
+            try:
+                responses.append(pending.result())
+            except CloudletBusy as e:
+                logger.info(str(e))
+                busy.append(e.retry_after)
+
         # - interleave results from cloudlets in case any returned more than requested.
         # - recombine into a single list, drop failed results, and limit to max_results.
         results = list(
             islice(
-                filterfalse(
-                    lambda r: r is None,
-                    chain(*zip_longest(*(request.result() for request in requests))),
-                ),
+                filterfalse(lambda r: r is None, chain(*zip_longest(*responses))),
                 max_results,
             )
         )
 
         # all requests failed?
         if not results:
+            if busy and len(busy) == len(requests):
+                raise ProblemException(
+                    503,
+                    "Service Unavailable",
+                    "All cloudlets are busy",
+                    headers={"Retry-After": str(min(busy))},
+                )
             raise ProblemException(500, "Error", "Something went wrong")
 
         return results
 
-    def get(self, uuid, application_key):
-        raise ProblemException(500, "Error", "Not implemented")
+
+class DeployEventsView(MethodView):
+    def get(self, uuid, application_key, cloudlet):
+        """Relay the status event stream from one of the known cloudlets."""
+        try:
+            client_key = WireguardKey(application_key)
+        except ValueError:
+            raise ProblemException(400, "Bad Request", "Incorrectly formatted request")
+
+        try:
+            cloudlet_uuid = UUID(cloudlet)
+        except ValueError:
+            raise ProblemException(400, "Bad Request", "Incorrectly formatted request")
+
+        target = current_app.config["cloudlets"].get(cloudlet_uuid)
+        if target is None:
+            raise ProblemException(404, "Not Found", "Unknown cloudlet")
+
+        try:
+            upstream = target.status_events(uuid, client_key)
+        except HTTPError as e:
+            # release the connection, the body of a streamed response is unread
+            with e.response:
+                retry_after = e.response.headers.get("Retry-After")
+                raise ProblemException(
+                    e.response.status_code,
+                    e.response.reason,
+                    "Cloudlet refused stream",
+                    headers={"Retry-After": retry_after} if retry_after else None,
+                )
+        except RequestException:
+            logger.exception(f"Failed to stream status events from {target.name}")
+            raise ProblemException(502, "Bad Gateway", "Failed to reach cloudlet")
+
+        def relay():
+            with upstream:
+                try:
+                    yield from upstream.iter_content(chunk_size=None)
+                except RequestException as e:
+                    logger.warning(f"Status event stream from {target.name}: {e!r}")
+
+        return Response(
+            relay(),
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
 
 
 class RecipeView(MethodView):
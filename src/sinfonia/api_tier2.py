@@ -8,25 +8,62 @@
 # SPDX-License-Identifier: MIT
 #
 
+import logging
 from concurrent.futures import CancelledError
+from concurrent.futures import TimeoutError as FutureTimeoutError
 
 from connexion import NoContent
 from connexion.exceptions import ProblemException
-from flask import current_app
+from flask import Response, current_app
 from flask.views import MethodView
 
+from .deployment import Deployment
+from .installer import INSTALLING, PENDING, InstallQueueFull, install_queue_full
+from .status_events import TooManyStreams
+from .teardown import TeardownInProgress
+
+# seconds before retrying a deploy that is still in progress
+DEPLOY_RETRY_AFTER = 5
+
 
 class DeployView(MethodView):
     def post(self, uuid, application_key):
         cluster = current_app.config["K8S_CLUSTER"]
-        deployment = cluster.get(uuid, application_key, create=True)
 
+        def deploy():
+            deployment = cluster.get(uuid, application_key, create=True)
+            return deployment.deploy()
+
+        # concurrent requests for the same deployment wait for the first one
         try:
-            deployment.deploy()
-        except (CancelledError, TimeoutError) as e:
-            raise ProblemException(400, "Error", f"Failed to deploy {e!r}")
+            deployment = current_app.config["deploy_coalescer"].run(
+                (str(uuid), str(application_key)), deploy
+            )
+        except (CancelledError, TimeoutError, FutureTimeoutError) as e:
+            # still in progress on the server, the client should try again
+            logging.warning(f"Gave up waiting for deploy of {uuid}: {e!r}")
+            raise ProblemException(
+                503,
+                "Service Unavailable",
+                "Deployment still in progress",
+                headers={"Retry-After": str(DEPLOY_RETRY_AFTER)},
+            )
+        except InstallQueueFull as e:
+            raise install_queue_full(e)
+        except TeardownInProgress as e:
+            logging.info(str(e))
+            raise ProblemException(
+                503,
+                "Service Unavailable",
+                "Previous deployment is still being removed",
+                headers={"Retry-After": str(DEPLOY_RETRY_AFTER)},
+            )
 
-        return [deployment.asdict()]
+        # backend is still being installed in the background
+        result = deployment.asdict()
+        if result["Status"] in (PENDING, INSTALLING):
+            return [result], 202
+        return [result]
 
     def get(self, uuid, application_key):
         cluster = current_app.config["K8S_CLUSTER"]
@@ -42,5 +79,40 @@ class DeployView(MethodView):
         deployment = cluster.get(uuid, application_key)
         if deployment is not None:
             deployment.expire()
-            deployment.delete()
         return NoContent, 204
+
+
+class DeployEventsView(MethodView):
+    def get(self, uuid, application_key):
+        cluster = current_app.config["K8S_CLUSTER"]
+        deployment = cluster.get(uuid, application_key)
+        if deployment is None:
+            raise ProblemException(
+                404, "Not Found", "Unable to find existing deployment"
+            )
+
+        def describe():
+            # pick up changes to the peer, such as suspend and resume
+            try:
+                current = Deployment.from_deployment(
+                    cluster, deployment.uuid, deployment.client_public_key
+                )
+            except IndexError:
+                current = deployment
+            return current.summary()
+
+        try:
+            events = cluster.events.stream(deployment.name, describe)
+        except TooManyStreams as e:
+            logging.warning(str(e))
+            raise ProblemException(
+                503,
+                "Service Unavailable",
+                "Too many open status streams",
+                headers={"Retry-After": str(int(cluster.events.keepalive))},
+            )
+        return Response(
+            events,
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
@@ -34,15 +34,22 @@ from .app_common import (
 from .cloudlets import Cloudlet
 from .cloudlets import load as cloudlets_load
 from .deployment_repository import DeploymentRepository
-from .jobs import scheduler, start_expire_cloudlets_job
+from .jobs import scheduler, start_expire_cloudlets_job, start_recipe_index_job
 from .matchers import Tier1MatchFunction, get_match_function_plugins
 from .openapi import load_spec
+from .recipe_cache import RecipeCache
+from .recipe_watcher import RecipeWatcher
 
 
 class Tier1DefaultConfig:
     CLOUDLETS: str | Path | None = None
     MATCHERS: list[str] = ["network", "location", "random"]
     RECIPES: str | Path | URL = "RECIPES"
+    RECIPES_CACHE_TTL: int = 60  # seconds
+    RECIPES_NEGATIVE_TTL: int = 10  # seconds
+    RECIPES_STALE_TTL: int = 600  # seconds
+    RECIPES_INDEX_REFRESH: int = 300  # seconds, 0 disables the index manifest
+    RECIPES_WATCH: bool = True  # keep local recipes in memory and watch for changes
 
     # These are initialized by the wsgi app factory from the config
     # cloudlets: dict[UUID, Cloudlet] = {}                          # CLOUDLETS
@@ -50,6 +57,8 @@ class Tier1DefaultConfig:
     # geolite2_reader = geolite2.reader()
     # match_functions: list[Tier1MatchFunction] = []                # MATCHERS
     # deployment_repository: DeploymentRepository | None = None     # RECIPES
+    # recipe_cache: RecipeCache | None = None       # RECIPES_*_TTL
+    # recipe_watcher: RecipeWatcher | None = None   # RECIPES_WATCH
 
 
 def load_cloudlets_conf(cloudlets_conf: str | Path | None) -> dict[UUID, Cloudlet]:
@@ -107,6 +116,23 @@ def wsgi_app_factory(**args) -> connexion.FlaskApp:
     flask_app.config["deployment_repository"] = DeploymentRepository(
         flask_app.config["RECIPES"]
     )
+    flask_app.config["recipe_cache"] = RecipeCache(
+        flask_app.config["deployment_repository"],
+        ttl=flask_app.config["RECIPES_CACHE_TTL"],
+        negative_ttl=flask_app.config["RECIPES_NEGATIVE_TTL"],
+        stale_ttl=flask_app.config["RECIPES_STALE_TTL"],
+    )
+    flask_app.config["recipe_watcher"] = None
+    if (
+        flask_app.config["RECIPES_WATCH"]
+        and flask_app.config["deployment_repository"].base_url.scheme == "file"
+    ):
+        flask_app.config["recipe_watcher"] = RecipeWatcher(
+            flask_app.config["recipe_cache"]
+        )
+        flask_app.config["recipe_watcher"].start()
+    elif flask_app.config["RECIPES_INDEX_REFRESH"]:
+        flask_app.config["recipe_cache"].load_index()
     flask_app.config["match_functions"] = load_match_functions(
         flask_app.config["MATCHERS"]
     )
@@ -115,6 +141,7 @@ def wsgi_app_factory(**args) -> connexion.FlaskApp:
     scheduler.init_app(flask_app)
     scheduler.start()
     start_expire_cloudlets_job()
+    start_recipe_index_job()
 
     # handle running behind reverse proxy (should this be made configurable?)
     flask_app.wsgi_app = ProxyFix(flask_app.wsgi_app)
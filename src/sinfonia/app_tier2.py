@@ -9,8 +9,9 @@
 from __future__ import annotations
 
 import socket
+import tempfile
 from pathlib import Path
-from uuid import uuid4
+from uuid import UUID, uuid4
 
 import connexion
 import typer
@@ -30,24 +31,75 @@ from .app_common import (
     recipes_option,
     version_option,
 )
+from .chart_cache import ChartCache
 from .cluster import Cluster
+from .coalesce import Coalescer
 from .deployment_repository import DeploymentRepository
-from .jobs import scheduler, start_expire_deployments_job, start_reporting_job
+from .installer import Installer
+from .jobs import (
+    scheduler,
+    start_chart_prefetch_job,
+    start_expire_deployments_job,
+    start_orphan_gc_job,
+    start_recipe_index_job,
+    start_reporting_job,
+    start_teardown_job,
+    start_warm_pool_job,
+)
+from .manifest_cache import ManifestCache
+from .metrics import CONTENT_TYPE, REGISTRY
 from .openapi import load_spec
+from .orphans import OrphanCollector
+from .peer_activity import WireguardDump
+from .prometheus import Prometheus
+from .recipe_cache import RecipeCache
+from .recipe_watcher import RecipeWatcher
+from .teardown import Teardown
+from .warm_pool import WarmPool
 
 
 class Tier2DefaultConfig:
     RECIPES: str | Path | URL = "RECIPES"
+    RECIPES_CACHE_TTL: int = 60  # seconds
+    RECIPES_NEGATIVE_TTL: int = 10  # seconds
+    RECIPES_STALE_TTL: int = 600  # seconds
+    RECIPES_INDEX_REFRESH: int = 300  # seconds, 0 disables the index manifest
+    RECIPES_WATCH: bool = True  # keep local recipes in memory and watch for changes
     KUBECONFIG: str = ""
     KUBECONTEXT: str = ""
+    CLIENT_NETWORK: str = "10.5.0.0/16"  # tunnel addresses assigned to clients
+    METADATA_REFRESH: int = 60  # seconds between tunnel parameter refreshes
     PROMETHEUS: str = "http://kube-prometheus-stack-prometheus.monitoring:9090"
+    PROMETHEUS_TTL: int = 10  # seconds metrics are shared between users
+    WIREGUARD_INTERFACE: str = ""  # read tunnel activity with 'wg show'
+    WIREGUARD_DUMP: str = ""  # or from a file with 'wg show' dump output
     TIER1_URLS: list[str] = []
     TIER2_URL: str | None = None
+    DEPLOY_TIMEOUT: int = 300  # seconds concurrent requests wait for a deploy
+    DEPLOY_ASYNC: bool = True  # return before the backend is installed
+    INSTALL_WORKERS: int = 4  # concurrent background helm installs
+    INSTALL_QUEUE: int = 16  # queued installs before rejecting new deployments
+    CHART_CACHE: str | Path = Path(tempfile.gettempdir(), "sinfonia-charts")
+    CHART_CACHE_SIZE: int = 1 << 30  # bytes
+    CHART_CACHE_TTL: int = 300  # seconds before charts are revalidated
+    CHART_PREFETCH: int = 300  # seconds between chart prefetches, 0 disables
+    HELM_RELEASES: bool = True  # False applies cached manifests, see manifest_cache
+    SUSPEND_DURATION: int = 3600  # seconds idle backends stay scaled down
+    TEARDOWN_WORKERS: int = 4  # concurrent uninstalls of expired backends
+    STATUS_STREAMS: int = 8  # open status event streams, below WSGI workers
+    ORPHAN_GC_INTERVAL: int = 300  # seconds between orphan checks, 0 disables
+    ORPHAN_GRACE_PERIOD: int = 600  # seconds before orphans are removed
+    WARM_POOL: dict[str, int] = {}  # recipe uuid -> minimum warm backends
+    WARM_POOL_MAX: int = 4  # upper bound on warm backends per recipe
 
     # These are initialized by the wsgi app factory from the config
     # UUID: UUID
     # deployment_repository: DeploymentRepository | None = None     # RECIPES
+    # recipe_cache: RecipeCache | None = None       # RECIPES_*_TTL
+    # recipe_watcher: RecipeWatcher | None = None   # RECIPES_WATCH
     # K8S_CLUSTER : Cluster | None = None   # KUBECONFIG KUBECONTEXT PROMETHEUS
+    #                                         and CLIENT_NETWORK
+    # deploy_coalescer: Coalescer   # DEPLOY_TIMEOUT
 
 
 def tier2_app_factory(**args) -> connexion.FlaskApp:
@@ -68,21 +120,86 @@ def tier2_app_factory(**args) -> connexion.FlaskApp:
     flask_app.config["deployment_repository"] = DeploymentRepository(
         flask_app.config["RECIPES"]
     )
+    flask_app.config["recipe_cache"] = RecipeCache(
+        flask_app.config["deployment_repository"],
+        ttl=flask_app.config["RECIPES_CACHE_TTL"],
+        negative_ttl=flask_app.config["RECIPES_NEGATIVE_TTL"],
+        stale_ttl=flask_app.config["RECIPES_STALE_TTL"],
+    )
+    flask_app.config["recipe_watcher"] = None
+    if (
+        flask_app.config["RECIPES_WATCH"]
+        and flask_app.config["deployment_repository"].base_url.scheme == "file"
+    ):
+        flask_app.config["recipe_watcher"] = RecipeWatcher(
+            flask_app.config["recipe_cache"]
+        )
+        flask_app.config["recipe_watcher"].start()
+    elif flask_app.config["RECIPES_INDEX_REFRESH"]:
+        flask_app.config["recipe_cache"].load_index()
 
     # connect to local kubernetes cluster
     cluster = Cluster.connect(
-        flask_app.config.get("KUBECONFIG"), flask_app.config.get("KUBECONTEXT")
+        flask_app.config.get("KUBECONFIG"),
+        flask_app.config.get("KUBECONTEXT"),
+        flask_app.config["CLIENT_NETWORK"],
+        flask_app.config["SUSPEND_DURATION"],
+    )
+    cluster.events.max_streams = flask_app.config["STATUS_STREAMS"]
+    cluster.charts = ChartCache(
+        flask_app.config["CHART_CACHE"],
+        max_size=flask_app.config["CHART_CACHE_SIZE"],
+        ttl=flask_app.config["CHART_CACHE_TTL"],
+    )
+    if not flask_app.config["HELM_RELEASES"]:
+        cluster.manifests = ManifestCache(cluster.api, cluster.helm, cluster.charts)
+    cluster.prometheus = Prometheus(
+        URL(flask_app.config["PROMETHEUS"]), ttl=flask_app.config["PROMETHEUS_TTL"]
+    )
+    if flask_app.config["WIREGUARD_INTERFACE"]:
+        cluster.activity_sources.append(
+            WireguardDump.from_interface(flask_app.config["WIREGUARD_INTERFACE"])
+        )
+    if flask_app.config["WIREGUARD_DUMP"]:
+        cluster.activity_sources.append(
+            WireguardDump.from_file(flask_app.config["WIREGUARD_DUMP"])
+        )
+    if flask_app.config["DEPLOY_ASYNC"]:
+        cluster.installer = Installer(
+            max_workers=flask_app.config["INSTALL_WORKERS"],
+            max_queue=flask_app.config["INSTALL_QUEUE"],
+            listeners=[cluster.events.install_changed],
+        )
+    if flask_app.config["WARM_POOL"]:
+        cluster.warm_pool = WarmPool(
+            cluster,
+            {UUID(uuid): size for uuid, size in flask_app.config["WARM_POOL"].items()},
+            max_size=flask_app.config["WARM_POOL_MAX"],
+        )
+    cluster.teardown = Teardown(
+        cluster, max_workers=flask_app.config["TEARDOWN_WORKERS"]
     )
-    cluster.prometheus_url = (
-        URL(flask_app.config["PROMETHEUS"]) / "api" / "v1" / "query"
+    cluster.orphans = OrphanCollector(
+        cluster, grace_period=flask_app.config["ORPHAN_GRACE_PERIOD"]
     )
+    cluster.metadata.refresh_interval = flask_app.config["METADATA_REFRESH"]
+    cluster.metadata.start()
+    cluster.informer.start()
     flask_app.config["K8S_CLUSTER"] = cluster
+    flask_app.config["deploy_coalescer"] = Coalescer(
+        "deploy", timeout=flask_app.config["DEPLOY_TIMEOUT"]
+    )
 
     # start background jobs to expire deployments and report to Tier1
     scheduler.init_app(flask_app)
     scheduler.start()
     start_expire_deployments_job()
+    start_teardown_job()
+    start_orphan_gc_job()
     start_reporting_job()
+    start_recipe_index_job()
+    start_warm_pool_job()
+    start_chart_prefetch_job()
 
     # handle running behind reverse proxy (should this be made configurable?)
     flask_app.wsgi_app = ProxyFix(flask_app.wsgi_app)
@@ -98,6 +215,10 @@ def tier2_app_factory(**args) -> connexion.FlaskApp:
     def index():
         return ""
 
+    @app.route("/metrics")
+    def metrics():
+        return flask_app.response_class(REGISTRY.render(), content_type=CONTENT_TYPE)
+
     return app
 
 
@@ -162,6 +283,13 @@ def tier2_server(
         show_default=False,
         rich_help_panel="Kubernetes cluster config",
     ),
+    client_network: OptionalStr = typer.Option(
+        None,
+        metavar="CIDR",
+        help="Network to assign client tunnel addresses from [10.5.0.0/16]",
+        show_default=False,
+        rich_help_panel="Kubernetes cluster config",
+    ),
     prometheus: OptionalStr = typer.Option(
         None,
         metavar="URL",
@@ -193,6 +321,7 @@ def tier2_server(
         recipes=recipes,
         kubeconfig=kubeconfig,
         kubecontext=kubecontext,
+        client_network=client_network,
         prometheus=prometheus,
         tier1_urls=tier1_urls,
         tier2_url=tier2_url,
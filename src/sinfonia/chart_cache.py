@@ -0,0 +1,248 @@
+#
+# Sinfonia
+#
+# Copyright (c) 2022 Carnegie Mellon University
+#
+# SPDX-License-Identifier: MIT
+#
+"""Local cache of helm charts referenced by deployment recipes.
+
+Helm is always handed a local chart file. Charts from a remote recipe
+repository are downloaded once through the repository, so the same S3
+credentials and connection pool are used as for recipes, and stored by the
+sha256 digest of their contents. Chart references (chart-version) map to the
+digest of what they resolved to, charts with identical contents are stored
+only once.
+
+Chart references are revalidated with the repository (ETag/Last-Modified)
+after a while, so a chart that is republished under the same version is
+picked up. Charts are evicted least recently used first when the cache grows
+beyond its size limit, but not while helm may still be reading them.
+
+Charts referenced by known recipes are prefetched in the background so that
+even the first deploy of a recipe doesn't wait for the download.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+from typing import Callable, Iterable, Iterator
+
+from attrs import define, field
+from requests.exceptions import RequestException
+
+from .coalesce import Coalescer
+from .deployment_recipe import DeploymentRecipe
+from .deployment_repository import CacheValidators
+from .metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_SIZE = 1 << 30  # bytes
+
+REQUESTS = REGISTRY.counter(
+    "sinfonia_chart_cache_requests", "Chart lookups by result", ["result"]
+)
+DOWNLOAD_TIME = REGISTRY.histogram(
+    "sinfonia_chart_download_seconds", "Time taken to download a chart"
+)
+EVICTIONS = REGISTRY.counter(
+    "sinfonia_chart_cache_evictions", "Charts evicted from the cache"
+)
+CACHE_SIZE = REGISTRY.gauge("sinfonia_chart_cache_bytes", "Size of cached charts")
+
+
+def _digest(path: Path) -> str:
+    sha256 = hashlib.sha256()
+    with path.open("rb") as f:
+        for chunk in iter(lambda: f.read(1 << 16), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+@define
+class ChartRef:
+    digest: str
+    validators: CacheValidators | None
+    expires: float
+
+
+@define
+class ChartCache:
+    directory: Path = field(converter=Path)
+    max_size: int = DEFAULT_CACHE_SIZE
+    ttl: float = 300  # seconds before a chart reference is revalidated
+    retry_delay: float = 10  # seconds before retrying a failed revalidation
+    clock: Callable[[], float] = time.monotonic
+
+    # chart reference -> digest of the chart contents
+    _refs: dict[str, ChartRef] = field(init=False, factory=dict)
+    # digest -> size, least recently used first
+    _blobs: OrderedDict[str, int] = field(init=False, factory=OrderedDict)
+    # digest -> number of users, these are not evicted
+    _in_use: dict[str, int] = field(init=False, factory=dict)
+    _lock: threading.Lock = field(init=False, factory=threading.Lock)
+    _downloads: Coalescer[str] = field(
+        init=False, factory=lambda: Coalescer("chart_download")
+    )
+
+    def __attrs_post_init__(self) -> None:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        # charts left by a previous run, we lost track of their references
+        # but they go first when we have to evict.
+        for path in sorted(self.directory.glob("*.tgz"), key=os.path.getmtime):
+            self._blobs[path.stem] = path.stat().st_size
+        CACHE_SIZE.set_function(lambda: self.size)
+
+    @property
+    def size(self) -> int:
+        return sum(self._blobs.values())
+
+    def _path(self, digest: str) -> Path:
+        return self.directory / f"{digest}.tgz"
+
+    def get(self, recipe: DeploymentRecipe) -> Path:
+        """Return a local file with the recipe's chart, downloading it when
+        it is not yet cached. The file may be evicted once other charts are
+        downloaded, use() holds on to it.
+        Raises OSError or RequestException."""
+        return self._lookup(recipe, hold=False)
+
+    @contextmanager
+    def use(self, recipe: DeploymentRecipe) -> Iterator[Path]:
+        """Local file with the recipe's chart that is not evicted until
+        we're done with it. Raises OSError or RequestException."""
+        path = self._lookup(recipe, hold=True)
+        try:
+            yield path
+        finally:
+            if path.parent == self.directory:
+                self._release(path.stem)
+
+    def _hold(self, digest: str, hold: bool) -> Path:
+        """Called with the lock held."""
+        if hold:
+            self._in_use[digest] = self._in_use.get(digest, 0) + 1
+        return self._path(digest)
+
+    def _release(self, digest: str) -> None:
+        with self._lock:
+            users = self._in_use.pop(digest, 0) - 1
+            if users > 0:
+                self._in_use[digest] = users
+            self._evict()
+
+    def _lookup(self, recipe: DeploymentRecipe, hold: bool) -> Path:
+        chart_ref = recipe.chart_ref
+        if chart_ref.scheme == "file":
+            return Path(chart_ref.path)
+
+        key = str(chart_ref)
+        with self._lock:
+            ref = self._refs.get(key)
+            if ref is not None and ref.digest in self._blobs:
+                if self.clock() < ref.expires:
+                    self._blobs.move_to_end(ref.digest)
+                    REQUESTS.inc(result="hit")
+                    return self._hold(ref.digest, hold)
+                REQUESTS.inc(result="revalidate")
+            else:
+                REQUESTS.inc(result="miss")
+
+        while True:
+            digest = self._downloads.run(key, lambda: self._download(recipe))
+            with self._lock:
+                if digest in self._blobs:
+                    return self._hold(digest, hold)
+            # evicted by a concurrent download before we got hold of it
+            logger.info(f"Chart {key} was evicted, downloading it again")
+
+    def _download(self, recipe: DeploymentRecipe) -> str:
+        """Download the chart unless the cached copy is still current,
+        returns the digest of the chart."""
+        key = str(recipe.chart_ref)
+        with self._lock:
+            ref = self._refs.get(key)
+            if ref is not None and ref.digest not in self._blobs:
+                ref = None
+        validators = ref.validators if ref is not None else None
+
+        start = self.clock()
+        with NamedTemporaryFile(dir=self.directory, suffix=".part", delete=False) as f:
+            tmp_path = Path(f.name)
+            try:
+                validators = recipe.repository.download(
+                    f"{recipe.chart_version}.tgz", f, validators
+                )
+            except BaseException as e:
+                f.close()
+                tmp_path.unlink()
+                if ref is None or not isinstance(e, (OSError, RequestException)):
+                    raise
+                # keep using the cached chart for a while
+                logger.warning(f"Failed to revalidate chart {key}: {e!r}")
+                with self._lock:
+                    ref.expires = self.clock() + self.retry_delay
+                return ref.digest
+
+        if validators is None:
+            # not modified since we downloaded it
+            assert ref is not None
+            tmp_path.unlink()
+            with self._lock:
+                ref.expires = self.clock() + self.ttl
+            return ref.digest
+        DOWNLOAD_TIME.observe(self.clock() - start)
+
+        digest = _digest(tmp_path)
+        path = self._path(digest)
+        os.replace(tmp_path, path)
+        if ref is None or ref.digest != digest:
+            logger.info(f"Cached chart {key} as {digest}")
+
+        with self._lock:
+            self._refs[key] = ChartRef(digest, validators, self.clock() + self.ttl)
+            self._blobs[digest] = path.stat().st_size
+            self._blobs.move_to_end(digest)
+            self._evict()
+        return digest
+
+    def _evict(self) -> None:
+        """Drop least recently used charts until we fit, called with the lock
+        held. Never evicts the most recently used chart, or charts that are
+        in use."""
+        size = self.size
+        if size <= self.max_size or not self._blobs:
+            return
+        newest = next(reversed(self._blobs))
+        for digest in list(self._blobs):
+            if size <= self.max_size:
+                break
+            if digest == newest or digest in self._in_use:
+                continue
+            blob_size = self._blobs.pop(digest)
+            try:
+                self._path(digest).unlink()
+            except FileNotFoundError:
+                pass
+            self._refs = {
+                key: ref for key, ref in self._refs.items() if ref.digest != digest
+            }
+            size -= blob_size
+            EVICTIONS.inc()
+
+    def prefetch(self, recipes: Iterable[DeploymentRecipe]) -> None:
+        """Make sure the charts for the recipes are cached."""
+        for recipe in recipes:
+            try:
+                self.get(recipe)
+            except (OSError, RequestException) as e:
+                logger.warning(f"Failed to prefetch chart {recipe.chart_ref}: {e!r}")
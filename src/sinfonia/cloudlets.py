@@ -24,6 +24,7 @@ from attrs import define
 from connexion.exceptions import ProblemException
 from flask import current_app
 from jsonschema import Draft202012Validator
+from wireguard_tools import WireguardKey
 from yarl import URL
 
 from .client_info import ClientInfo
@@ -109,6 +110,28 @@ CLOUDLET_SCHEMA = {
 logging.basicConfig(format="%(levelname)s:%(message)s", level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# seconds to back off when a busy cloudlet didn't say for how long
+DEFAULT_RETRY_AFTER = 5
+
+
+class CloudletBusy(Exception):
+    """Cloudlet is too busy to deploy right now (503 Service Unavailable)."""
+
+    def __init__(self, name: str, retry_after: int):
+        super().__init__(name, retry_after)
+        self.name = name
+        self.retry_after = retry_after
+
+    def __str__(self) -> str:
+        return f"{self.name} is busy, retry after {self.retry_after}s"
+
+
+def retry_after(response: requests.Response) -> int:
+    try:
+        return max(0, int(response.headers["Retry-After"]))
+    except (KeyError, ValueError):
+        return DEFAULT_RETRY_AFTER
+
 
 def getaddrinfo(host, port):
     # return list of global ip addresses for the service at host/port.
@@ -262,7 +285,9 @@ class Cloudlet:
         app_uuid: UUID,
         client_info: ClientInfo,
     ) -> Future:
-        """Initiate backend deployment on this cloudlet."""
+        """Initiate backend deployment on this cloudlet.
+        The result raises CloudletBusy when the cloudlet asked us to back off.
+        """
 
         def deploy(
             url: str,
@@ -277,12 +302,20 @@ class Cloudlet:
                     headers["X-Location"] = f"{client_location[0]},{client_location[1]}"
                 r = requests.post(url, headers=headers)
                 r.raise_for_status()
-                return r.json()
+                # tell clients where to follow the deployment status
+                return [dict(result, Cloudlet=cloudlet_uuid) for result in r.json()]
+            except requests.exceptions.HTTPError as e:
+                if e.response is not None and e.response.status_code == 503:
+                    raise CloudletBusy(name, retry_after(e.response))
+                logger.exception("Exception while forwarding request")
+                return []
             except requests.exceptions.RequestException:
                 logger.exception("Exception while forwarding request")
                 return []
 
         request_url = self.endpoint / str(app_uuid) / client_info.publickey.urlsafe
+        cloudlet_uuid = str(self.uuid)
+        name = self.name
 
         executor = current_app.config["executor"]
         return executor.submit(
@@ -300,12 +333,32 @@ class Cloudlet:
         """Request backend deployment on this cloudlet."""
 
         request = self.deploy_async(app_uuid, client_info)
-        result = request.result()
+        try:
+            result = request.result()
+        except CloudletBusy as e:
+            raise ProblemException(
+                503,
+                "Service Unavailable",
+                str(e),
+                headers={"Retry-After": str(e.retry_after)},
+            )
         if result is None:
             raise ProblemException(500, "Error", "Error while forwarding request")
 
         return result
 
+    def status_events(
+        self, app_uuid: UUID, public_key: WireguardKey
+    ) -> requests.Response:
+        """Open the deployment status event stream on this cloudlet.
+        Raises RequestException.
+        """
+        url = self.endpoint / str(app_uuid) / public_key.urlsafe / "events"
+        # the read timeout is well beyond the keepalive interval
+        r = requests.get(str(url), stream=True, timeout=(5, 60))
+        r.raise_for_status()
+        return r
+
     def distance_from(self, location: GeoLocation) -> float | None:
         """Calculate closest distance to any cloudlet managed by this Tier 2 instance.
         Return distance in kilometers, or None when cloudlet location is unknown.
@@ -10,123 +10,164 @@
 
 from __future__ import annotations
 
-import ipaddress
-import json
 import logging
-import math
-import random
-from ipaddress import IPv4Address
-from typing import Any, Iterator, Sequence
+from ipaddress import IPv4Address, IPv6Address
+from typing import Any, Callable, Iterator
 from uuid import UUID
 
-import pendulum
-import requests
 from attrs import define, field
 from connexion.exceptions import ProblemException
-from plumbum.cmd import helm, kubectl
+from plumbum.cmd import helm
 from plumbum.commands.base import BaseCommand
-from plumbum.commands.processes import ProcessExecutionError
 from requests.exceptions import RequestException
 from wireguard_tools import WireguardKey
-from yarl import URL
 
+from .chart_cache import ChartCache
+from .cluster_metadata import ClusterMetadata, MetadataCache, MetadataUnavailable
 from .deployment import CLIENT_NETWORK, Deployment
 from .deployment_recipe import DeploymentRecipe
-
-RESOURCE_QUERIES = {
-    "cpu_ratio": 'sum(rate(node_cpu_seconds_total{mode!="idle"}[1m])) / sum(node:node_num_cpu:sum)',  # noqa
-    "mem_ratio": "sum(1 - (node_memory_MemAvailable_bytes / node_memory_MemTotal_bytes)) / count(node_memory_MemTotal_bytes)",  # noqa
-    "net_rx_rate": "instance:node_network_receive_bytes_excluding_lo:rate5m",
-    "net_tx_rate": "instance:node_network_transmit_bytes_excluding_lo:rate5m",
-    "gpu_ratio": "sum(DCGM_FI_DEV_GPU_UTIL) / count(DCGM_FI_DEV_GPU_UTIL)",
-}
+from .installer import Installer, InstallQueueFull, install_queue_full
+from .ipam import AddressPoolExhausted, ClientAddressPool, peer_address
+from .kube_client import PEERS, KubeClient
+from .leases import LeaseScheduler
+from .manifest_cache import ManifestCache
+from .node_resources import (
+    NODE_QUERIES,
+    RESOURCE_QUERIES,
+    NodeHeadroom,
+    best_gpu_node,
+    needs_gpu,
+    nodes_from_metrics,
+    over_utilized,
+    resources_from_metrics,
+    summarize,
+)
+from .orphans import OrphanCollector
+from .peer_activity import ActivePeers, ActivitySource, prometheus_active_peers
+from .peer_informer import DEPLOYMENT_SELECTOR, PeerInformer
+from .prometheus import Prometheus, QueryResults
+from .status_events import StatusBroker
+from .teardown import Teardown
+from .warm_pool import WarmPool
 
 LEASE_DURATION = 300  # seconds
 
+# tunnels with recent handshakes or received traffic
+ACTIVE_PEERS_QUERY = (
+    f"delta(wireguard_last_handshake_seconds[{LEASE_DURATION}s])!=0"
+    " or "
+    f"delta(wireguard_received_bytes_total[{LEASE_DURATION}s])!=0"
+)
+SUSPEND_DURATION = 3600  # seconds an idle deployment stays suspended
+SUSPEND_RETRY = 60  # seconds before retrying a failed suspend
+EXPIRE_RETRY = 60  # seconds before retrying a failed expire
+
+# reclaim suspended deployments when utilization is above this ratio
+RESOURCE_PRESSURE = 0.8
+
 
 @define
 class Cluster:
-    # bound commands using the current cluster config and context
-    kubectl: BaseCommand = field()
+    # in-process client for the kubernetes API server and bound helm command
+    # using the current cluster config and context
+    api: KubeClient = field()
     helm: BaseCommand = field()
 
-    # tunnel public key and endpoint information
-    tunnel_public_key: WireguardKey = field(init=False)
-    tunnel_endpoint: str = field(init=False)
-    kubedns_address: ipaddress.IPv4Address = field(
-        init=False, converter=ipaddress.ip_address
-    )
+    # addresses assigned to clients from the tunnel client network
+    ipam: ClientAddressPool = field(factory=lambda: ClientAddressPool(CLIENT_NETWORK))
+
+    # runs helm installs in the background when set
+    installer: Installer | None = None
+
+    # local copies of helm charts, otherwise helm fetches the chart itself
+    charts: ChartCache | None = None
+
+    # rendered chart manifests, backends are installed by applying these
+    # instead of running helm install when set
+    manifests: ManifestCache | None = None
+
+    # pre-provisioned backends for frequently deployed recipes when set
+    warm_pool: WarmPool | None = None
+
+    # removes expired deployments in batches in the background when set
+    teardown: Teardown | None = None
+
+    # periodically removes peers and namespaces that lost their counterpart
+    orphans: OrphanCollector | None = None
+
+    # idle deployments are scaled down and only removed after they have been
+    # suspended for this long, 0 removes them right away
+    suspend_duration: int = SUSPEND_DURATION
+
+    # tunnel and DNS parameters for clients, discovered in the background
+    metadata: MetadataCache = field(init=False)
 
     # currently we can only extract resource metrics from a local
     # prometheus when we're running in a kubernetes cluster. in the long
     # run we may have to use kubectl port-forward to punch a hole into the
     # right cluster.
-    prometheus_url: URL = field()
+    prometheus: Prometheus = field(factory=Prometheus)
+
+    # sources of tunnel activity that are tried before falling back to
+    # querying prometheus
+    activity_sources: list[ActivitySource] = field(factory=list)
+
+    # pushes deployment status changes to subscribed clients
+    events: StatusBroker = field(factory=StatusBroker)
+
+    # lease deadlines of deployments, kept up to date by the informer
+    leases: LeaseScheduler = field(init=False)
+
+    # watch-based cache of deployment peers, queries fall back to listing
+    # peers with the API server until it is started and synchronized.
+    informer: PeerInformer = field(init=False)
 
     @classmethod
-    def connect(cls, kubeconfig: str = "", kubecontext: str = "") -> Cluster:
+    def connect(
+        cls,
+        kubeconfig: str = "",
+        kubecontext: str = "",
+        client_network: str = str(CLIENT_NETWORK),
+        suspend_duration: int = SUSPEND_DURATION,
+    ) -> Cluster:
         return cls(
-            kubectl=kubectl[f"--kubeconfig={kubeconfig}", f"--context={kubecontext}"],
+            api=KubeClient.connect(kubeconfig, kubecontext),
             helm=helm[f"--kubeconfig={kubeconfig}", f"--kube-context={kubecontext}"],
+            ipam=ClientAddressPool(client_network),
+            suspend_duration=suspend_duration,
         )
 
-    @tunnel_public_key.default
-    def _tunnel_public_key(self) -> WireguardKey:
-        try:
-            key = self.kubectl(
-                "get",
-                "node",
-                "-o",
-                r"jsonpath={.items[0].metadata.annotations.kilo\.squat\.ai/key}",
-            ).strip()
-            return WireguardKey(key)
-        except ProcessExecutionError:
-            # fake it until we break it
-            return WireguardKey.generate().public_key()
-
-    @tunnel_endpoint.default
-    def _tunnel_endpoint(self) -> str:
-        try:
-            return self.kubectl(
-                "get",
-                "node",
-                "-o",
-                r"jsonpath={.items[0].metadata.annotations.kilo\.squat\.ai/endpoint}",
-            ).strip()
-        except ProcessExecutionError:
-            return ""
-
-    @kubedns_address.default
-    def _kubedns_address(self) -> str:
-        try:
-            return self.kubectl(
-                "-n",
-                "kube-system",
-                "get",
-                "service",
-                "kube-dns",
-                "-o",
-                "jsonpath={.spec.clusterIP}",
-            ).strip()
-        except ProcessExecutionError:
-            return "8.8.8.8"
-
-    @prometheus_url.default
-    def _prometheus_url(self) -> URL:
-        return URL(
-            "http://kube-prometheus-stack-prometheus.monitoring:9090/api/v1/query"
+    @metadata.default
+    def _metadata(self) -> MetadataCache:
+        return MetadataCache(self.api)
+
+    @leases.default
+    def _leases(self) -> LeaseScheduler:
+        return LeaseScheduler(LEASE_DURATION, self.suspend_duration)
+
+    @informer.default
+    def _informer(self) -> PeerInformer:
+        return PeerInformer(
+            self.api,
+            listeners=[
+                self.ipam.peer_changed,
+                self.leases.peer_changed,
+                self.events.peer_changed,
+            ],
         )
 
     def get_peers(self, *args: str) -> list[dict[str, Any]]:
+        if self.informer.healthy:
+            return self.informer.select(*args)
+
         selector = ",".join(args)
         try:
-            result = self.kubectl("get", "peer", "-o", "json", "-l", selector)
-            return json.loads(result)["items"]
-        except ProcessExecutionError:
+            return self.api.list(PEERS, label_selector=selector)["items"]
+        except RequestException:
             return []
 
     def deployments(self) -> Iterator[Deployment]:
-        for ns in self.get_peers("findcloudlet.org=deployment"):
+        for ns in self.get_peers(DEPLOYMENT_SELECTOR):
             yield Deployment.from_manifest(self, ns)
 
     def get(
@@ -163,83 +204,144 @@ class Cluster:
         if not create:
             return default
 
-        return Deployment.from_recipe(
-            cluster=self,
-            recipe=recipe,
-            client_public_key=key,
-        )
+        # reject early when we can't install any time soon, the reserved
+        # place in the install queue is used or given back by deploy()
+        try:
+            if self.installer is not None:
+                self.installer.admit()
+        except InstallQueueFull as e:
+            raise install_queue_full(e)
 
-    def get_unique_client_address(self) -> IPv4Address:
-        """Find an unused address to assign to a client"""
-        while True:
-            hosts = list(CLIENT_NETWORK.hosts())
-            for client_ip in random.sample(hosts, 32):
-                ns_list = self.get_peers(f"findcloudlet.org/client={client_ip}")
-                if not ns_list:
-                    assert isinstance(client_ip, IPv4Address)
-                    return client_ip
-            print("Unable to find unique client ip in 32 tries, resampling candidates")
+        try:
+            return Deployment.from_recipe(
+                cluster=self,
+                recipe=recipe,
+                client_public_key=key,
+                admitted=self.installer is not None,
+            )
+        except AddressPoolExhausted:
+            if self.installer is not None:
+                self.installer.release()
+            logging.error(f"No free addresses left in {self.ipam.network}")
+            raise ProblemException(
+                503, "Service Unavailable", "No client addresses available"
+            )
+
+    def tunnel_metadata(self) -> ClusterMetadata:
+        try:
+            return self.metadata.get()
+        except MetadataUnavailable as e:
+            logging.error(str(e))
+            raise ProblemException(
+                503, "Service Unavailable", "Tunnel configuration unavailable"
+            )
+
+    def get_unique_client_address(self) -> IPv4Address | IPv6Address:
+        """Allocate an unused address to assign to a client.
+        Raises AddressPoolExhausted when the client network is full.
+        """
+        if not self.informer.healthy:
+            # the informer keeps the pool in sync, without it we have to
+            # rebuild it from the currently existing peers.
+            peers = self.api.list(PEERS, label_selector=DEPLOYMENT_SELECTOR)
+            addresses = map(peer_address, peers["items"])
+            self.ipam.reset(address for address in addresses if address is not None)
+        return self.ipam.allocate()
+
+    def _metrics(self) -> QueryResults:
+        """Resource metrics and active tunnels, collected in a single pass
+        and shared by reporting and deployment expiration."""
+        queries = {
+            resource: f"scalar({query})" for resource, query in RESOURCE_QUERIES.items()
+        }
+        queries["active_peers"] = ACTIVE_PEERS_QUERY
+        queries.update(NODE_QUERIES)
+        return self.prometheus.query(queries)
+
+    def node_headroom(self) -> list[NodeHeadroom]:
+        return nodes_from_metrics(self._metrics())
+
+    def placement(self, recipe: DeploymentRecipe) -> str | None:
+        """Preferred node for a recipe that needs scarce resources."""
+        if not needs_gpu(recipe.values):
+            return None
+        return best_gpu_node(self.node_headroom())
 
     def get_resources(self) -> dict[str, float]:
-        resources: dict[str, float] = {}
-
-        for resource in RESOURCE_QUERIES:
-            try:
-                r = requests.post(
-                    str(self.prometheus_url),
-                    data={
-                        "query": f"scalar({RESOURCE_QUERIES[resource]})",
-                    },
-                )
-                r.raise_for_status()
-
-                result = r.json()
-                assert result["status"] == "success"
-                assert result["data"]["resultType"] == "scalar"
-
-                metric = float(result["data"]["result"][1])
-                if math.isfinite(metric):
-                    resources[resource] = metric
-
-            except (RequestException, AssertionError, ValueError):
-                logging.exception(f"Failed to retrieve {resource}")
-                pass
+        metrics = self._metrics()
+        resources = resources_from_metrics(metrics)
+        resources.update(summarize(nodes_from_metrics(metrics)))
+
+        if self.installer is not None:
+            resources.update(self.installer.resources())
         return resources
 
-    def _active_peers(self, lease_duration: int) -> Sequence[WireguardKey]:
+    def _active_peers(self) -> ActivePeers | None:
+        """Keys of clients with active tunnels, None when unknown."""
+        for source in self.activity_sources:
+            active_peers = source.active_peers(LEASE_DURATION)
+            if active_peers is not None:
+                return active_peers
+        return prometheus_active_peers(self._metrics())
+
+    def _resource_pressure(self) -> bool:
+        return over_utilized(self.get_resources(), RESOURCE_PRESSURE)
+
+    def _expire(self, deployment: Deployment, now: float) -> None:
+        """Expire a deployment, it is examined again later when that fails."""
         try:
-            r = requests.post(
-                str(self.prometheus_url),
-                data=dict(
-                    query=(
-                        f"delta(wireguard_last_handshake_seconds[{lease_duration}s])!=0"
-                        " or "
-                        f"delta(wireguard_received_bytes_total[{lease_duration}s])!=0"
-                    ),
-                ),
-            )
-            r.raise_for_status()
-
-            result = r.json()
-            assert result["status"] == "success"
-            assert result["data"]["resultType"] == "vector"
-
-            return [
-                WireguardKey(peer["metric"]["public_key"])
-                for peer in result["data"]["result"]
-            ]
-        except (RequestException, AssertionError, ValueError):
-            logging.exception("Failed to retrieve active peers")
-            return []
+            deployment.expire()
+        except RequestException:
+            logging.exception(f"Failed to expire {deployment.name}")
+            self.leases.schedule(deployment.name, now + EXPIRE_RETRY)
 
     def expire_inactive_deployments(self) -> None:
-        cutoff = pendulum.now().subtract(seconds=LEASE_DURATION)
-        active_peers = self._active_peers(LEASE_DURATION)
-
-        for deployment in self.deployments():
-            if (
-                deployment.created < cutoff
-                and deployment.client_public_key not in active_peers
-            ):
+        """Suspend or expire deployments whose lease ran out."""
+        active_peers = self._active_peers()
+        if active_peers is None:
+            # without knowing who is active we'd suspend everything
+            logging.warning("Active tunnels unknown, not expiring deployments")
+            return
+
+        get_peer: Callable[[str], dict[str, Any] | None] = self.informer.get
+        if not self.informer.healthy:
+            peers = {
+                peer["metadata"]["name"]: peer
+                for peer in self.get_peers(DEPLOYMENT_SELECTOR)
+            }
+            self.leases.sync(peers.values())
+            get_peer = peers.get  # type: ignore[assignment]
+
+        now = self.leases.clock()
+        self.leases.observe(active_peers, now)
+
+        for name in self.leases.due(now):
+            peer = get_peer(name)
+            if peer is None:
+                self.leases.remove(name)
+                continue
+
+            deployment = Deployment.from_manifest(self, peer)
+            if deployment.suspended is not None:
+                logging.info(f"Expiring suspended {deployment.name}")
+                self._expire(deployment, now)
+            elif not self.suspend_duration:
                 logging.info(f"Expiring {deployment.name}")
-                deployment.expire()
+                self._expire(deployment, now)
+            else:
+                logging.info(f"Suspending {deployment.name}")
+                try:
+                    deployment.suspend()
+                except RequestException:
+                    logging.exception(f"Failed to suspend {deployment.name}")
+                    self.leases.schedule(name, now + SUSPEND_RETRY)
+
+        # scaled down backends still hold on to storage, services and addresses
+        suspended = self.leases.suspended()
+        if suspended and self._resource_pressure():
+            for name in suspended:
+                peer = get_peer(name)
+                if peer is None:
+                    continue
+                logging.info(f"Expiring suspended {name}, low resources")
+                self._expire(Deployment.from_manifest(self, peer), now)
@@ -0,0 +1,147 @@
+#
+# Sinfonia
+#
+# Copyright (c) 2022 Carnegie Mellon University
+#
+# SPDX-License-Identifier: MIT
+#
+"""Tunnel and DNS parameters that clients need to reach their backend.
+
+The tunnel public key and endpoint are annotations that Kilo adds to the
+cluster nodes and the DNS server is the cluster IP of the kube-dns service.
+These are discovered together, in the background so that startup does not
+wait for the API server, and refreshed periodically so that a rotated Kilo
+key is picked up.
+
+We never make these up. When they could not be retrieved recently enough
+the deployment status can not be returned, clients would not be able to
+connect with a made up key or DNS server anyway.
+"""
+
+from __future__ import annotations
+
+import logging
+import threading
+import time
+from ipaddress import IPv4Address, IPv6Address, ip_address
+from typing import Callable
+
+from attrs import define, field
+from requests.exceptions import RequestException
+from wireguard_tools import WireguardKey
+
+from .coalesce import Coalescer
+from .kube_client import KUBE_DNS, NODES, KubeClient
+from .metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+KILO_KEY = "kilo.squat.ai/key"
+KILO_ENDPOINT = "kilo.squat.ai/endpoint"
+KILO_LEADER = "kilo.squat.ai/leader"
+
+REFRESH_ERRORS = REGISTRY.counter(
+    "sinfonia_metadata_refresh_errors", "Failed cluster metadata refreshes"
+)
+
+
+class MetadataUnavailable(Exception):
+    pass
+
+
+@define(frozen=True)
+class ClusterMetadata:
+    tunnel_public_key: WireguardKey
+    tunnel_endpoint: str
+    kubedns_address: IPv4Address | IPv6Address = field(converter=ip_address)
+
+    @classmethod
+    def discover(cls, api: KubeClient) -> ClusterMetadata:
+        """Read the Kilo node annotations and the kube-dns address.
+        Raises RequestException, or ValueError when they are missing.
+        """
+        nodes = [
+            node["metadata"].get("annotations", {}) for node in api.list(NODES)["items"]
+        ]
+        kilo_nodes = [annotations for annotations in nodes if KILO_KEY in annotations]
+        if not kilo_nodes:
+            raise ValueError("No nodes with a Kilo public key")
+        # prefer the leader of the location, which is the node peers talk to
+        leader = next(
+            (node for node in kilo_nodes if node.get(KILO_LEADER) == "true"),
+            kilo_nodes[0],
+        )
+
+        try:
+            kubedns_address = api.get(KUBE_DNS)["spec"]["clusterIP"]
+        except KeyError:
+            raise ValueError("kube-dns service has no cluster IP")
+
+        return cls(
+            tunnel_public_key=WireguardKey(leader[KILO_KEY]),
+            tunnel_endpoint=leader.get(KILO_ENDPOINT, ""),
+            kubedns_address=kubedns_address,
+        )
+
+
+@define
+class MetadataCache:
+    api: KubeClient
+    refresh_interval: float = 60.0  # seconds
+    max_age: float = 300.0  # seconds before metadata is considered stale
+    clock: Callable[[], float] = time.monotonic
+
+    _current: ClusterMetadata | None = field(init=False, default=None)
+    _updated: float = field(init=False, default=0.0)
+    _lock: threading.Lock = field(init=False, factory=threading.Lock)
+    _refreshes: Coalescer[ClusterMetadata | None] = field(
+        init=False, factory=lambda: Coalescer("cluster_metadata")
+    )
+    _stop: threading.Event = field(init=False, factory=threading.Event)
+    _thread: threading.Thread | None = field(init=False, default=None)
+
+    def refresh(self) -> ClusterMetadata | None:
+        """Discover the current metadata, None when that failed."""
+        try:
+            metadata = ClusterMetadata.discover(self.api)
+        except (RequestException, ValueError) as e:
+            logger.warning(f"Failed to discover cluster metadata: {e!r}")
+            REFRESH_ERRORS.inc()
+            return None
+
+        with self._lock:
+            current = self._current
+            self._current, self._updated = metadata, self.clock()
+        if current is not None and current != metadata:
+            logger.info(f"Cluster metadata changed to {metadata}")
+        return metadata
+
+    def get(self) -> ClusterMetadata:
+        """Current metadata, refreshed when it is out of date.
+        Raises MetadataUnavailable.
+        """
+        with self._lock:
+            current, updated = self._current, self._updated
+        if current is not None and self.clock() - updated < self.max_age:
+            return current
+
+        metadata = self._refreshes.run("metadata", self.refresh)
+        if metadata is None:
+            raise MetadataUnavailable("Tunnel configuration is unavailable")
+        return metadata
+
+    def start(self) -> None:
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float | None = None) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            self._refreshes.run("metadata", self.refresh)
+            self._stop.wait(self.refresh_interval)
@@ -0,0 +1,83 @@
+#
+# Sinfonia
+#
+# Copyright (c) 2022 Carnegie Mellon University
+#
+# SPDX-License-Identifier: MIT
+#
+"""Serialize and coalesce concurrent operations on the same key.
+
+The first caller for a key runs the operation, callers arriving while it is
+in flight wait for and share its result (or exception). Operations on
+different keys run in parallel.
+"""
+
+from __future__ import annotations
+
+import threading
+from concurrent.futures import Future
+from typing import Callable, Generic, Hashable, TypeVar
+
+from attrs import define, field
+
+from .metrics import REGISTRY
+
+T = TypeVar("T")
+
+REQUESTS = REGISTRY.counter(
+    "sinfonia_coalescer_requests",
+    "Operations requested",
+    ["operation"],
+)
+COALESCED = REGISTRY.counter(
+    "sinfonia_coalescer_coalesced",
+    "Operations that waited on an already in-flight operation for the same key",
+    ["operation"],
+)
+INFLIGHT = REGISTRY.gauge(
+    "sinfonia_coalescer_inflight",
+    "Operations currently in flight",
+    ["operation"],
+)
+
+
+@define
+class Coalescer(Generic[T]):
+    operation: str
+    timeout: float | None = None  # seconds waiters wait for the result
+
+    _inflight: dict[Hashable, Future[T]] = field(init=False, factory=dict)
+    _lock: threading.Lock = field(init=False, factory=threading.Lock)
+
+    def __attrs_post_init__(self) -> None:
+        INFLIGHT.set_function(lambda: len(self._inflight), operation=self.operation)
+
+    def run(self, key: Hashable, function: Callable[[], T]) -> T:
+        """Run function, unless it already is running for this key in which
+        case we wait for the result. May raise concurrent.futures.TimeoutError.
+        """
+        REQUESTS.inc(operation=self.operation)
+        with self._lock:
+            future = self._inflight.get(key)
+            leader = future is None
+            if future is None:
+                future = self._inflight[key] = Future()
+
+        if not leader:
+            COALESCED.inc(operation=self.operation)
+            return future.result(self.timeout)
+
+        try:
+            result = function()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._inflight[key]
+
+    def __len__(self) -> int:
+        return len(self._inflight)
@@ -10,26 +10,28 @@
 
 from __future__ import annotations
 
-from ipaddress import (
-    IPv4Address,
-    IPv4Network,
-    IPv6Address,
-    IPv6Network,
-    ip_address,
-    ip_network,
-)
-from tempfile import NamedTemporaryFile
-from typing import TYPE_CHECKING, Any, Callable, cast
+import hashlib
+import logging
+import tempfile
+from base64 import b32encode
+from contextlib import contextmanager
+from ipaddress import IPv4Address, IPv6Address, ip_address, ip_network
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Dict, Iterator, Tuple, cast
 from uuid import UUID
 
 import pendulum
-import randomname
-import yaml
-from attrs import define, field
-from plumbum import TF
+from attrs import converters, define, field
+from requests.exceptions import RequestException
 from wireguard_tools import WireguardKey
 
 from .deployment_recipe import DeploymentRecipe
+from .installer import FAILED, InstallStatus
+from .ipam import address_from_k8s_label, address_to_k8s_label
+from .kube_client import NAMESPACES, PEERS, KubeApiError
+from .manifest_cache import WORKLOADS, UnsupportedChart, values_file
+from .node_resources import place_values
+from .teardown import TeardownInProgress
 
 if TYPE_CHECKING:
     from .cluster import Cluster
@@ -38,17 +40,10 @@ else:
 
 CLIENT_NETWORK = ip_network("10.5.0.0/16")
 
+SUSPENDED = "findcloudlet.org/suspended"
+REPLICAS = "findcloudlet.org/replicas"
 
-def check_in_network(
-    network: IPv4Network | IPv6Network,
-) -> Callable[[Any, Any, IPv4Address | IPv6Address], None]:
-    """Check if the address is in the client network"""
-
-    def _check(_self: Any, _attribute: Any, value: IPv4Address | IPv6Address) -> None:
-        if value not in network:
-            raise ValueError
-
-    return _check
+Workload = Tuple[str, Dict[str, Any]]
 
 
 def parse_date(value: str | pendulum.DateTime) -> pendulum.DateTime:
@@ -74,31 +69,142 @@ def key_to_k8s_label(key: WireguardKey) -> str:
     return f"wg-{key.urlsafe}-pubkey"
 
 
+def deployment_name(uuid: UUID, key: WireguardKey) -> str:
+    """Deterministic name for the Peer, namespace and helm release of a
+    deployment, so that concurrent deploys for the same client collide."""
+    digest = hashlib.blake2b(uuid.bytes + key.keydata, digest_size=10).digest()
+    return f"sinfonia-{b32encode(digest).decode().lower()}"
+
+
+@contextmanager
+def chart_file(cluster: Cluster, recipe: DeploymentRecipe) -> Iterator[str]:
+    """Chart reference to hand to helm.
+
+    Helm can not fetch s3:// references without the helm-s3 plugin, so
+    without a chart cache these are downloaded through the recipe repository.
+    """
+    if cluster.charts is not None:
+        with cluster.charts.use(recipe) as path:
+            yield str(path)
+    elif recipe.chart_ref.scheme != "s3":
+        yield str(recipe.chart_ref)
+    else:
+        with tempfile.TemporaryDirectory(prefix="sinfonia-") as tmpdir:
+            path = Path(tmpdir, "chart.tgz")
+            with path.open("wb") as f:
+                recipe.repository.download(f"{recipe.chart_version}.tgz", f)
+            yield str(path)
+
+
+def helm_install(
+    cluster: Cluster,
+    recipe: DeploymentRecipe,
+    namespace: str,
+    wait: bool = False,
+    timeout: int = 300,
+    node: str | None = None,
+) -> None:
+    """Install the recipe's chart as a release named after its namespace.
+
+    With wait it only returns once the backend is ready, or raises when it
+    did not become ready within timeout seconds.
+    """
+    wait_args = ["--wait", "--timeout", f"{timeout}s"] if wait else []
+    chart_values = recipe.values if node is None else place_values(recipe.values, node)
+    with chart_file(cluster, recipe) as chart, values_file(chart_values) as values:
+        cluster.helm(
+            "install",
+            "--namespace",
+            namespace,
+            "--create-namespace",
+            "--values",
+            values,
+            "--replace",
+            *wait_args,
+            namespace,
+            chart,
+        )
+
+
+def install_chart(
+    cluster: Cluster,
+    recipe: DeploymentRecipe,
+    namespace: str,
+    wait: bool = False,
+    timeout: int = 300,
+) -> None:
+    """Install the recipe's backend in namespace, by applying its rendered
+    manifests when we can, and otherwise as a helm release."""
+    node = cluster.placement(recipe)
+    if node is not None:
+        logging.info(f"Preferring node {node} for {namespace}")
+
+    if cluster.manifests is not None:
+        try:
+            cluster.manifests.apply(recipe, namespace, wait, timeout, node)
+            return
+        except UnsupportedChart as e:
+            logging.info(f"{e}, installing as helm release")
+    helm_install(cluster, recipe, namespace, wait, timeout, node)
+
+
 @define
 class Deployment:
     cluster: Cluster
-    recipe: DeploymentRecipe
     client_public_key: WireguardKey
-    client_ip: IPv4Address | IPv6Address = field(
-        converter=ip_address, validator=check_in_network(CLIENT_NETWORK)
-    )
+    client_ip: IPv4Address | IPv6Address = field(converter=ip_address)
+    # recipe is loaded when first needed, as listing or expiring deployments
+    # only needs to know the uuid.
+    _recipe: DeploymentRecipe | None = field(default=None, kw_only=True)
+    # holds a place in the install queue, see Installer.admit
+    _admitted: bool = field(default=False, kw_only=True, eq=False, repr=False)
+    uuid: UUID = field(kw_only=True)
     name: str = field()
+    # namespace and helm release, differs from name for warm pool backends
+    namespace: str = field()
     created: pendulum.DateTime = field(converter=parse_date)
+    # set while the backend is scaled down because the client went idle
+    suspended: pendulum.DateTime | None = field(
+        default=None, converter=converters.optional(parse_date)
+    )
+
+    @client_ip.validator
+    def _check_client_ip(self, _attribute: Any, value: IPv4Address | IPv6Address):
+        """Check if the address is in the client network"""
+        if value not in self.cluster.ipam.network:
+            raise ValueError(f"{value} is not in {self.cluster.ipam.network}")
+
+    @uuid.default
+    def _default_uuid(self) -> UUID:
+        if self._recipe is None:
+            raise TypeError("Deployment needs either a recipe or a uuid")
+        return self._recipe.uuid
 
     @name.default
     def _default_name(self) -> str:
-        return randomname.get_name()
+        return deployment_name(self.uuid, self.client_public_key)
+
+    @namespace.default
+    def _default_namespace(self) -> str:
+        return self.name
 
     @created.default
     def _default_created(self) -> pendulum.DateTime:
         return pendulum.now().start_of("second")
 
+    @property
+    def recipe(self) -> DeploymentRecipe:
+        if self._recipe is None:
+            self._recipe = DeploymentRecipe.from_uuid(self.uuid)
+        return self._recipe
+
     @classmethod
     def from_recipe(
         cls,
         cluster: Cluster,
         recipe: DeploymentRecipe,
         client_public_key: WireguardKey,
+        admitted: bool = False,
     ) -> Deployment:
         client_ip = cluster.get_unique_client_address()
         return cls(
@@ -106,6 +212,7 @@ class Deployment:
             recipe=recipe,
             client_public_key=client_public_key,
             client_ip=client_ip,
+            admitted=admitted,
         )
 
     @classmethod
@@ -128,103 +235,252 @@ class Deployment:
         metadata = k8s_json["metadata"]
 
         uuid = UUID(metadata["labels"]["findcloudlet.org/uuid"])
-        recipe = DeploymentRecipe.from_uuid(uuid)
         client_key = key_from_k8s_label(metadata["labels"]["findcloudlet.org/key"])
 
         return cls(
             cluster=cluster,
             name=metadata["name"],
-            recipe=recipe,
+            namespace=metadata["annotations"].get(
+                "findcloudlet.org/namespace", metadata["name"]
+            ),
+            uuid=uuid,
             client_public_key=client_key,
-            client_ip=metadata["labels"]["findcloudlet.org/client"],
+            client_ip=address_from_k8s_label(
+                metadata["labels"]["findcloudlet.org/client"]
+            ),
             created=metadata["annotations"]["findcloudlet.org/created"],
+            suspended=metadata["annotations"].get(SUSPENDED),
         )
 
-    def deploy(self) -> None:
-        while True:
-            if self.is_deployed():
-                return
-
-            client_key_label = key_to_k8s_label(self.client_public_key)
-            self.created = self._default_created()
-            (
-                self.cluster.kubectl["apply", "-f", "-"]
-                << f"""\
-apiVersion: kilo.squat.ai/v1alpha1
-kind: Peer
-metadata:
-  name: "{self.name}"
-  labels:
-    findcloudlet.org: deployment
-    findcloudlet.org/uuid: "{self.recipe.uuid}"
-    findcloudlet.org/key: "{client_key_label}"
-    findcloudlet.org/client: "{self.client_ip}"
-  annotations:
-    findcloudlet.org/created: "{self.created}"
-spec:
-  allowedIPs:
-    - "{self.client_ip}/32"
-  publicKey: "{self.client_public_key}"
-  persistentKeepalive: 10
-"""
-            )()
-            # check if we are the only deployment?
-            # this is probably not how to do it...
-            deployment = self.cluster.get(self.recipe.uuid, self.client_public_key)
-            if deployment is None or deployment == self:
-                break
-
-            print("Duplicate deployments found, deleting and retrying")
-            self.expire()
-            self = deployment
-
-        self.helm_install()
+    def deploy(self) -> Deployment:
+        """Create the deployment unless it already exists.
+
+        Returns the deployment that was actually created, which may be an
+        existing or concurrently created one for the same application and key.
+        Raises TeardownInProgress while a previous deployment is being removed,
+        and InstallQueueFull when a failed install can't be retried yet.
+        """
+        try:
+            return self._deploy()
+        finally:
+            # give back the place in the install queue when we didn't use it
+            if self._admitted and self.cluster.installer is not None:
+                self.cluster.installer.release()
+            self._admitted = False
+
+    def _deploy(self) -> Deployment:
+        teardown = self.cluster.teardown
+        if teardown is not None:
+            if teardown.cancel(self.name):
+                # expired but not yet removed, restart its lease
+                self.resume()
+                return self
+            if teardown.removing(self.name):
+                # the new backend would reuse the namespace being deleted
+                if not self.is_deployed():
+                    self.cluster.ipam.release(self.client_ip)
+                raise TeardownInProgress(f"{self.name} is being removed")
+
+        if self.is_deployed():
+            if self.suspended is not None:
+                self.resume()
+            status = self.install_status()
+            if status is not None and status.state == FAILED:
+                logging.info(f"Retrying failed install of {self.name}")
+                self.install()
+            return self
+
+        self.created = self._default_created()
+        warm_pool = self.cluster.warm_pool
+        claimed = warm_pool is not None and warm_pool.claim(self)
+        try:
+            peer = self.cluster.api.create(PEERS, self.peer_manifest())
+        except RequestException as e:
+            if claimed:
+                assert warm_pool is not None
+                warm_pool.unclaim(self)
+            if not isinstance(e, KubeApiError) or not e.conflict:
+                self.cluster.ipam.release(self.client_ip)
+                raise
+            existing = self._existing()
+            if existing.client_ip != self.client_ip:
+                self.cluster.ipam.release(self.client_ip)
+            return existing
+
+        self.cluster.informer.update(peer)
+        if claimed:
+            # warm backends are already installed and running
+            if self.cluster.installer is not None:
+                self.cluster.installer.mark_ready(self.name)
+        else:
+            self.install()
+        return self
+
+    def install(self) -> None:
+        """Install the backend, in the background when the cluster has an
+        installer so that the client can bring up the tunnel in parallel."""
+        if self.cluster.installer is not None:
+            self.cluster.installer.submit(self, admitted=self._admitted)
+            self._admitted = False
+        else:
+            self.install_chart()
+
+    def install_status(self) -> InstallStatus | None:
+        if self.cluster.installer is None:
+            return None
+        return self.cluster.installer.status(self.name)
+
+    def _existing(self) -> Deployment:
+        peer = self.cluster.informer.get(self.name)
+        if peer is None:
+            peer = self.cluster.api.get(f"{PEERS}/{self.name}")
+        return Deployment.from_manifest(self.cluster, peer)
+
+    def peer_manifest(self) -> dict[str, Any]:
+        return {
+            "apiVersion": "kilo.squat.ai/v1alpha1",
+            "kind": "Peer",
+            "metadata": {
+                "name": self.name,
+                "labels": {
+                    "findcloudlet.org": "deployment",
+                    "findcloudlet.org/uuid": str(self.uuid),
+                    "findcloudlet.org/key": key_to_k8s_label(self.client_public_key),
+                    "findcloudlet.org/client": address_to_k8s_label(self.client_ip),
+                },
+                "annotations": {
+                    "findcloudlet.org/created": str(self.created),
+                    "findcloudlet.org/namespace": self.namespace,
+                },
+            },
+            "spec": {
+                "allowedIPs": [f"{self.client_ip}/{self.client_ip.max_prefixlen}"],
+                "publicKey": str(self.client_public_key),
+                "persistentKeepalive": 10,
+            },
+        }
 
     def is_deployed(self) -> bool:
         """Kilo peer is removed when a lease expires"""
-        return self.cluster.kubectl["get", "peer", self.name, "-o", "name"] & TF
+        if self.cluster.informer.healthy:
+            return self.cluster.informer.get(self.name) is not None
+        try:
+            return self.cluster.api.exists(f"{PEERS}/{self.name}")
+        except RequestException:
+            return False
 
     def expire(self) -> None:
-        """Remove kilo peer and shut down backend"""
-        self.cluster.kubectl("delete", "peer", self.name, retcode=None)
+        """Remove kilo peer and shut down backend, batched with other expired
+        deployments when the cluster has a teardown pipeline.
+        Raises RequestException when the peer could not be removed."""
+        if self.cluster.teardown is not None:
+            self.cluster.teardown.submit(self)
+            return
+
+        # raises when the peer can't be deleted, so we try again later
+        try:
+            self.cluster.api.delete(f"{PEERS}/{self.name}")
+        except KubeApiError as e:
+            if not e.not_found:
+                raise
+        self.cluster.informer.remove(self.name)
         self.cluster.helm(
-            "uninstall", "--namespace", self.name, self.name, retcode=None
+            "uninstall", "--namespace", self.namespace, self.namespace, retcode=None
         )
-        self.cluster.kubectl("delete", "namespace", self.name, retcode=None)
-
-    def helm_install(self) -> None:
-        with NamedTemporaryFile(delete=False) as f:
-            f.write(yaml.dump(self.recipe.values).encode("utf-8"))
-            f.flush()
-
-            self.cluster.helm(
-                "install",
-                "--namespace",
-                self.name,
-                "--create-namespace",
-                "--values",
-                f.name,
-                "--replace",
-                self.name,
-                self.recipe.chart_ref,
+        try:
+            self.cluster.api.delete(f"{NAMESPACES}/{self.namespace}")
+        except RequestException:
+            logging.exception(f"Failed to delete namespace {self.namespace}")
+        if self.cluster.installer is not None:
+            self.cluster.installer.forget(self.name)
+
+    def _workloads(self) -> Iterator[Workload]:
+        for kind in WORKLOADS:
+            path = f"/apis/apps/v1/namespaces/{self.namespace}/{kind}"
+            for workload in self.cluster.api.list(path)["items"]:
+                yield f"{path}/{workload['metadata']['name']}", workload
+
+    def _annotate_peer(self, annotations: dict[str, str | None]) -> None:
+        peer = self.cluster.api.patch(
+            f"{PEERS}/{self.name}", {"metadata": {"annotations": annotations}}
+        )
+        self.cluster.informer.update(peer)
+
+    def suspend(self) -> None:
+        """Scale the backend down to zero but keep the namespace, release
+        and peer, so a returning client can quickly resume it."""
+        for path, workload in self._workloads():
+            replicas = workload["spec"].get("replicas", 1)
+            if replicas == 0:
+                continue
+            self.cluster.api.patch(
+                path,
+                {
+                    "metadata": {"annotations": {REPLICAS: str(replicas)}},
+                    "spec": {"replicas": 0},
+                },
+            )
+        self.suspended = pendulum.now().start_of("second")
+        self._annotate_peer({SUSPENDED: str(self.suspended)})
+
+    def resume(self) -> None:
+        """Scale a suspended backend back up and restart its lease."""
+        logging.info(f"Resuming {self.name}")
+        for path, workload in self._workloads():
+            annotations = workload["metadata"].get("annotations", {})
+            if REPLICAS not in annotations:
+                continue
+            self.cluster.api.patch(
+                path,
+                {
+                    "metadata": {"annotations": {REPLICAS: None}},
+                    "spec": {"replicas": int(annotations[REPLICAS])},
+                },
             )
+        self.created = self._default_created()
+        self.suspended = None
+        self._annotate_peer(
+            {"findcloudlet.org/created": str(self.created), SUSPENDED: None}
+        )
 
-    def asdict(self) -> dict[str, Any]:
-        status = "Deployed" if self.is_deployed() else "Expired"
+    def install_chart(self, wait: bool = False, timeout: int = 300) -> None:
+        install_chart(self.cluster, self.recipe, self.namespace, wait, timeout)
+
+    def status(self) -> str:
+        """Expired, Suspended, or the progress of the backend install when it
+        is tracked (Pending, Installing, Ready, Failed), and otherwise Deployed.
+        """
+        if not self.is_deployed():
+            return "Expired"
+        if self.suspended is not None:
+            return "Suspended"
+        install_status = self.install_status()
+        if install_status is None:
+            return "Deployed"
+        return install_status.state
+
+    def summary(self) -> dict[str, Any]:
+        """Identity and status of the deployment, without the tunnel config."""
         return {
             "DeploymentName": self.name,
-            "UUID": str(self.recipe.uuid),
+            "UUID": str(self.uuid),
             "ApplicationKey": str(self.client_public_key),
-            "Status": status,
+            "Status": self.status(),
+        }
+
+    def asdict(self) -> dict[str, Any]:
+        metadata = self.cluster.tunnel_metadata()
+        return {
+            **self.summary(),
             "Created": str(self.created),
             "TunnelConfig": {
-                "publicKey": str(self.cluster.tunnel_public_key),
-                "allowedIPs": ["0.0.0.0/0"],
-                "endpoint": str(self.cluster.tunnel_endpoint),
+                "publicKey": str(metadata.tunnel_public_key),
+                "allowedIPs": ["0.0.0.0/0" if self.client_ip.version == 4 else "::/0"],
+                "endpoint": str(metadata.tunnel_endpoint),
                 "address": [str(self.client_ip)],
                 "dns": [
-                    str(self.cluster.kubedns_address),
-                    f"{self.name}.svc.cluster.local",
+                    str(metadata.kubedns_address),
+                    f"{self.namespace}.svc.cluster.local",
                     "svc.cluster.local",
                     "cluster.local",
                 ],
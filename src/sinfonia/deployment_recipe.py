@@ -80,6 +80,7 @@ SINFONIA_RECIPE_SCHEMA = {
     },
     "required": ["chart", "version"],
 }
+RECIPE_VALIDATOR = Draft202012Validator(SINFONIA_RECIPE_SCHEMA)
 
 
 @define
@@ -94,14 +95,22 @@ class DeploymentRecipe:
 
     @classmethod
     def from_uuid(cls, uuid: UUID | str) -> DeploymentRecipe:
-        repository = current_app.config["deployment_repository"]
+        """Get deployment recipe through the application's recipe cache.
+        Raises ValueError when the recipe could not be found or is invalid.
+        """
         if isinstance(uuid, str):
             uuid = UUID(uuid)
+
+        recipe_cache = current_app.config.get("recipe_cache")
+        if recipe_cache is not None:
+            return recipe_cache.get(uuid)
+
+        repository = current_app.config["deployment_repository"]
         try:
             return cls.from_repo(repository, uuid)
-        except RequestException:
+        except (OSError, RequestException):
             raise ValueError(f"Request for unknown recipe {uuid}")
-        except ValidationError:
+        except (ValidationError, yaml.YAMLError):
             raise ValueError(f"Failed to validate recipe {uuid}")
 
     @classmethod
@@ -112,10 +121,25 @@ class DeploymentRecipe:
         May raise jsonschema.exceptions.ValidationError.
         """
         recipe_yaml = repository.get(str(uuid) + ".yaml")
+        return cls.from_yaml(repository, uuid, recipe_yaml)
 
-        recipe = yaml.safe_load(recipe_yaml)
-        validator = Draft202012Validator(SINFONIA_RECIPE_SCHEMA)
-        validator.validate(recipe)
+    @classmethod
+    def from_yaml(
+        cls, repository: DeploymentRepository, uuid: UUID, recipe_yaml: str
+    ) -> DeploymentRecipe:
+        """Parse and validate deployment recipe yaml document.
+        May raise yaml.YAMLError or jsonschema.exceptions.ValidationError.
+        """
+        return cls.from_dict(repository, uuid, yaml.safe_load(recipe_yaml))
+
+    @classmethod
+    def from_dict(
+        cls, repository: DeploymentRepository, uuid: UUID, recipe: Any
+    ) -> DeploymentRecipe:
+        """Validate already parsed deployment recipe.
+        May raise jsonschema.exceptions.ValidationError.
+        """
+        RECIPE_VALIDATOR.validate(recipe)
 
         return cls(
             repository=repository,
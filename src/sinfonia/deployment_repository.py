@@ -9,7 +9,8 @@
 
 Deployment descriptions are stored in a repository defined by `--recipes=URL`
 (`SINFONIA_RECIPES` environment variables). This can be either a local
-directory, or a remote reference through a URL. This complicates things because
+directory, a remote reference through a URL, or a (private) S3 bucket
+referenced as s3://bucket/prefix. This complicates things because
 we do still want to avoid typicaly local path traversal exploits. The inputs
 here are the Admin defined RECIPES, the UUID from the 'untrusted client', and
 the application developer specified chart and version fields in the deployment
@@ -19,13 +20,20 @@ recipe file.
 from __future__ import annotations
 
 import os
+import shutil
+from email.utils import formatdate
 from pathlib import Path
+from typing import IO
 
 import requests
 from attrs import define, field
 from werkzeug.security import safe_join
 from yarl import URL
 
+from .s3_client import S3Endpoint
+
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
 
 def _root_to_url(repository_root: str | os.PathLike | URL) -> URL:
     """Canonicalize the repository root."""
@@ -37,13 +45,57 @@ def _root_to_url(repository_root: str | os.PathLike | URL) -> URL:
         fullpath = Path(repository_root).resolve()
         root_url = URL.build(scheme="file", path=str(fullpath))
 
+    # S3 repositories are prefixes of keys in a bucket, make sure the prefix
+    # ends with '/' so relative references stay within the prefix.
+    if root_url.scheme == "s3":
+        if root_url.path.endswith("/"):
+            return root_url
+        return root_url.with_path(root_url.path + "/")
+
     # adding an empty path forces the url to end with '/'
     return root_url / ""
 
 
+@define(frozen=True)
+class CacheValidators:
+    """Validators used to check if a previously retrieved document changed.
+
+    For remote repositories these are the ETag and Last-Modified response
+    headers, for local repositories we derive them from the file status.
+    """
+
+    etag: str | None = None
+    last_modified: str | None = None
+
+
+def _file_validators(path: Path) -> CacheValidators:
+    stat = path.stat()
+    return CacheValidators(
+        etag=f"{stat.st_ino:x}-{stat.st_mtime_ns:x}-{stat.st_size:x}",
+        last_modified=formatdate(stat.st_mtime, usegmt=True),
+    )
+
+
+def _conditional_headers(validators: CacheValidators | None) -> dict[str, str]:
+    headers = {}
+    if validators is not None:
+        if validators.etag is not None:
+            headers["If-None-Match"] = validators.etag
+        if validators.last_modified is not None:
+            headers["If-Modified-Since"] = validators.last_modified
+    return headers
+
+
 @define
 class DeploymentRepository:
     base_url: URL = field(converter=_root_to_url)
+    # reuse connections to remote repositories
+    session: requests.Session = field(factory=requests.Session, eq=False, repr=False)
+    s3: S3Endpoint | None = field(eq=False, repr=False)
+
+    @s3.default
+    def _s3_default(self) -> S3Endpoint | None:
+        return S3Endpoint.from_env() if self.base_url.scheme == "s3" else None
 
     def join(self, other: str | os.PathLike | URL) -> URL:
         """Try to safely join the current repository with 'other'.
@@ -63,8 +115,26 @@ class DeploymentRepository:
         # when repository root is not a local directory, the reference we
         # are trying to join should definitely not be one.
         assert not (self.base_url.scheme != "file" and other_url.scheme == "file")
+
+        if self.base_url.scheme == "s3" and other_url.scheme == "":
+            # urljoin doesn't know how to handle relative s3 references
+            bucket_url = self.base_url.with_scheme("https")
+            return bucket_url.join(other_url).with_scheme("s3")
         return self.base_url.join(other_url)
 
+    def _get(
+        self, ref_url: URL, headers: dict[str, str], stream: bool = False
+    ) -> requests.Response:
+        if ref_url.scheme == "s3":
+            assert self.s3 is not None
+            return self.session.get(
+                str(self.s3.object_url(ref_url)),
+                headers=headers,
+                auth=self.s3.auth,
+                stream=stream,
+            )
+        return self.session.get(str(ref_url), headers=headers, stream=stream)
+
     def get(self, ref: str | URL) -> str:
         """Retrieves the contents of 'ref'.
 
@@ -82,6 +152,100 @@ class DeploymentRepository:
         if ref_url.scheme == "file":
             return Path(ref_url.path).read_text()
 
-        r = requests.get(str(ref_url))
+        r = self._get(ref_url, {})
         r.raise_for_status()
         return r.text
+
+    def download(
+        self,
+        ref: str | URL,
+        fileobj: IO[bytes],
+        validators: CacheValidators | None = None,
+    ) -> CacheValidators | None:
+        """Write the (binary) contents of 'ref' to fileobj.
+
+        Returns validators that can be passed to a later call, or None when
+        the document did not change since the validators were obtained, in
+        which case nothing was written.
+
+        raises the same exceptions as 'get'.
+        """
+        ref_url = self.join(ref)
+
+        if ref_url.scheme == "file":
+            path = Path(ref_url.path)
+            current = _file_validators(path)
+            if validators is not None and validators.etag == current.etag:
+                return None
+            with path.open("rb") as f:
+                shutil.copyfileobj(f, fileobj)
+            return current
+
+        with self._get(ref_url, _conditional_headers(validators), stream=True) as r:
+            if r.status_code == requests.codes.not_modified and validators is not None:
+                return None
+            r.raise_for_status()
+            for chunk in r.iter_content(DOWNLOAD_CHUNK_SIZE):
+                fileobj.write(chunk)
+            return CacheValidators(
+                etag=r.headers.get("ETag"),
+                last_modified=r.headers.get("Last-Modified"),
+            )
+
+    def fetch(
+        self, ref: str | URL, validators: CacheValidators | None = None
+    ) -> tuple[str | None, CacheValidators]:
+        """Conditionally retrieves the contents of 'ref'.
+
+        Returns the document contents and validators that can be passed to a
+        later call. When the document did not change since the validators were
+        obtained, the returned contents are None.
+
+        raises the same exceptions as 'get', and FileNotFoundError when a
+        local document does not exist.
+        """
+        ref_url = self.join(ref)
+
+        if ref_url.scheme == "file":
+            path = Path(ref_url.path)
+            current = _file_validators(path)
+            if validators is not None and validators.etag == current.etag:
+                return None, validators
+            return path.read_text(), current
+
+        r = self._get(ref_url, _conditional_headers(validators))
+        if r.status_code == requests.codes.not_modified and validators is not None:
+            return None, validators
+        r.raise_for_status()
+
+        return r.text, CacheValidators(
+            etag=r.headers.get("ETag"),
+            last_modified=r.headers.get("Last-Modified"),
+        )
+
+    def list(self, suffix: str = "") -> list[str]:
+        """List documents in the repository, relative to the repository root.
+
+        Only local and S3 repositories support listing, raises
+        NotImplementedError for plain HTTP repositories.
+        """
+        if self.base_url.scheme == "file":
+            root = Path(self.base_url.path)
+            return sorted(
+                path.relative_to(root).as_posix()
+                for path in root.rglob(f"*{suffix}")
+                if path.is_file()
+            )
+
+        if self.base_url.scheme == "s3" and self.s3 is not None:
+            assert self.base_url.host is not None
+            prefix = self.base_url.path.lstrip("/")
+            return sorted(
+                key[len(prefix) :]
+                for key, _etag in self.s3.list_objects(
+                    self.session, self.base_url.host, prefix
+                )
+                if key.endswith(suffix)
+            )
+
+        raise NotImplementedError(f"Unable to list {self.base_url}")
@@ -0,0 +1,214 @@
+#
+# Sinfonia
+#
+# Copyright (c) 2022 Carnegie Mellon University
+#
+# SPDX-License-Identifier: MIT
+#
+"""Install deployment backends in the background.
+
+Once the Peer exists the client can already bring up its wireguard tunnel,
+so instead of blocking the deploy request for the whole helm install we hand
+the install off to a bounded pool of workers and report its progress in the
+deployment status.
+
+    Pending -> Installing -> Ready
+                          -> Failed
+
+The number of installs waiting for a worker is bounded, when the queue is
+full new deployments are rejected before anything is created so that Tier1
+can fail over to another cloudlet. Admission reserves a place in the queue
+which is either used by the install or given back, so concurrent deploys
+can't overfill the queue between admission and submitting the install.
+"""
+
+from __future__ import annotations
+
+import logging
+import math
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import TYPE_CHECKING, Callable
+
+from attrs import define, field
+from connexion.exceptions import ProblemException
+
+from .metrics import REGISTRY
+
+if TYPE_CHECKING:
+    from .deployment import Deployment
+
+logger = logging.getLogger(__name__)
+
+PENDING = "Pending"
+INSTALLING = "Installing"
+READY = "Ready"
+FAILED = "Failed"
+
+INSTALLS = REGISTRY.counter(
+    "sinfonia_installs", "Backend installs by outcome", ["result"]
+)
+INSTALL_DURATION = REGISTRY.histogram(
+    "sinfonia_install_duration_seconds", "Time taken to install a backend"
+)
+QUEUE_WAIT = REGISTRY.histogram(
+    "sinfonia_install_queue_wait_seconds", "Time installs waited for a worker"
+)
+REJECTED = REGISTRY.counter(
+    "sinfonia_install_rejected", "Deployments rejected because the queue was full"
+)
+QUEUE_DEPTH = REGISTRY.gauge(
+    "sinfonia_install_queue_depth", "Installs waiting for a worker"
+)
+
+# weight of the latest sample in the moving averages of wait and install time
+EWMA_ALPHA = 0.2
+
+
+class InstallQueueFull(Exception):
+    def __init__(self, retry_after: int):
+        super().__init__(f"Install queue full, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+def install_queue_full(e: InstallQueueFull) -> ProblemException:
+    """Response telling the client to come back when the queue drained."""
+    logger.warning(str(e))
+    return ProblemException(
+        503,
+        "Service Unavailable",
+        "Too many deployments in progress",
+        headers={"Retry-After": str(e.retry_after)},
+    )
+
+
+@define(frozen=True)
+class InstallStatus:
+    state: str
+    error: str | None = None
+    updated: float = field(factory=time.monotonic)
+
+    @property
+    def done(self) -> bool:
+        return self.state in (READY, FAILED)
+
+
+# called with the deployment name and new status on every state change
+InstallListener = Callable[[str, InstallStatus], None]
+
+
+@define
+class Installer:
+    max_workers: int = 4
+    max_queue: int = 16  # installs waiting for a worker before rejecting
+    clock: Callable[[], float] = time.monotonic
+    listeners: list[InstallListener] = field(factory=list)
+
+    _executor: ThreadPoolExecutor = field(init=False)
+    _status: dict[str, InstallStatus] = field(init=False, factory=dict)
+    _lock: threading.Lock = field(init=False, factory=threading.Lock)
+    _queued: int = field(init=False, default=0)
+    # admitted installs that were not submitted yet
+    _reserved: int = field(init=False, default=0)
+    _active: int = field(init=False, default=0)
+    _avg_wait: float = field(init=False, default=0.0)
+    _avg_duration: float = field(init=False, default=60.0)
+
+    def __attrs_post_init__(self) -> None:
+        QUEUE_DEPTH.set_function(lambda: self._queued)
+
+    @_executor.default
+    def _default_executor(self) -> ThreadPoolExecutor:
+        return ThreadPoolExecutor(
+            max_workers=self.max_workers, thread_name_prefix="installer"
+        )
+
+    def status(self, name: str) -> InstallStatus | None:
+        return self._status.get(name)
+
+    def _set(self, name: str, state: str, error: str | None = None) -> None:
+        status = InstallStatus(state, error, self.clock())
+        with self._lock:
+            self._status[name] = status
+        for listener in self.listeners:
+            listener(name, status)
+
+    def admit(self) -> None:
+        """Reserve room to queue another install, which is used by
+        submit(admitted=True) or given back with release().
+        Raises InstallQueueFull with an estimate of when to retry.
+        """
+        with self._lock:
+            queued = self._queued + self._reserved
+            if queued < self.max_queue:
+                self._reserved += 1
+                return
+
+        REJECTED.inc()
+        # time until enough of the queue drained to make room for one more
+        drain = (queued - self.max_queue + 1) / self.max_workers
+        raise InstallQueueFull(max(1, math.ceil(drain * self._avg_duration)))
+
+    def resources(self) -> dict[str, float]:
+        """Queue state, reported to Tier1 along with the cluster resources."""
+        return {
+            "install_queue_depth": self._queued,
+            "install_queue_ratio": self._queued / self.max_queue,
+            "install_queue_wait": self._avg_wait,
+            "install_active": self._active,
+        }
+
+    def release(self) -> None:
+        """Give back room reserved by admit() that won't be used."""
+        with self._lock:
+            self._reserved -= 1
+
+    def submit(self, deployment: Deployment, admitted: bool = False) -> Future[None]:
+        """Queue the helm install for a deployment, using the room reserved by
+        an earlier admit() when admitted.
+        Raises InstallQueueFull when not admitted and the queue is full.
+        """
+        if not admitted:
+            self.admit()
+        with self._lock:
+            self._reserved -= 1
+            self._queued += 1
+        self._set(deployment.name, PENDING)
+        return self._executor.submit(self._install, deployment, self.clock())
+
+    def _install(self, deployment: Deployment, queued: float) -> None:
+        start = self.clock()
+        with self._lock:
+            self._queued -= 1
+            self._active += 1
+            self._avg_wait += EWMA_ALPHA * (start - queued - self._avg_wait)
+        QUEUE_WAIT.observe(start - queued)
+
+        self._set(deployment.name, INSTALLING)
+        try:
+            deployment.install_chart(wait=True)
+        except Exception as e:
+            logger.exception(f"Failed to install {deployment.name}")
+            self._set(deployment.name, FAILED, str(e))
+            INSTALLS.inc(result="failed")
+        else:
+            self._set(deployment.name, READY)
+            INSTALLS.inc(result="ready")
+        finally:
+            duration = self.clock() - start
+            INSTALL_DURATION.observe(duration)
+            with self._lock:
+                self._active -= 1
+                self._avg_duration += EWMA_ALPHA * (duration - self._avg_duration)
+
+    def mark_ready(self, name: str) -> None:
+        """Track a deployment that was ready without having to install it."""
+        self._set(name, READY)
+
+    def forget(self, name: str) -> None:
+        with self._lock:
+            self._status.pop(name, None)
+
+    def shutdown(self, wait: bool = True) -> None:
+        self._executor.shutdown(wait=wait)
@@ -0,0 +1,251 @@
+#
+# Sinfonia
+#
+# Copyright (c) 2022 Carnegie Mellon University
+#
+# SPDX-License-Identifier: MIT
+#
+"""Allocate client tunnel addresses from the Tier2 client network.
+
+Allocated addresses are tracked in a bitmap with one bit per address, a /16
+takes 8KB. Finding a free address searches for the first byte that is not
+0xff starting from a next-fit cursor, which is done in C by the regular
+expression engine, so allocation does not depend on the number of clients
+and does not need to query the cluster.
+
+Recently released addresses are only reused after the cursor wrapped around,
+which avoids immediately handing out an address a previous client may still
+be using.
+
+When the pool is rebuilt from a list of existing Peers, addresses that were
+allocated or reserved recently are kept. Deploys that are in progress may not
+have created their Peer yet, or created it after the list was retrieved.
+Only addresses that were not touched for a while and are not used by any
+listed Peer are known to be free.
+"""
+
+from __future__ import annotations
+
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+from ipaddress import (
+    IPv4Address,
+    IPv4Network,
+    IPv6Address,
+    IPv6Network,
+    ip_address,
+    ip_network,
+)
+from typing import Any, Callable, Iterable, Union
+
+from attrs import define, field
+
+logger = logging.getLogger(__name__)
+
+ClientAddress = Union[IPv4Address, IPv6Address]
+ClientNetwork = Union[IPv4Network, IPv6Network]
+
+# largest number of addresses we track, large IPv6 networks are truncated
+MAX_POOL_SIZE = 1 << 24
+
+_FREE_BYTE = re.compile(rb"[^\xff]")
+
+
+class AddressPoolExhausted(Exception):
+    pass
+
+
+def _to_network(value: str | ClientNetwork) -> ClientNetwork:
+    return ip_network(value)
+
+
+@define
+class ClientAddressPool:
+    network: ClientNetwork = field(converter=_to_network)
+    # seconds recently allocated or reserved addresses survive a rebuild
+    pending_timeout: float = 600.0
+    clock: Callable[[], float] = time.monotonic
+
+    _size: int = field(init=False)
+    _reserved: frozenset[int] = field(init=False)
+    _bitmap: bytearray = field(init=False)
+    _cursor: int = field(init=False, default=0)
+    _used: int = field(init=False, default=0)
+    # recently allocated or reserved offsets, oldest first
+    _recent: OrderedDict[int, float] = field(init=False, factory=OrderedDict)
+    _lock: threading.Lock = field(init=False, factory=threading.Lock)
+
+    def __attrs_post_init__(self) -> None:
+        self._size = min(self.network.num_addresses, MAX_POOL_SIZE)
+        if self._size < self.network.num_addresses:
+            logger.warning(
+                f"Only using the first {self._size} addresses of {self.network}"
+            )
+
+        # network and broadcast addresses are not available, mirroring hosts()
+        reserved = set()
+        if self.network.num_addresses > 2:
+            reserved.add(0)
+            if self.network.version == 4:
+                reserved.add(self._size - 1)
+        self._reserved = frozenset(reserved)
+        self._reset()
+
+    def _reset(self) -> None:
+        self._bitmap = bytearray((self._size + 7) // 8)
+
+        # as are the bits past the end of the pool
+        for offset in self._reserved.union(range(self._size, len(self._bitmap) * 8)):
+            self._bitmap[offset >> 3] |= 1 << (offset & 7)
+        self._used = 0
+
+    def _offset(self, address: ClientAddress) -> int | None:
+        if address not in self.network:
+            return None
+        offset = int(address) - int(self.network.network_address)
+        if offset >= self._size or offset in self._reserved:
+            return None
+        return offset
+
+    def _set(self, offset: int) -> bool:
+        mask = 1 << (offset & 7)
+        if self._bitmap[offset >> 3] & mask:
+            return False
+        self._bitmap[offset >> 3] |= mask
+        self._used += 1
+        return True
+
+    def _touch(self, offset: int) -> None:
+        now = self.clock()
+        self._recent.pop(offset, None)
+        self._recent[offset] = now
+        self._expire_recent(now)
+
+    def _expire_recent(self, now: float) -> None:
+        while self._recent:
+            offset, touched = next(iter(self._recent.items()))
+            if now - touched < self.pending_timeout:
+                break
+            del self._recent[offset]
+
+    def _clear(self, offset: int) -> bool:
+        mask = 1 << (offset & 7)
+        if not self._bitmap[offset >> 3] & mask:
+            return False
+        self._bitmap[offset >> 3] &= ~mask
+        self._used -= 1
+        return True
+
+    @property
+    def used(self) -> int:
+        return self._used
+
+    @property
+    def available(self) -> int:
+        return self._size - len(self._reserved) - self._used
+
+    def __contains__(self, address: object) -> bool:
+        """Is the address currently allocated."""
+        if not isinstance(address, (IPv4Address, IPv6Address)):
+            return False
+        offset = self._offset(address)
+        if offset is None:
+            return False
+        return bool(self._bitmap[offset >> 3] & (1 << (offset & 7)))
+
+    def allocate(self) -> ClientAddress:
+        """Allocate an unused address, raises AddressPoolExhausted."""
+        with self._lock:
+            # the byte the cursor points into, with the bits before it masked
+            index = self._cursor >> 3
+            byte = self._bitmap[index] | ((1 << (self._cursor & 7)) - 1)
+            if byte == 0xFF:
+                match = _FREE_BYTE.search(self._bitmap, index + 1)
+                if match is None:
+                    match = _FREE_BYTE.search(self._bitmap, 0, index + 1)
+                if match is None:
+                    raise AddressPoolExhausted(f"No free addresses in {self.network}")
+                index = match.start()
+                byte = self._bitmap[index]
+
+            bit = (~byte & (byte + 1)).bit_length() - 1  # lowest clear bit
+            offset = (index << 3) | bit
+            self._set(offset)
+            self._touch(offset)
+            self._cursor = (offset + 1) % (len(self._bitmap) * 8)
+            return self.network.network_address + offset
+
+    def reserve(self, address: ClientAddress) -> bool:
+        """Mark an address as used, returns False if it already was."""
+        offset = self._offset(address)
+        if offset is None:
+            return False
+        with self._lock:
+            self._touch(offset)
+            return self._set(offset)
+
+    def release(self, address: ClientAddress) -> bool:
+        """Return an address to the pool, returns False if it wasn't in use."""
+        offset = self._offset(address)
+        if offset is None:
+            return False
+        with self._lock:
+            self._recent.pop(offset, None)
+            return self._clear(offset)
+
+    def reset(self, addresses: Iterable[ClientAddress]) -> None:
+        """Rebuild the pool from the addresses of existing Peers, keeping
+        recently allocated or reserved addresses that may not be listed."""
+        offsets = [self._offset(address) for address in addresses]
+        with self._lock:
+            self._expire_recent(self.clock())
+            self._reset()
+            for offset in offsets:
+                if offset is not None:
+                    self._set(offset)
+            for offset in self._recent:
+                self._set(offset)
+
+    def peer_changed(
+        self, old: dict[str, Any] | None, new: dict[str, Any] | None
+    ) -> None:
+        """Keep the pool in sync with Peer objects, called by the informer."""
+        if (
+            old is not None
+            and new is not None
+            and peer_address(old) == peer_address(new)
+        ):
+            return
+        if old is not None:
+            address = peer_address(old)
+            if address is not None:
+                self.release(address)
+        if new is not None:
+            address = peer_address(new)
+            if address is not None:
+                self.reserve(address)
+
+
+def address_to_k8s_label(address: ClientAddress) -> str:
+    """Kubernetes label values can not contain ':', use the exploded form of
+    IPv6 addresses with '-' separators so they begin and end with a hex digit.
+    """
+    if address.version == 6:
+        return address.exploded.replace(":", "-")
+    return str(address)
+
+
+def address_from_k8s_label(value: str) -> ClientAddress:
+    return ip_address(value.replace("-", ":"))
+
+
+def peer_address(peer: dict[str, Any]) -> ClientAddress | None:
+    """Client address of a Peer object, from the findcloudlet.org/client label."""
+    label = peer["metadata"].get("labels", {}).get("findcloudlet.org/client")
+    try:
+        return address_from_k8s_label(label) if label else None
+    except ValueError:
+        return None
@@ -45,6 +45,27 @@ def start_expire_cloudlets_job():
     )
 
 
+def refresh_recipe_index():
+    recipe_cache = scheduler.app.config["recipe_cache"]
+    recipe_cache.load_index()
+
+
+def start_recipe_index_job():
+    interval = scheduler.app.config["RECIPES_INDEX_REFRESH"]
+    if not interval or scheduler.app.config["recipe_watcher"] is not None:
+        return
+
+    scheduler.add_job(
+        func=refresh_recipe_index,
+        trigger="interval",
+        seconds=interval,
+        max_instances=1,
+        coalesce=True,
+        id="refresh_recipe_index",
+        replace_existing=True,
+    )
+
+
 def expire_deployments():
     cluster = scheduler.app.config["K8S_CLUSTER"]
     with scheduler.app.app_context():
@@ -55,7 +76,7 @@ def start_expire_deployments_job():
     scheduler.add_job(
         func=expire_deployments,
         trigger="interval",
-        seconds=60,
+        seconds=10,
         max_instances=1,
         coalesce=True,
         id="expire_deployments",
@@ -63,6 +84,48 @@ def start_expire_deployments_job():
     )
 
 
+def teardown_deployments():
+    cluster = scheduler.app.config["K8S_CLUSTER"]
+    cluster.teardown.run()
+
+
+def start_teardown_job():
+    if scheduler.app.config["K8S_CLUSTER"].teardown is None:
+        return
+
+    scheduler.add_job(
+        func=teardown_deployments,
+        trigger="interval",
+        seconds=5,
+        max_instances=1,
+        coalesce=True,
+        id="teardown_deployments",
+        replace_existing=True,
+    )
+
+
+def collect_orphans():
+    cluster = scheduler.app.config["K8S_CLUSTER"]
+    with scheduler.app.app_context():
+        cluster.orphans.collect()
+
+
+def start_orphan_gc_job():
+    interval = scheduler.app.config["ORPHAN_GC_INTERVAL"]
+    if not interval or scheduler.app.config["K8S_CLUSTER"].orphans is None:
+        return
+
+    scheduler.add_job(
+        func=collect_orphans,
+        trigger="interval",
+        seconds=interval,
+        max_instances=1,
+        coalesce=True,
+        id="collect_orphans",
+        replace_existing=True,
+    )
+
+
 def report_to_tier1_endpoints():
     config = scheduler.app.config
 
@@ -104,3 +167,48 @@ def start_reporting_job():
         id="report_to_tier1",
         replace_existing=True,
     )
+
+
+def refill_warm_pool():
+    cluster = scheduler.app.config["K8S_CLUSTER"]
+    with scheduler.app.app_context():
+        cluster.warm_pool.refill()
+
+
+def start_warm_pool_job():
+    cluster = scheduler.app.config["K8S_CLUSTER"]
+    if cluster.warm_pool is None:
+        return
+
+    scheduler.add_job(
+        func=refill_warm_pool,
+        trigger="interval",
+        seconds=30,
+        max_instances=1,
+        coalesce=True,
+        id="refill_warm_pool",
+        replace_existing=True,
+    )
+
+
+def prefetch_charts():
+    cluster = scheduler.app.config["K8S_CLUSTER"]
+    recipe_cache = scheduler.app.config["recipe_cache"]
+    cluster.charts.prefetch(recipe_cache.recipes())
+
+
+def start_chart_prefetch_job():
+    interval = scheduler.app.config["CHART_PREFETCH"]
+    if not interval or scheduler.app.config["K8S_CLUSTER"].charts is None:
+        return
+
+    scheduler.add_job(
+        func=prefetch_charts,
+        trigger="interval",
+        seconds=interval,
+        next_run_time=pendulum.now(),
+        max_instances=1,
+        coalesce=True,
+        id="prefetch_charts",
+        replace_existing=True,
+    )
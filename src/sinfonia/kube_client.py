@@ -0,0 +1,421 @@
+#
+# Sinfonia
+#
+# Copyright (c) 2022 Carnegie Mellon University
+#
+# SPDX-License-Identifier: MIT
+#
+"""Minimal in-process client for the Kubernetes API server.
+
+Running kubectl for every operation costs a fork/exec and a kubeconfig parse
+each time. Instead we parse the kubeconfig (or the in-cluster service account)
+once and talk to the API server over a pooled, authenticated requests session.
+
+Only the subset of the kubeconfig format we need is supported, server and
+certificate authority, bearer tokens (inline or from a file), client
+certificates and basic authentication. Exec and auth-provider plugins are not.
+Like kubectl, the files listed in KUBECONFIG are merged, the first file to
+define a setting or a named cluster, context or user wins.
+"""
+
+from __future__ import annotations
+
+import atexit
+import json
+import os
+import shutil
+import tempfile
+from base64 import b64decode
+from pathlib import Path
+from typing import Any, Iterable, Iterator
+
+import requests
+import yaml
+from attrs import define, field
+from yarl import URL
+
+# kubeconfig entries with file references relative to the kubeconfig file
+PATH_FIELDS = {
+    "clusters": ("cluster", ["certificate-authority"]),
+    "users": ("user", ["client-certificate", "client-key", "tokenFile"]),
+}
+NAMED_LISTS = ("clusters", "contexts", "users")
+
+SERVICEACCOUNT = Path("/var/run/secrets/kubernetes.io/serviceaccount")
+
+# (connect, read) timeouts for API requests
+DEFAULT_TIMEOUT = (5, 30)
+
+# field manager used for server-side apply
+FIELD_MANAGER = "sinfonia"
+
+
+class KubeConfigError(ValueError):
+    pass
+
+
+class KubeApiError(requests.HTTPError):
+    """Unsuccessful response from the API server."""
+
+    def __init__(self, response: requests.Response):
+        try:
+            status = response.json()
+        except ValueError:
+            status = {}
+        self.status_code = response.status_code
+        self.reason = status.get("reason", response.reason)
+        message = status.get("message", response.text)
+        super().__init__(
+            f"{response.status_code} {self.reason}: {message}", response=response
+        )
+
+    @property
+    def not_found(self) -> bool:
+        return self.status_code == 404
+
+    @property
+    def conflict(self) -> bool:
+        return self.status_code == 409
+
+
+class TokenFileAuth(requests.auth.AuthBase):
+    """Bearer token read from a file, reloaded when the file changes.
+    (projected service account tokens are rotated by the kubelet)
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._mtime = 0
+        self._token = ""
+
+    def __call__(self, r: requests.PreparedRequest) -> requests.PreparedRequest:
+        mtime = self.path.stat().st_mtime_ns
+        if mtime != self._mtime:
+            self._token = self.path.read_text().strip()
+            self._mtime = mtime
+        r.headers["Authorization"] = f"Bearer {self._token}"
+        return r
+
+
+def _by_name(items: Any, name: Any, kind: str) -> dict[str, Any]:
+    for item in items or []:
+        if item.get("name") == name:
+            return item.get(kind, {})
+    raise KubeConfigError(f"{kind} '{name}' not found in kubeconfig")
+
+
+def _load_kubeconfig(kubeconfig: Path) -> dict[str, Any]:
+    """Parse a kubeconfig file, resolving relative file references."""
+    config = yaml.safe_load(kubeconfig.read_text())
+    if not isinstance(config, dict):
+        raise KubeConfigError(f"Failed to parse {kubeconfig}")
+
+    for section, (kind, fields) in PATH_FIELDS.items():
+        for item in config.get(section) or []:
+            entry = item.get(kind) or {}
+            for name in fields:
+                if name in entry:
+                    path = Path(entry[name]).expanduser()
+                    entry[name] = str(kubeconfig.parent / path)
+    return config
+
+
+def _merge_kubeconfigs(configs: Iterable[dict[str, Any]]) -> dict[str, Any]:
+    """Merge kubeconfigs the way kubectl does, first definition wins."""
+    merged: dict[str, Any] = {name: [] for name in NAMED_LISTS}
+    for config in configs:
+        for key, value in config.items():
+            if key not in NAMED_LISTS:
+                if value not in (None, ""):
+                    merged.setdefault(key, value)
+                continue
+            known = {item.get("name") for item in merged[key]}
+            merged[key].extend(
+                item for item in value or [] if item.get("name") not in known
+            )
+    return merged
+
+
+@define
+class KubeClient:
+    server: URL
+    session: requests.Session = field(factory=requests.Session, repr=False)
+    namespace: str = "default"
+
+    # discovered resources by apiVersion and kind
+    _resources: dict[str, dict[str, dict[str, Any]]] = field(
+        init=False, factory=dict, repr=False
+    )
+
+    @classmethod
+    def connect(
+        cls, kubeconfig: str | os.PathLike = "", context: str = ""
+    ) -> KubeClient:
+        """Connect using the same rules kubectl uses to find its configuration."""
+        if kubeconfig:
+            return cls.from_kubeconfig(Path(kubeconfig), context)
+
+        env_kubeconfigs = [
+            Path(path) for path in os.environ.get("KUBECONFIG", "").split(os.pathsep)
+        ]
+        env_kubeconfigs = [path for path in env_kubeconfigs if path.name]
+        if env_kubeconfigs:
+            return cls.from_kubeconfig(env_kubeconfigs, context)
+
+        default_kubeconfig = Path.home() / ".kube" / "config"
+        if default_kubeconfig.exists():
+            return cls.from_kubeconfig(default_kubeconfig, context)
+
+        if "KUBERNETES_SERVICE_HOST" in os.environ:
+            return cls.in_cluster()
+
+        # same fallback as kubectl, which will most likely fail to connect
+        return cls(URL("http://localhost:8080"))
+
+    @classmethod
+    def in_cluster(cls, serviceaccount: Path = SERVICEACCOUNT) -> KubeClient:
+        host = os.environ["KUBERNETES_SERVICE_HOST"]
+        port = int(os.environ.get("KUBERNETES_SERVICE_PORT", "443"))
+
+        session = requests.Session()
+        session.verify = str(serviceaccount / "ca.crt")
+        session.auth = TokenFileAuth(serviceaccount / "token")
+
+        namespace_file = serviceaccount / "namespace"
+        namespace = (
+            namespace_file.read_text().strip() if namespace_file.exists() else "default"
+        )
+        return cls(
+            URL.build(scheme="https", host=host, port=port),
+            session=session,
+            namespace=namespace,
+        )
+
+    @classmethod
+    def from_kubeconfig(
+        cls, kubeconfig: Path | list[Path], context: str = ""
+    ) -> KubeClient:
+        """Connect using a kubeconfig, or the merged list of kubeconfigs where
+        files that don't exist are skipped (as listed in KUBECONFIG)."""
+        if isinstance(kubeconfig, Path):
+            config = _load_kubeconfig(kubeconfig)
+            source = str(kubeconfig)
+        else:
+            existing = [path for path in kubeconfig if path.exists()]
+            source = os.pathsep.join(map(str, kubeconfig))
+            if not existing:
+                raise KubeConfigError(f"No kubeconfig found in {source}")
+            config = _merge_kubeconfigs(_load_kubeconfig(path) for path in existing)
+
+        context = context or config.get("current-context", "")
+        if not context:
+            raise KubeConfigError(f"No context selected in {source}")
+
+        ctx = _by_name(config.get("contexts"), context, "context")
+        cluster = _by_name(config.get("clusters"), ctx.get("cluster"), "cluster")
+        user = (
+            _by_name(config.get("users"), ctx["user"], "user")
+            if ctx.get("user")
+            else {}
+        )
+
+        if "exec" in user or "auth-provider" in user:
+            raise KubeConfigError("Credential plugins are not supported")
+
+        session = requests.Session()
+        tmpdir: Path | None = None
+
+        def data_file(name: str, data: str) -> str:
+            nonlocal tmpdir
+            if tmpdir is None:
+                tmpdir = Path(tempfile.mkdtemp(prefix="sinfonia-kube-"))
+                atexit.register(shutil.rmtree, tmpdir, ignore_errors=True)
+            path = tmpdir / name
+            path.write_bytes(b64decode(data))
+            path.chmod(0o600)
+            return str(path)
+
+        if cluster.get("insecure-skip-tls-verify"):
+            session.verify = False
+        elif "certificate-authority-data" in cluster:
+            session.verify = data_file("ca.crt", cluster["certificate-authority-data"])
+        elif "certificate-authority" in cluster:
+            session.verify = cluster["certificate-authority"]
+
+        if "client-certificate-data" in user:
+            session.cert = (
+                data_file("client.crt", user["client-certificate-data"]),
+                data_file("client.key", user["client-key-data"]),
+            )
+        elif "client-certificate" in user:
+            session.cert = (user["client-certificate"], user["client-key"])
+
+        if "token" in user:
+            session.headers["Authorization"] = f"Bearer {user['token']}"
+        elif "tokenFile" in user:
+            session.auth = TokenFileAuth(Path(user["tokenFile"]))
+        elif "username" in user:
+            session.auth = (user["username"], user.get("password", ""))
+
+        return cls(
+            URL(cluster["server"]),
+            session=session,
+            namespace=ctx.get("namespace", "default"),
+        )
+
+    def request(
+        self,
+        method: str,
+        path: str,
+        params: dict[str, Any] | None = None,
+        body: Any = None,
+        content_type: str = "application/json",
+        **kwargs: Any,
+    ) -> requests.Response:
+        """Send request to the API server, raises KubeApiError on failure."""
+        headers = {"Accept": "application/json"}
+        data = None
+        if body is not None:
+            headers["Content-Type"] = content_type
+            data = json.dumps(body)
+
+        # keep any path prefix of the server, i.e. when behind a proxy
+        url = self.server.with_path(self.server.path.rstrip("/") + path)
+
+        kwargs.setdefault("timeout", DEFAULT_TIMEOUT)
+        r = self.session.request(
+            method,
+            str(url),
+            params=params,
+            data=data,
+            headers=headers,
+            **kwargs,
+        )
+        if not r.ok:
+            raise KubeApiError(r)
+        return r
+
+    def get(self, path: str, **params: Any) -> dict[str, Any]:
+        return self.request("GET", path, params=params).json()
+
+    def list(
+        self,
+        path: str,
+        label_selector: str = "",
+        field_selector: str = "",
+        **params: Any,
+    ) -> dict[str, Any]:
+        if label_selector:
+            params["labelSelector"] = label_selector
+        if field_selector:
+            params["fieldSelector"] = field_selector
+        return self.request("GET", path, params=params).json()
+
+    def create(self, path: str, body: dict[str, Any]) -> dict[str, Any]:
+        return self.request("POST", path, body=body).json()
+
+    def patch(
+        self,
+        path: str,
+        body: Any,
+        content_type: str = "application/merge-patch+json",
+        **params: Any,
+    ) -> dict[str, Any]:
+        return self.request(
+            "PATCH", path, params=params, body=body, content_type=content_type
+        ).json()
+
+    def apply(self, path: str, body: dict[str, Any]) -> dict[str, Any]:
+        """Server-side apply, the in-process equivalent of 'kubectl apply'."""
+        return self.patch(
+            path,
+            body,
+            content_type="application/apply-patch+yaml",
+            fieldManager=FIELD_MANAGER,
+            force="true",
+        )
+
+    def delete(
+        self, path: str, missing_ok: bool = True, **params: Any
+    ) -> dict[str, Any] | None:
+        try:
+            return self.request("DELETE", path, params=params).json()
+        except KubeApiError as e:
+            if missing_ok and e.not_found:
+                return None
+            raise
+
+    def delete_collection(
+        self, path: str, label_selector: str, **params: Any
+    ) -> dict[str, Any]:
+        """Delete all objects matching the selector in a single request."""
+        params["labelSelector"] = label_selector
+        return self.request("DELETE", path, params=params).json()
+
+    def exists(self, path: str) -> bool:
+        try:
+            self.request("GET", path)
+        except KubeApiError as e:
+            if e.not_found:
+                return False
+            raise
+        return True
+
+    def resource(self, api_version: str, kind: str) -> dict[str, Any]:
+        """Discover the API resource (name, namespaced, verbs) for a kind of
+        object. Raises KeyError when the API server does not know the kind.
+        """
+        resources = self._resources.get(api_version)
+        if resources is None:
+            group_path = f"/apis/{api_version}" if "/" in api_version else "/api/v1"
+            discovered = self.get(group_path)["resources"]
+            resources = self._resources[api_version] = {
+                resource["kind"]: resource
+                for resource in discovered
+                if "/" not in resource["name"]  # skip subresources
+            }
+        if kind not in resources:
+            raise KeyError(f"Unknown kind {kind} in {api_version}")
+        return resources[kind]
+
+    def resource_path(
+        self, api_version: str, kind: str, namespace: str = "", name: str = ""
+    ) -> str:
+        """REST path for objects of a kind, or a single named object."""
+        resource = self.resource(api_version, kind)
+        path = f"/apis/{api_version}" if "/" in api_version else "/api/v1"
+        if resource["namespaced"]:
+            path += f"/namespaces/{namespace or self.namespace}"
+        path += f"/{resource['name']}"
+        return f"{path}/{name}" if name else path
+
+    def watch(
+        self, path: str, resource_version: str, label_selector: str = "", timeout=300
+    ) -> Iterator[dict[str, Any]]:
+        """Yields watch events (type, object) until the server ends the watch."""
+        params: dict[str, Any] = {
+            "watch": "1",
+            "resourceVersion": resource_version,
+            "allowWatchBookmarks": "true",
+            "timeoutSeconds": timeout,
+        }
+        if label_selector:
+            params["labelSelector"] = label_selector
+
+        with self.request(
+            "GET",
+            path,
+            params=params,
+            stream=True,
+            timeout=(DEFAULT_TIMEOUT[0], timeout + 10),
+        ) as r:
+            for line in r.iter_lines():
+                if line:
+                    yield json.loads(line)
+
+
+# API paths of the resources we use
+PEERS = "/apis/kilo.squat.ai/v1alpha1/peers"
+NODES = "/api/v1/nodes"
+NAMESPACES = "/api/v1/namespaces"
+KUBE_DNS = "/api/v1/namespaces/kube-system/services/kube-dns"
@@ -0,0 +1,160 @@
+#
+# Sinfonia
+#
+# Copyright (c) 2022 Carnegie Mellon University
+#
+# SPDX-License-Identifier: MIT
+#
+"""Lease deadlines of deployments, ordered by when they run out.
+
+A deployment's lease starts when it is created (or resumed) and is renewed
+whenever its client's tunnel is seen active. Suspended deployments have a
+deadline at the end of their suspend duration. Deadlines are kept in a heap,
+so an expiry round only looks at the deployments whose lease ran out instead
+of every deployment on the cloudlet.
+
+The scheduler follows the deployment peers as an informer listener, which
+also rebuilds it from the peer annotations after a restart.
+"""
+
+from __future__ import annotations
+
+import heapq
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable
+
+from attrs import define, field
+from wireguard_tools import WireguardKey
+
+from .deployment import SUSPENDED, key_from_k8s_label, parse_date
+
+logger = logging.getLogger(__name__)
+
+Peer = Dict[str, Any]
+
+
+@define
+class LeaseScheduler:
+    lease_duration: int = 300  # seconds
+    suspend_duration: int = 3600  # seconds
+    clock: Callable[[], float] = time.time
+
+    # deployment name -> current deadline, the heap may hold older entries
+    _deadlines: dict[str, float] = field(init=False, factory=dict)
+    _heap: list[tuple[float, str]] = field(init=False, factory=list)
+    _suspended: set[str] = field(init=False, factory=set)
+    # client key -> deployment names
+    _clients: dict[WireguardKey, set[str]] = field(init=False, factory=dict)
+    _keys: dict[str, WireguardKey] = field(init=False, factory=dict)
+    _lock: threading.Lock = field(init=False, factory=threading.Lock)
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def deadline(self, name: str) -> float | None:
+        return self._deadlines.get(name)
+
+    def suspended(self) -> list[str]:
+        with self._lock:
+            return sorted(self._suspended)
+
+    def _schedule(self, name: str, deadline: float) -> None:
+        """Called with the lock held."""
+        self._deadlines[name] = deadline
+        heapq.heappush(self._heap, (deadline, name))
+        # drop superseded entries once they make up most of the heap
+        if len(self._heap) > 2 * len(self._deadlines) + 64:
+            self._heap = [(when, name) for name, when in self._deadlines.items()]
+            heapq.heapify(self._heap)
+
+    def schedule(self, name: str, deadline: float) -> None:
+        """(Re-)examine a tracked deployment at deadline."""
+        with self._lock:
+            if name in self._keys:
+                self._schedule(name, deadline)
+
+    def _remove(self, name: str) -> None:
+        self._deadlines.pop(name, None)
+        self._suspended.discard(name)
+        key = self._keys.pop(name, None)
+        if key is not None:
+            names = self._clients.get(key, set())
+            names.discard(name)
+            if not names:
+                self._clients.pop(key, None)
+
+    def remove(self, name: str) -> None:
+        with self._lock:
+            self._remove(name)
+
+    def peer_changed(self, old: Peer | None, new: Peer | None) -> None:
+        """PeerInformer listener, tracks added, changed and removed peers."""
+        if new is None:
+            if old is not None:
+                self.remove(old["metadata"]["name"])
+            return
+
+        metadata = new["metadata"]
+        name = metadata["name"]
+        annotations = metadata.get("annotations", {})
+        try:
+            key = key_from_k8s_label(metadata["labels"]["findcloudlet.org/key"])
+            created = parse_date(annotations["findcloudlet.org/created"])
+            suspended = annotations.get(SUSPENDED)
+            if suspended is not None:
+                deadline = parse_date(suspended).timestamp() + self.suspend_duration
+            else:
+                deadline = created.timestamp() + self.lease_duration
+        except (KeyError, ValueError):
+            logger.warning(f"Unable to track lease of {name}")
+            return
+
+        with self._lock:
+            if self._keys.get(name) != key:
+                self._remove(name)
+                self._keys[name] = key
+                self._clients.setdefault(key, set()).add(name)
+
+            if suspended is not None:
+                self._suspended.add(name)
+            elif name in self._suspended:
+                self._suspended.discard(name)  # resumed, lease restarts
+            elif name in self._deadlines:
+                # keep leases that were renewed since the peer was created
+                deadline = max(deadline, self._deadlines[name])
+            self._schedule(name, deadline)
+
+    def sync(self, peers: Iterable[Peer]) -> None:
+        """Track exactly these peers, used when there is no informer to
+        follow the peers for us."""
+        current = set()
+        for peer in peers:
+            self.peer_changed(None, peer)
+            current.add(peer["metadata"]["name"])
+        with self._lock:
+            for name in set(self._keys) - current:
+                self._remove(name)
+
+    def observe(self, active_peers: Iterable[WireguardKey], now: float) -> None:
+        """Renew the leases of deployments with an active client tunnel."""
+        deadline = now + self.lease_duration
+        with self._lock:
+            for key in active_peers:
+                for name in self._clients.get(key, ()):
+                    if name not in self._suspended:
+                        if self._deadlines.get(name, 0.0) < deadline:
+                            self._schedule(name, deadline)
+
+    def due(self, now: float) -> list[str]:
+        """Deployments whose deadline has passed, these are no longer
+        scheduled until they change or are explicitly scheduled again."""
+        due = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                deadline, name = heapq.heappop(self._heap)
+                if self._deadlines.get(name) == deadline:
+                    del self._deadlines[name]
+                    due.append(name)
+        return due
@@ -0,0 +1,354 @@
+#
+# Sinfonia
+#
+# Copyright (c) 2022 Carnegie Mellon University
+#
+# SPDX-License-Identifier: MIT
+#
+"""Install backends by applying pre-rendered chart manifests.
+
+A helm install forks helm, unpacks the chart and renders its templates for
+every deployment, while the only thing that differs between deployments of
+the same recipe is the namespace, which is also used as the release name.
+So we render a recipe's chart once with 'helm template', using a placeholder
+of the same length as the namespace, and cache the result. Installing a
+backend substitutes the namespace and applies the manifests with the API
+server (server-side apply), without involving helm at all.
+
+The cache is keyed by the recipe values, the chart file and the length of
+the namespace, charts from the chart cache are content addressed so a changed
+chart or recipe renders again.
+
+This is opt-in (HELM_RELEASES = False) because it is only correct for charts
+that render the same manifests for every deployment. Charts raise
+UnsupportedChart, and are installed as regular helm releases instead, when
+- they create resources that are not namespaced, as these would outlive the
+  namespace, or the API server doesn't know a kind they use.
+- they use helm hooks, which only helm knows how to run.
+- their templates use random values, generated certificates or lookup(), as
+  every deployment of the recipe would share the rendered secrets, and lookup
+  returns nothing when rendering without a release.
+Backends applied this way have no helm release record, 'helm list' does not
+show them and removing them relies on deleting the namespace.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import os
+import re
+import tarfile
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Callable, Iterator, Tuple
+
+import yaml
+from attrs import define, field
+from plumbum.commands.base import BaseCommand
+from requests.exceptions import RequestException
+
+from .chart_cache import ChartCache
+from .coalesce import Coalescer
+from .deployment_recipe import DeploymentRecipe
+from .kube_client import NAMESPACES, KubeClient
+from .metrics import REGISTRY
+from .node_resources import place_manifest
+
+logger = logging.getLogger(__name__)
+
+# same length as deployment names, so truncated names come out the same,
+# other namespace lengths use a shortened or padded placeholder
+PLACEHOLDER = "sinfonia-zzplaceholderzzz"
+MIN_NAMESPACE_LENGTH = len("sinfonia-zzplaceholder")
+
+# template functions that render differently for every release
+NONDETERMINISTIC = re.compile(
+    r"\b(rand(Alpha|AlphaNum|Ascii|Bytes|Int|Numeric)|uuidv4|lookup|"
+    r"gen(CA|CAWithKey|PrivateKey|SelfSignedCert|SelfSignedCertWithKey|"
+    r"SignedCert|SignedCertWithKey))\b"
+)
+HOOK_ANNOTATION = "helm.sh/hook"
+
+# kinds are applied in this order (after helm's install order), any other
+# kinds are applied after these.
+INSTALL_ORDER = [
+    "NetworkPolicy",
+    "ResourceQuota",
+    "LimitRange",
+    "PodDisruptionBudget",
+    "ServiceAccount",
+    "Secret",
+    "ConfigMap",
+    "PersistentVolumeClaim",
+    "Role",
+    "RoleBinding",
+    "Service",
+    "DaemonSet",
+    "Pod",
+    "ReplicationController",
+    "ReplicaSet",
+    "Deployment",
+    "HorizontalPodAutoscaler",
+    "StatefulSet",
+    "Job",
+    "CronJob",
+    "Ingress",
+]
+
+# workloads we wait for to become ready
+WORKLOADS = ("deployments", "statefulsets")
+
+RENDERS = REGISTRY.counter(
+    "sinfonia_manifest_cache_requests", "Rendered chart lookups by result", ["result"]
+)
+RENDER_TIME = REGISTRY.histogram(
+    "sinfonia_chart_render_seconds", "Time taken to render a chart"
+)
+
+CacheKey = Tuple[str, ...]
+
+
+class UnsupportedChart(Exception):
+    pass
+
+
+@contextmanager
+def values_file(values: dict[str, Any]) -> Iterator[str]:
+    """Temporary file with recipe values to pass to helm."""
+    with tempfile.TemporaryDirectory(prefix="sinfonia-") as tmpdir:
+        path = os.path.join(tmpdir, "values.yaml")
+        with open(path, "w") as f:
+            yaml.dump(values, f)
+        yield path
+
+
+def placeholder(length: int) -> str:
+    """Namespace placeholder of the given length."""
+    if length < MIN_NAMESPACE_LENGTH:
+        raise UnsupportedChart(f"namespace shorter than {MIN_NAMESPACE_LENGTH}")
+    return PLACEHOLDER[:length].ljust(length, "z")
+
+
+def _nondeterministic(archive: tarfile.TarFile) -> str | None:
+    """First template function in the chart, or any of its subcharts, that
+    renders differently for every release."""
+    for member in archive.getmembers():
+        if not member.isfile():
+            continue
+        fileobj = archive.extractfile(member)
+        if fileobj is None:
+            continue
+        if member.name.endswith(".tgz"):
+            with tarfile.open(fileobj=fileobj) as subchart:
+                function = _nondeterministic(subchart)
+        elif "/templates/" in member.name:
+            match = NONDETERMINISTIC.search(fileobj.read().decode(errors="replace"))
+            function = match.group(1) if match else None
+        else:
+            continue
+        if function is not None:
+            return f"{member.name} uses {function}"
+    return None
+
+
+def _install_order(manifest: dict[str, Any]) -> int:
+    try:
+        return INSTALL_ORDER.index(manifest["kind"])
+    except ValueError:
+        return len(INSTALL_ORDER)
+
+
+def _ready(workload: dict[str, Any]) -> bool:
+    metadata, spec = workload["metadata"], workload["spec"]
+    status = workload.get("status", {})
+    return status.get("observedGeneration", 0) >= metadata.get(
+        "generation", 0
+    ) and status.get("readyReplicas", 0) >= spec.get("replicas", 1)
+
+
+@define(frozen=True)
+class RenderedChart:
+    # JSON encoded manifests with the namespace placeholder
+    template: str | None
+    error: str | None = None
+    placeholder: str = PLACEHOLDER
+
+    def manifests(self, namespace: str) -> list[dict[str, Any]]:
+        if self.template is None:
+            raise UnsupportedChart(self.error)
+        return json.loads(self.template.replace(self.placeholder, namespace))
+
+
+@define
+class ManifestCache:
+    api: KubeClient
+    helm: BaseCommand
+    charts: ChartCache
+    max_entries: int = 64
+    clock: Callable[[], float] = time.monotonic
+    sleep: Callable[[float], None] = time.sleep
+
+    _entries: OrderedDict[CacheKey, RenderedChart] = field(
+        init=False, factory=OrderedDict
+    )
+    _lock: threading.Lock = field(init=False, factory=threading.Lock)
+    _renders: Coalescer[RenderedChart] = field(
+        init=False, factory=lambda: Coalescer("chart_render")
+    )
+
+    def _key(self, recipe: DeploymentRecipe, chart: Path, length: int) -> CacheKey:
+        stat = chart.stat()
+        values = json.dumps(recipe.values, sort_keys=True, default=str)
+        return (
+            str(chart),
+            str(stat.st_mtime_ns),
+            str(stat.st_size),
+            hashlib.sha256(values.encode()).hexdigest(),
+            str(length),
+        )
+
+    def render(
+        self, recipe: DeploymentRecipe, length: int = len(PLACEHOLDER)
+    ) -> RenderedChart:
+        """Rendered manifests for the recipe with a namespace placeholder of
+        the given length, from the cache if possible."""
+        name = placeholder(length)
+        with self.charts.use(recipe) as chart:
+            key = self._key(recipe, chart, length)
+            with self._lock:
+                rendered = self._entries.get(key)
+                if rendered is not None:
+                    self._entries.move_to_end(key)
+                    RENDERS.inc(result="hit")
+                    return rendered
+
+            RENDERS.inc(result="miss")
+            return self._renders.run(
+                key, lambda: self._render(recipe, chart, key, name)
+            )
+
+    def _render(
+        self, recipe: DeploymentRecipe, chart: Path, key: CacheKey, placeholder: str
+    ) -> RenderedChart:
+        rendered = self._check_chart(recipe, chart)
+        if rendered is None:
+            start = self.clock()
+            with values_file(recipe.values) as values:
+                output = self.helm(
+                    "template",
+                    placeholder,
+                    str(chart),
+                    "--namespace",
+                    placeholder,
+                    "--values",
+                    values,
+                    "--skip-tests",
+                )
+            RENDER_TIME.observe(self.clock() - start)
+            rendered = self._check_manifests(recipe, output, placeholder)
+
+        with self._lock:
+            self._entries[key] = rendered
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return rendered
+
+    def _check_chart(
+        self, recipe: DeploymentRecipe, chart: Path
+    ) -> RenderedChart | None:
+        """Unsupported when the chart templates render differently for every
+        release, None when the chart is fine."""
+        try:
+            with tarfile.open(chart) as archive:
+                error = _nondeterministic(archive)
+        except (tarfile.TarError, OSError) as e:
+            error = f"can't inspect chart: {e}"
+        if error is not None:
+            return RenderedChart(None, f"{recipe.chart_version}: {error}")
+        return None
+
+    def _check_manifests(
+        self, recipe: DeploymentRecipe, output: str, placeholder: str
+    ) -> RenderedChart:
+        """Rendered chart, unless it has hooks or resources that can't be
+        placed in the deployment namespace."""
+        manifests = [doc for doc in yaml.safe_load_all(output) if doc]
+        for manifest in manifests:
+            kind, name = manifest["kind"], manifest["metadata"]["name"]
+            annotations = manifest["metadata"].get("annotations") or {}
+            if HOOK_ANNOTATION in annotations:
+                return RenderedChart(
+                    None, f"{recipe.chart_version} has helm hook {kind} {name}"
+                )
+            try:
+                resource = self.api.resource(manifest["apiVersion"], kind)
+            except KeyError as e:
+                return RenderedChart(None, f"{recipe.chart_version}: {e}")
+            except RequestException as e:
+                # not cached, discovery may work next time
+                raise UnsupportedChart(f"{recipe.chart_version}: {e}") from e
+            if not resource["namespaced"]:
+                return RenderedChart(
+                    None, f"{recipe.chart_version} creates cluster scoped {kind} {name}"
+                )
+        return RenderedChart(
+            json.dumps(sorted(manifests, key=_install_order)), placeholder=placeholder
+        )
+
+    def apply(
+        self,
+        recipe: DeploymentRecipe,
+        namespace: str,
+        wait: bool = False,
+        timeout: int = 300,
+        node: str | None = None,
+    ) -> None:
+        """Install the recipe's backend in namespace, preferably on node.
+        With wait it only returns once the backend is ready, or raises
+        TimeoutError.
+        Raises UnsupportedChart when the chart has to be installed by helm.
+        """
+        manifests = self.render(recipe, len(namespace)).manifests(namespace)
+        if node is not None:
+            for manifest in manifests:
+                place_manifest(manifest, node)
+
+        self.api.apply(
+            f"{NAMESPACES}/{namespace}",
+            {"apiVersion": "v1", "kind": "Namespace", "metadata": {"name": namespace}},
+        )
+        for manifest in manifests:
+            manifest["metadata"]["namespace"] = namespace
+            path = self.api.resource_path(
+                manifest["apiVersion"],
+                manifest["kind"],
+                namespace,
+                manifest["metadata"]["name"],
+            )
+            self.api.apply(path, manifest)
+
+        if wait:
+            self.wait_ready(namespace, timeout)
+
+    def wait_ready(self, namespace: str, timeout: int = 300) -> None:
+        """Wait for all workloads in namespace to have their replicas ready."""
+        deadline = self.clock() + timeout
+        while True:
+            workloads = [
+                workload
+                for kind in WORKLOADS
+                for workload in self.api.list(
+                    f"/apis/apps/v1/namespaces/{namespace}/{kind}"
+                )["items"]
+            ]
+            if all(_ready(workload) for workload in workloads):
+                return
+            if self.clock() >= deadline:
+                raise TimeoutError(f"{namespace} not ready after {timeout}s")
+            self.sleep(1.0)
@@ -0,0 +1,207 @@
+#
+# Sinfonia
+#
+# Copyright (c) 2022 Carnegie Mellon University
+#
+# SPDX-License-Identifier: MIT
+#
+"""Minimal process metrics exported in the Prometheus text format.
+
+We only need a handful of counters, gauges and histograms, which doesn't
+justify pulling in prometheus_client. Metrics are registered once at import
+time in the module that updates them and are rendered by the /metrics
+endpoint.
+"""
+
+from __future__ import annotations
+
+import math
+import threading
+from typing import Callable, Dict, Iterator, Sequence, Tuple, Union
+
+from attrs import define, field
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LabelValues = Tuple[str, ...]
+Sample = Tuple[str, Dict[str, str], float]
+
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", r"\\").replace("\n", r"\n").replace('"', r"\"")
+
+
+def _format_value(value: float) -> str:
+    if math.isnan(value):
+        return "NaN"
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if value == int(value):
+        return str(int(value))
+    return repr(value)
+
+
+@define
+class _Metric:
+    name: str
+    help: str
+    labelnames: Sequence[str] = ()
+    _lock: threading.Lock = field(init=False, factory=threading.Lock, repr=False)
+
+    TYPE = "untyped"
+
+    def _key(self, labels: dict[str, str]) -> LabelValues:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _labels(self, key: LabelValues) -> dict[str, str]:
+        return dict(zip(self.labelnames, key))
+
+    def samples(self) -> Iterator[Sample]:
+        raise NotImplementedError
+
+
+@define
+class Counter(_Metric):
+    _values: dict[LabelValues, float] = field(init=False, factory=dict)
+
+    TYPE = "counter"
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels: str) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    def samples(self) -> Iterator[Sample]:
+        for key, value in list(self._values.items()):
+            yield self.name + "_total", self._labels(key), value
+
+
+@define
+class Gauge(_Metric):
+    _values: dict[LabelValues, float] = field(init=False, factory=dict)
+    _functions: dict[LabelValues, Callable[[], float]] = field(init=False, factory=dict)
+
+    TYPE = "gauge"
+
+    def set(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+    def set_function(self, function: Callable[[], float], **labels: str) -> None:
+        """Sample the value by calling function whenever metrics are rendered."""
+        self._functions[self._key(labels)] = function
+
+    def value(self, **labels: str) -> float:
+        key = self._key(labels)
+        if key in self._functions:
+            return self._functions[key]()
+        return self._values.get(key, 0.0)
+
+    def samples(self) -> Iterator[Sample]:
+        for key, value in list(self._values.items()):
+            yield self.name, self._labels(key), value
+        for key, function in list(self._functions.items()):
+            yield self.name, self._labels(key), function()
+
+
+@define
+class Histogram(_Metric):
+    buckets: Sequence[float] = DEFAULT_BUCKETS
+    _counts: dict[LabelValues, list[int]] = field(init=False, factory=dict)
+    _sums: dict[LabelValues, float] = field(init=False, factory=dict)
+
+    TYPE = "histogram"
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            counts = self._counts.setdefault(key, [0] * (len(self.buckets) + 1))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-1] += 1
+            self._sums[key] = self._sums.get(key, 0.0) + value
+
+    def count(self, **labels: str) -> int:
+        counts = self._counts.get(self._key(labels))
+        return counts[-1] if counts else 0
+
+    def samples(self) -> Iterator[Sample]:
+        for key, counts in list(self._counts.items()):
+            labels = self._labels(key)
+            for bound, count in zip([*self.buckets, math.inf], counts):
+                bucket_labels = dict(labels, le=_format_value(bound))
+                yield self.name + "_bucket", bucket_labels, count
+            yield self.name + "_sum", labels, self._sums[key]
+            yield self.name + "_count", labels, counts[-1]
+
+
+Metric = Union[Counter, Gauge, Histogram]
+
+
+@define
+class Registry:
+    metrics: dict[str, Metric] = field(factory=dict)
+
+    def _register(self, metric: Metric) -> Metric:
+        existing = self.metrics.setdefault(metric.name, metric)
+        if type(existing) is not type(metric):
+            raise ValueError(f"{metric.name} already registered as {existing.TYPE}")
+        return existing
+
+    def counter(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Counter:
+        metric = self._register(Counter(name, help, tuple(labelnames)))
+        assert isinstance(metric, Counter)
+        return metric
+
+    def gauge(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Gauge:
+        metric = self._register(Gauge(name, help, tuple(labelnames)))
+        assert isinstance(metric, Gauge)
+        return metric
+
+    def histogram(
+        self,
+        name: str,
+        help: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ) -> Histogram:
+        metric = self._register(
+            Histogram(name, help, tuple(labelnames), buckets=tuple(buckets))
+        )
+        assert isinstance(metric, Histogram)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for name, metric in sorted(self.metrics.items()):
+            lines.append(f"# HELP {name} {_escape(metric.help)}")
+            lines.append(f"# TYPE {name} {metric.TYPE}")
+            for sample, labels, value in metric.samples():
+                if labels:
+                    label_str = ",".join(
+                        f'{label}="{_escape(str(label_value))}"'
+                        for label, label_value in labels.items()
+                    )
+                    sample = f"{sample}{{{label_str}}}"
+                lines.append(f"{sample} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
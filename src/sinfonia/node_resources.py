@@ -0,0 +1,220 @@
+#
+# Sinfonia
+#
+# Copyright (c) 2022 Carnegie Mellon University
+#
+# SPDX-License-Identifier: MIT
+#
+"""Per-node resource headroom of a multi-node cloudlet.
+
+Cluster wide averages hide how capacity is spread over the nodes, a cloudlet
+with a single idle GPU node reports the same gpu_ratio as one where every
+GPU is half busy. We collect cpu, memory and gpu utilization per node, report
+a compact summary (the best node and the average of the top-k nodes) to
+Tier1, and steer backends that need a GPU towards the node with the most
+GPU headroom with a preferred node affinity.
+
+The cluster wide utilization ratios are also used to decide when resources
+are getting scarce. All utilization values are ratios (0..1), DCGM reports
+GPU utilization in percent so those queries scale it down.
+"""
+
+from __future__ import annotations
+
+import copy
+import logging
+import math
+from typing import Any, Iterable, Mapping, Optional
+
+from attrs import define, field
+
+from .prometheus import PrometheusError, QueryResults, scalar, vector
+
+logger = logging.getLogger(__name__)
+
+# cluster wide utilization (0..1) and network rates
+RESOURCE_QUERIES = {
+    "cpu_ratio": 'sum(rate(node_cpu_seconds_total{mode!="idle"}[1m])) / sum(node:node_num_cpu:sum)',  # noqa
+    "mem_ratio": "sum(1 - (node_memory_MemAvailable_bytes / node_memory_MemTotal_bytes)) / count(node_memory_MemTotal_bytes)",  # noqa
+    "net_rx_rate": "instance:node_network_receive_bytes_excluding_lo:rate5m",
+    "net_tx_rate": "instance:node_network_transmit_bytes_excluding_lo:rate5m",
+    "gpu_ratio": "sum(DCGM_FI_DEV_GPU_UTIL) / count(DCGM_FI_DEV_GPU_UTIL) / 100",
+}
+UTILIZATION_RATIOS = ("cpu_ratio", "mem_ratio", "gpu_ratio")
+
+# per-node utilization (0..1), labeled with the node's hostname
+NODE_QUERIES = {
+    "node_cpu": (
+        '(1 - avg by (instance) (rate(node_cpu_seconds_total{mode="idle"}[1m])))'
+        " * on (instance) group_left (nodename) node_uname_info"
+    ),
+    "node_mem": (
+        "(1 - node_memory_MemAvailable_bytes / node_memory_MemTotal_bytes)"
+        " * on (instance) group_left (nodename) node_uname_info"
+    ),
+    "node_gpu": (
+        'label_replace(avg by (Hostname) (DCGM_FI_DEV_GPU_UTIL) / 100, "nodename",'
+        ' "$1", "Hostname", "(.*)")'
+    ),
+}
+
+TOP_K = 3
+
+HOSTNAME_LABEL = "kubernetes.io/hostname"
+GPU_RESOURCE_SUFFIX = "/gpu"  # nvidia.com/gpu, amd.com/gpu
+
+
+@define(frozen=True)
+class NodeHeadroom:
+    """Fraction of each resource that is still available on a node."""
+
+    name: str
+    cpu: float = 0.0
+    mem: float = 0.0
+    gpu: Optional[float] = field(default=None)  # None when the node has no GPU
+
+    @property
+    def headroom(self) -> float:
+        """Limited by the scarcest of cpu and memory."""
+        return min(self.cpu, self.mem)
+
+
+def resources_from_metrics(metrics: QueryResults) -> dict[str, float]:
+    """Cluster wide resource values from the RESOURCE_QUERIES results."""
+    resources: dict[str, float] = {}
+    for resource in RESOURCE_QUERIES:
+        if resource not in metrics:
+            continue
+        try:
+            metric = scalar(metrics[resource])
+        except (PrometheusError, ValueError, KeyError, IndexError):
+            logger.exception(f"Failed to retrieve {resource}")
+            continue
+        if math.isfinite(metric):
+            resources[resource] = metric
+    return resources
+
+
+def over_utilized(resources: Mapping[str, float], threshold: float) -> bool:
+    """Is the cpu, memory or gpu utilization ratio above threshold."""
+    return any(
+        resources.get(resource, 0.0) > threshold for resource in UTILIZATION_RATIOS
+    )
+
+
+def nodes_from_metrics(metrics: QueryResults) -> list[NodeHeadroom]:
+    """Combine per-node utilization query results."""
+    utilization: dict[str, dict[str, float]] = {}
+    for query, resource in (
+        ("node_cpu", "cpu"),
+        ("node_mem", "mem"),
+        ("node_gpu", "gpu"),
+    ):
+        if query not in metrics:
+            continue
+        try:
+            samples = vector(metrics[query])
+        except (PrometheusError, KeyError):
+            continue
+        for sample in samples:
+            try:
+                node = sample["metric"]["nodename"]
+                value = float(sample["value"][1])
+            except (KeyError, IndexError, ValueError):
+                continue
+            if math.isfinite(value):
+                utilization.setdefault(node, {})[resource] = value
+
+    def free(value: float) -> float:
+        return min(1.0, max(0.0, 1.0 - value))
+
+    return [
+        NodeHeadroom(
+            name=node,
+            cpu=free(used.get("cpu", 1.0)),
+            mem=free(used.get("mem", 1.0)),
+            gpu=free(used["gpu"]) if "gpu" in used else None,
+        )
+        for node, used in sorted(utilization.items())
+    ]
+
+
+def summarize(nodes: Iterable[NodeHeadroom], k: int = TOP_K) -> dict[str, float]:
+    """Compact per-node capacity summary to report along with the cluster
+    wide resource ratios."""
+    nodes = list(nodes)
+    if not nodes:
+        return {}
+
+    summary: dict[str, float] = {"node_count": len(nodes)}
+    per_resource = {
+        "cpu": [node.cpu for node in nodes],
+        "mem": [node.mem for node in nodes],
+        "gpu": [node.gpu for node in nodes if node.gpu is not None],
+        "node": [node.headroom for node in nodes],
+    }
+    for resource, values in per_resource.items():
+        if not values:
+            continue
+        best = sorted(values, reverse=True)[:k]
+        summary[f"{resource}_headroom_max"] = best[0]
+        summary[f"{resource}_headroom_top{k}"] = sum(best) / len(best)
+    return summary
+
+
+def needs_gpu(values: Any) -> bool:
+    """Do the recipe's chart values request GPUs anywhere?"""
+    if isinstance(values, Mapping):
+        return any(
+            (isinstance(key, str) and key.endswith(GPU_RESOURCE_SUFFIX))
+            or needs_gpu(value)
+            for key, value in values.items()
+        )
+    if isinstance(values, list):
+        return any(needs_gpu(value) for value in values)
+    return False
+
+
+def best_gpu_node(nodes: Iterable[NodeHeadroom]) -> str | None:
+    """Node with the most GPU headroom, ties broken by cpu/memory headroom."""
+    gpu_nodes = [node for node in nodes if node.gpu is not None]
+    if not gpu_nodes:
+        return None
+    return max(gpu_nodes, key=lambda node: (node.gpu, node.headroom)).name
+
+
+def preferred_node_affinity(node: str, weight: int = 100) -> dict[str, Any]:
+    return {
+        "weight": weight,
+        "preference": {
+            "matchExpressions": [
+                {"key": HOSTNAME_LABEL, "operator": "In", "values": [node]}
+            ]
+        },
+    }
+
+
+def add_node_affinity(affinity: dict[str, Any] | None, node: str) -> dict[str, Any]:
+    """Copy of a pod affinity with an added preference for node."""
+    affinity = copy.deepcopy(affinity) if affinity else {}
+    preferred = affinity.setdefault("nodeAffinity", {}).setdefault(
+        "preferredDuringSchedulingIgnoredDuringExecution", []
+    )
+    preferred.append(preferred_node_affinity(node))
+    return affinity
+
+
+def place_manifest(manifest: dict[str, Any], node: str) -> None:
+    """Prefer scheduling the pods of a workload manifest on node."""
+    spec = manifest.get("spec", {})
+    if manifest["kind"] == "CronJob":
+        spec = spec.get("jobTemplate", {}).get("spec", {})
+    pod_spec = spec.get("template", {}).get("spec")
+    if pod_spec is not None:
+        pod_spec["affinity"] = add_node_affinity(pod_spec.get("affinity"), node)
+
+
+def place_values(values: dict[str, Any], node: str) -> dict[str, Any]:
+    """Chart values that prefer node, for charts following the 'helm create'
+    convention of a top-level affinity value."""
+    return dict(values, affinity=add_node_affinity(values.get("affinity"), node))
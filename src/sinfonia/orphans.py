@@ -0,0 +1,180 @@
+#
+# Sinfonia
+#
+# Copyright (c) 2022 Carnegie Mellon University
+#
+# SPDX-License-Identifier: MIT
+#
+"""Find and remove deployment resources that lost their counterpart.
+
+A deployment is a Peer, a namespace and, when it was installed with helm, a
+helm release in that namespace. A failed install, or Tier2 going down in the
+middle of a deploy or teardown, can leave Peers without a namespace, or
+namespaces and releases without a Peer. These hold on to client addresses
+and cluster resources until they are removed.
+
+The collector periodically lists all deployment Peers, namespaces and helm
+release secrets, one request each, and compares them. Anything that is
+still orphaned after the grace period is removed, which leaves deploys and
+installs that are in progress enough time to complete.
+"""
+
+from __future__ import annotations
+
+import logging
+import re
+import threading
+import time
+from typing import TYPE_CHECKING, Any, Callable, Tuple
+
+from attrs import define, field
+from plumbum.commands.processes import ProcessExecutionError
+from requests.exceptions import RequestException
+
+from .deployment import Deployment
+from .installer import INSTALLING, PENDING
+from .kube_client import NAMESPACES, PEERS
+from .metrics import REGISTRY
+from .peer_informer import DEPLOYMENT_SELECTOR
+from .teardown import SECRETS
+from .warm_pool import CLAIMED, STATE_LABEL
+
+if TYPE_CHECKING:
+    from .cluster import Cluster
+
+logger = logging.getLogger(__name__)
+
+# namespaces named by deployment_name()
+DEPLOYMENT_NAMESPACE = re.compile(r"sinfonia-[a-z2-7]{16}")
+
+PEER = "peer"
+NAMESPACE = "namespace"
+RELEASE = "release"
+
+ORPHANS = REGISTRY.gauge(
+    "sinfonia_orphans", "Orphaned resources found in the last pass", ["kind"]
+)
+ORPHANS_REMOVED = REGISTRY.counter(
+    "sinfonia_orphans_removed", "Orphaned resources removed", ["kind"]
+)
+
+Orphan = Tuple[str, str]  # kind, name
+
+
+def _is_backend(namespace: dict[str, Any]) -> bool:
+    """Namespace created for a deployment or a claimed warm backend."""
+    metadata = namespace["metadata"]
+    return (
+        DEPLOYMENT_NAMESPACE.fullmatch(metadata["name"]) is not None
+        or metadata.get("labels", {}).get(STATE_LABEL) == CLAIMED
+    )
+
+
+def _peer_namespace(peer: dict[str, Any]) -> str:
+    metadata = peer["metadata"]
+    return metadata.get("annotations", {}).get(
+        "findcloudlet.org/namespace", metadata["name"]
+    )
+
+
+@define
+class OrphanCollector:
+    cluster: Cluster
+    grace_period: float = 600.0  # seconds
+    clock: Callable[[], float] = time.monotonic
+
+    # when we first found each orphan
+    _seen: dict[Orphan, float] = field(init=False, factory=dict)
+    _lock: threading.Lock = field(init=False, factory=threading.Lock)
+
+    def _expired(self, orphans: set[Orphan]) -> set[Orphan]:
+        """Orphans that were found in every pass for the whole grace period."""
+        now = self.clock()
+        with self._lock:
+            self._seen = {orphan: self._seen.get(orphan, now) for orphan in orphans}
+            return {
+                orphan
+                for orphan, seen in self._seen.items()
+                if now - seen >= self.grace_period
+            }
+
+    def _in_progress(self, name: str) -> bool:
+        installer = self.cluster.installer
+        if installer is None:
+            return False
+        status = installer.status(name)
+        return status is not None and status.state in (PENDING, INSTALLING)
+
+    def find(
+        self,
+        peers: list[dict[str, Any]],
+        namespaces: list[dict[str, Any]],
+        releases: list[dict[str, Any]],
+    ) -> set[Orphan]:
+        """Compare deployment Peers, namespaces and helm release secrets."""
+        referenced = {_peer_namespace(peer) for peer in peers}
+        existing = {
+            namespace["metadata"]["name"]
+            for namespace in namespaces
+            # namespaces that are being deleted are taken care of
+            if namespace.get("status", {}).get("phase") != "Terminating"
+        }
+        orphaned = {
+            namespace["metadata"]["name"]
+            for namespace in namespaces
+            if _is_backend(namespace)
+        }
+        orphaned = (orphaned & existing) - referenced
+
+        orphans = {
+            (PEER, peer["metadata"]["name"])
+            for peer in peers
+            if _peer_namespace(peer) not in existing
+            and not self._in_progress(peer["metadata"]["name"])
+        }
+        orphans.update((NAMESPACE, name) for name in orphaned)
+        orphans.update(
+            (RELEASE, secret["metadata"]["namespace"])
+            for secret in releases
+            if secret["metadata"]["namespace"] in orphaned
+        )
+        return orphans
+
+    def collect(self) -> None:
+        """Find orphans and remove the ones past their grace period."""
+        api = self.cluster.api
+        try:
+            peers = api.list(PEERS, label_selector=DEPLOYMENT_SELECTOR)["items"]
+            namespaces = api.list(NAMESPACES)["items"]
+            releases = api.list(SECRETS, label_selector="owner=helm")["items"]
+        except RequestException as e:
+            logger.warning(f"Failed to list deployment resources: {e!r}")
+            return
+
+        orphans = self.find(peers, namespaces, releases)
+        for kind in (PEER, NAMESPACE, RELEASE):
+            ORPHANS.set(sum(1 for orphan in orphans if orphan[0] == kind), kind=kind)
+
+        expired = self._expired(orphans)
+        peers_by_name = {peer["metadata"]["name"]: peer for peer in peers}
+        for kind, name in sorted(expired):
+            try:
+                if kind == PEER:
+                    logger.info(f"Expiring peer {name} without a backend")
+                    Deployment.from_manifest(self.cluster, peers_by_name[name]).expire()
+                elif kind == NAMESPACE:
+                    logger.info(f"Removing namespace {name} without a peer")
+                    self._remove_namespace(name, (RELEASE, name) in expired)
+                else:
+                    # releases are uninstalled when removing their namespace
+                    continue
+            except (RequestException, ProcessExecutionError, ValueError) as e:
+                logger.warning(f"Failed to remove orphaned {kind} {name}: {e!r}")
+                continue
+            ORPHANS_REMOVED.inc(kind=kind)
+
+    def _remove_namespace(self, name: str, helm_release: bool) -> None:
+        if helm_release:
+            self.cluster.helm("uninstall", "--namespace", name, name)
+            ORPHANS_REMOVED.inc(kind=RELEASE)
+        self.cluster.api.delete(f"{NAMESPACES}/{name}", propagationPolicy="Background")
@@ -0,0 +1,150 @@
+#
+# Sinfonia
+#
+# Copyright (c) 2022 Carnegie Mellon University
+#
+# SPDX-License-Identifier: MIT
+#
+"""Track which clients still have an active WireGuard tunnel.
+
+Deployments expire when their client's tunnel has been idle for the lease
+duration. By default we ask Prometheus for peers with a recent handshake or
+received traffic, which is only as fresh as the scrape interval and breaks
+when any part of the scrape pipeline does. When Tier2 can see the tunnel
+interface (host network, or a sidecar that periodically writes the output
+of `wg show <interface> dump` to a shared file) it reads the WireGuard peer
+state directly, the Prometheus query is then only used as a fallback.
+
+The `wg show <interface> dump` output has one tab separated line for the
+interface (private-key, public-key, listen-port, fwmark) followed by a line
+per peer (public-key, preshared-key, endpoint, allowed-ips, latest-handshake,
+transfer-rx, transfer-tx, persistent-keepalive). With `wg show all dump`
+every line is prefixed with the interface name.
+"""
+
+from __future__ import annotations
+
+import logging
+import time
+from pathlib import Path
+from typing import Callable, Dict, Optional, Set, Tuple
+
+from attrs import define, field
+from plumbum import local
+from plumbum.commands.processes import CommandNotFound, ProcessExecutionError
+from wireguard_tools import WireguardKey
+
+from .prometheus import PrometheusError, QueryResults, vector
+
+logger = logging.getLogger(__name__)
+
+ActivePeers = Set[WireguardKey]
+
+
+@define(frozen=True)
+class PeerActivity:
+    public_key: WireguardKey
+    latest_handshake: int  # seconds since the epoch, 0 if never
+    rx_bytes: int
+    tx_bytes: int
+
+
+def parse_wg_dump(dump: str) -> Dict[WireguardKey, PeerActivity]:
+    """Parse peers from `wg show <interface|all> dump` output."""
+    peers = {}
+    for line in dump.splitlines():
+        fields = line.split("\t")
+        if len(fields) == 9:  # 'wg show all dump' peer line
+            fields = fields[1:]
+        if len(fields) != 8:  # interface line
+            continue
+        try:
+            public_key = WireguardKey(fields[0])
+            peers[public_key] = PeerActivity(
+                public_key=public_key,
+                latest_handshake=int(fields[4]),
+                rx_bytes=int(fields[5]),
+                tx_bytes=int(fields[6]),
+            )
+        except ValueError:
+            logger.warning(f"Unable to parse wireguard peer {line!r}")
+    return peers
+
+
+class ActivitySource:
+    """Source of tunnel activity, returns None when it can't tell."""
+
+    def active_peers(self, lease_duration: int) -> Optional[ActivePeers]:
+        raise NotImplementedError
+
+
+@define
+class WireguardDump(ActivitySource):
+    read: Callable[[], str]
+    clock: Callable[[], float] = time.time
+
+    # last seen receive counter and when it changed, by peer
+    _rx: Dict[WireguardKey, Tuple[int, float]] = field(init=False, factory=dict)
+
+    @classmethod
+    def from_interface(cls, interface: str) -> WireguardDump:
+        """Read peer state with the wg command."""
+
+        def read() -> str:
+            return local["wg"]("show", interface, "dump")
+
+        return cls(read)
+
+    @classmethod
+    def from_file(cls, path: str | Path, max_age: float = 60) -> WireguardDump:
+        """Read peer state from a dump file that is refreshed by some other
+        process, the dump is ignored when it wasn't updated recently."""
+        dump_path = Path(path)
+
+        def read() -> str:
+            age = time.time() - dump_path.stat().st_mtime
+            if age > max_age:
+                raise OSError(f"{dump_path} not updated for {age:.0f}s")
+            return dump_path.read_text()
+
+        return cls(read)
+
+    def active_peers(self, lease_duration: int) -> Optional[ActivePeers]:
+        try:
+            dump = self.read()
+        except (OSError, CommandNotFound, ProcessExecutionError) as e:
+            logger.warning(f"Failed to read wireguard peers: {e!r}")
+            return None
+
+        now = self.clock()
+        cutoff = now - lease_duration
+
+        peers = parse_wg_dump(dump)
+        active = set()
+        for key, peer in peers.items():
+            rx_bytes, changed = self._rx.get(key, (peer.rx_bytes, 0.0))
+            if peer.rx_bytes != rx_bytes:
+                changed = now
+            self._rx[key] = (peer.rx_bytes, changed)
+
+            if peer.latest_handshake > cutoff or changed > cutoff:
+                active.add(key)
+
+        # forget peers that were removed
+        for key in set(self._rx) - set(peers):
+            del self._rx[key]
+        return active
+
+
+def prometheus_active_peers(metrics: QueryResults) -> Optional[ActivePeers]:
+    """Active peers from the Prometheus handshake/traffic deltas query."""
+    if "active_peers" not in metrics:
+        return None
+    try:
+        return {
+            WireguardKey(peer["metric"]["public_key"])
+            for peer in vector(metrics["active_peers"])
+        }
+    except (PrometheusError, ValueError, KeyError):
+        logger.exception("Failed to retrieve active peers")
+        return None
@@ -0,0 +1,279 @@
+#
+# Sinfonia
+#
+# Copyright (c) 2022 Carnegie Mellon University
+#
+# SPDX-License-Identifier: MIT
+#
+"""In-memory cache of the Kilo Peer objects for Sinfonia deployments.
+
+The informer lists all deployment Peers once and then follows changes with a
+watch, resuming from the last seen resourceVersion whenever the API server
+closes the watch. When the resourceVersion is too old (410 Gone) it falls back
+to a full relist.
+
+Peers are indexed by name and by the recipe UUID, client key and client IP
+labels so that the common lookups are dictionary hits. Callers should check
+`healthy` and fall back to querying the API server when the watch is down.
+
+The cache is only considered healthy while it is known to be in sync, when
+the last relist, watch event or bookmark is no more than `max_staleness`
+seconds old. Watches are restarted well within that time so that a quiet
+cluster still counts as in sync. Deployment status is served from the cache,
+so this bounds how out of date a status response can be.
+"""
+
+from __future__ import annotations
+
+import logging
+import threading
+import time
+from collections import defaultdict
+from typing import Any, Callable, Dict, Iterable, Optional, Tuple
+
+from attrs import define, field
+from requests.exceptions import RequestException
+
+from .kube_client import PEERS, KubeApiError, KubeClient
+from .metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+DEPLOYMENT_SELECTOR = "findcloudlet.org=deployment"
+INDEXED_LABELS = (
+    "findcloudlet.org/uuid",
+    "findcloudlet.org/key",
+    "findcloudlet.org/client",
+)
+
+STALENESS = REGISTRY.gauge(
+    "sinfonia_peer_cache_staleness_seconds",
+    "Time since the peer cache was last known to be in sync",
+)
+
+Peer = Dict[str, Any]
+
+# called with the (old, new) peer whenever a peer is added, changed or removed
+PeerListener = Callable[[Optional[Peer], Optional[Peer]], None]
+Change = Tuple[Optional[Peer], Optional[Peer]]
+
+
+def parse_selector(selectors: Iterable[str]) -> dict[str, str]:
+    """Parse simple 'label=value' equality selectors."""
+    labels = {}
+    for selector in selectors:
+        for term in filter(None, selector.split(",")):
+            label, _, value = term.partition("=")
+            labels[label.strip()] = value.strip()
+    return labels
+
+
+def _newer(peer: Peer, current: Peer) -> bool:
+    """resourceVersions are opaque, but in practice etcd revision numbers."""
+    new_version = peer["metadata"].get("resourceVersion", "")
+    old_version = current["metadata"].get("resourceVersion", "")
+    if new_version.isdigit() and old_version.isdigit():
+        return int(new_version) >= int(old_version)
+    return True
+
+
+@define
+class PeerInformer:
+    api: KubeClient
+    selector: str = DEPLOYMENT_SELECTOR
+    watch_timeout: int = 60  # seconds before the server ends a watch
+    max_backoff: float = 30.0  # seconds
+    max_staleness: float = 120.0  # seconds without confirming we're in sync
+    listeners: list[PeerListener] = field(factory=list)
+    clock: Callable[[], float] = time.monotonic
+
+    _peers: dict[str, Peer] = field(init=False, factory=dict)
+    _index: dict[str, dict[str, set[str]]] = field(
+        init=False, factory=lambda: defaultdict(lambda: defaultdict(set))
+    )
+    _resource_version: str = field(init=False, default="")
+    _healthy: bool = field(init=False, default=False)
+    _synced: float = field(init=False, default=0.0)
+    _lock: threading.Lock = field(init=False, factory=threading.Lock)
+    _stop: threading.Event = field(init=False, factory=threading.Event)
+    _thread: threading.Thread | None = field(init=False, default=None)
+
+    def __attrs_post_init__(self) -> None:
+        STALENESS.set_function(lambda: self.staleness)
+
+    @property
+    def staleness(self) -> float:
+        """Seconds since the cache was last known to be in sync."""
+        return self.clock() - self._synced
+
+    @property
+    def healthy(self) -> bool:
+        return self._healthy and self.staleness <= self.max_staleness
+
+    def __len__(self) -> int:
+        return len(self._peers)
+
+    def get(self, name: str) -> Peer | None:
+        return self._peers.get(name)
+
+    def select(self, *selectors: str) -> list[Peer]:
+        """Return cached peers matching all 'label=value' selectors."""
+        labels = parse_selector(selectors)
+        with self._lock:
+            candidates: Iterable[str] = self._peers
+            for label in INDEXED_LABELS:
+                if label in labels:
+                    candidates = self._index[label].get(labels[label], set())
+                    break
+
+            return [
+                self._peers[name]
+                for name in list(candidates)
+                if all(
+                    self._peers[name]["metadata"].get("labels", {}).get(label) == value
+                    for label, value in labels.items()
+                )
+            ]
+
+    def peers(self) -> list[Peer]:
+        with self._lock:
+            return list(self._peers.values())
+
+    # updating the cache, listeners are notified after the lock is released
+    def replace(self, peers: list[Peer], resource_version: str) -> None:
+        with self._lock:
+            current = {peer["metadata"]["name"] for peer in peers}
+            changes = [self._discard(name) for name in set(self._peers) - current]
+            changes.extend(self._add(peer) for peer in peers)
+            self._resource_version = resource_version
+        self._notify(changes)
+
+    def update(self, peer: Peer) -> None:
+        """Add or update a peer, also used to write-through our own changes."""
+        with self._lock:
+            current = self._peers.get(peer["metadata"]["name"])
+            if current is not None and not _newer(peer, current):
+                return
+            change = self._add(peer)
+        self._notify([change])
+
+    def remove(self, name: str) -> None:
+        with self._lock:
+            change = self._discard(name)
+        self._notify([change])
+
+    def deleted(self, peer: Peer) -> None:
+        """Remove a deleted peer, unless it has since been replaced by a newer
+        peer with the same name."""
+        with self._lock:
+            current = self._peers.get(peer["metadata"]["name"])
+            if current is None or not _newer(peer, current):
+                return
+            change = self._discard(peer["metadata"]["name"])
+        self._notify([change])
+
+    def _add(self, peer: Peer) -> Change:
+        name = peer["metadata"]["name"]
+        old = self._unindex(name)
+        self._peers[name] = peer
+        labels = peer["metadata"].get("labels", {})
+        for label in INDEXED_LABELS:
+            if label in labels:
+                self._index[label][labels[label]].add(name)
+        return old, peer
+
+    def _discard(self, name: str) -> Change:
+        return self._unindex(name), None
+
+    def _unindex(self, name: str) -> Peer | None:
+        peer = self._peers.pop(name, None)
+        if peer is None:
+            return None
+        labels = peer["metadata"].get("labels", {})
+        for label in INDEXED_LABELS:
+            names = self._index[label].get(labels.get(label, ""))
+            if names is not None:
+                names.discard(name)
+                if not names:
+                    del self._index[label][labels[label]]
+        return peer
+
+    def _notify(self, changes: Iterable[Change]) -> None:
+        for old, new in changes:
+            if old is None and new is None:
+                continue
+            for listener in self.listeners:
+                listener(old, new)
+
+    # list + watch
+    def relist(self) -> None:
+        result = self.api.list(PEERS, label_selector=self.selector)
+        self.replace(result["items"], result["metadata"]["resourceVersion"])
+        self._healthy = True
+        self._synced = self.clock()
+        logger.debug(f"Listed {len(self._peers)} peers")
+
+    def handle_event(self, event: dict[str, Any]) -> None:
+        kind, obj = event["type"], event["object"]
+        if kind == "ERROR":
+            if obj.get("code") == 410:
+                # resourceVersion too old, need to relist
+                self._resource_version = ""
+                return
+            raise RuntimeError(f"Watch failed: {obj.get('message')}")
+
+        if kind == "ADDED" or kind == "MODIFIED":
+            self.update(obj)
+        elif kind == "DELETED":
+            self.deleted(obj)
+        self._resource_version = obj["metadata"]["resourceVersion"]
+        self._synced = self.clock()
+
+    def sync_once(self) -> None:
+        """Relist if needed and follow the watch until the server closes it."""
+        if not self._resource_version:
+            self.relist()
+
+        try:
+            for event in self.api.watch(
+                PEERS,
+                self._resource_version,
+                label_selector=self.selector,
+                timeout=self.watch_timeout,
+            ):
+                self.handle_event(event)
+                if not self._resource_version or self._stop.is_set():
+                    break
+            else:
+                # the server ended the watch, we saw everything up to now
+                self._synced = self.clock()
+        except KubeApiError as e:
+            if e.status_code != 410:
+                raise
+            self._resource_version = ""
+
+    def start(self) -> None:
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float | None = None) -> None:
+        """Stop following changes, an active watch only notices this when
+        the next event arrives or the server closes the watch."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self) -> None:
+        backoff = 1.0
+        while not self._stop.is_set():
+            try:
+                self.sync_once()
+                backoff = 1.0
+            except (RequestException, RuntimeError, KeyError, ValueError):
+                logger.exception("Peer watch failed")
+                self._healthy = False
+                self._resource_version = ""
+                self._stop.wait(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
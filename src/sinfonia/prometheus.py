@@ -0,0 +1,156 @@
+#
+# Sinfonia
+#
+# Copyright (c) 2022 Carnegie Mellon University
+#
+# SPDX-License-Identifier: MIT
+#
+"""Query the cluster's Prometheus server for resource and tunnel metrics.
+
+All queries we need are sent concurrently over a pooled session with short
+timeouts, so a slow or unreachable Prometheus can't stall the background
+jobs. Results are cached for a few seconds and shared by everything that
+needs them (reporting to Tier1, expiring deployments, the warm pool). When a
+query fails, its last result is used for a while longer.
+"""
+
+from __future__ import annotations
+
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Collection, Dict, FrozenSet, Mapping, Tuple
+
+import requests
+from attrs import define, field
+from requests.exceptions import RequestException
+from yarl import URL
+
+from .coalesce import Coalescer
+from .metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_URL = URL("http://kube-prometheus-stack-prometheus.monitoring:9090")
+
+QueryResults = Dict[str, Dict[str, Any]]
+
+QUERY_TIME = REGISTRY.histogram(
+    "sinfonia_prometheus_query_seconds", "Time taken by a pass over all queries"
+)
+QUERY_ERRORS = REGISTRY.counter(
+    "sinfonia_prometheus_query_errors", "Failed Prometheus queries"
+)
+
+
+class PrometheusError(Exception):
+    pass
+
+
+def scalar(data: dict[str, Any]) -> float:
+    """Value of a scalar query result."""
+    if data["resultType"] != "scalar":
+        raise PrometheusError(f"Expected scalar, got {data['resultType']}")
+    return float(data["result"][1])
+
+
+def vector(data: dict[str, Any]) -> list[dict[str, Any]]:
+    """Samples in an instant vector query result."""
+    if data["resultType"] != "vector":
+        raise PrometheusError(f"Expected vector, got {data['resultType']}")
+    return data["result"]
+
+
+@define
+class Prometheus:
+    url: URL = field(default=DEFAULT_URL, converter=URL)
+    session: requests.Session = field(factory=requests.Session, repr=False)
+    timeout: Tuple[float, float] = (2.0, 5.0)  # connect, read
+    ttl: float = 10.0  # seconds results are reused
+    stale_ttl: float = 120.0  # seconds results are used when a query fails
+    max_workers: int = 8
+    clock: Callable[[], float] = field(default=time.monotonic, repr=False)
+
+    # query -> (time retrieved, result data)
+    _cache: dict[str, Tuple[float, dict[str, Any]]] = field(
+        init=False, factory=dict, repr=False
+    )
+    _lock: threading.Lock = field(init=False, factory=threading.Lock, repr=False)
+    _executor: ThreadPoolExecutor = field(init=False, repr=False)
+    _passes: Coalescer[QueryResults] = field(
+        init=False, factory=lambda: Coalescer("prometheus"), repr=False
+    )
+
+    @_executor.default
+    def _default_executor(self) -> ThreadPoolExecutor:
+        return ThreadPoolExecutor(
+            max_workers=self.max_workers, thread_name_prefix="prometheus"
+        )
+
+    def _query(self, query: str) -> dict[str, Any]:
+        r = self.session.post(
+            str(self.url / "api" / "v1" / "query"),
+            data={"query": query},
+            timeout=self.timeout,
+        )
+        r.raise_for_status()
+        result = r.json()
+        if result["status"] != "success":
+            raise PrometheusError(result.get("error", "query failed"))
+        return result["data"]
+
+    def _fetch(self, queries: Collection[str]) -> QueryResults:
+        start = self.clock()
+        futures = {
+            query: self._executor.submit(self._query, query) for query in queries
+        }
+
+        results = {}
+        for query, future in futures.items():
+            try:
+                data = future.result()
+            except (RequestException, PrometheusError, ValueError, KeyError) as e:
+                logger.warning(f"Failed to query Prometheus for {query}: {e!r}")
+                QUERY_ERRORS.inc()
+                continue
+            results[query] = data
+            with self._lock:
+                self._cache[query] = (self.clock(), data)
+
+        QUERY_TIME.observe(self.clock() - start)
+        return results
+
+    def query(self, queries: Mapping[str, str]) -> QueryResults:
+        """Run named queries, returns the result data by name.
+
+        Queries that failed and don't have a recent enough earlier result
+        are left out.
+        """
+        now = self.clock()
+        results: QueryResults = {}
+        missing = {}
+        with self._lock:
+            for name, query in queries.items():
+                cached = self._cache.get(query)
+                if cached is not None and now - cached[0] < self.ttl:
+                    results[name] = cached[1]
+                else:
+                    missing[name] = query
+
+        if not missing:
+            return results
+
+        # concurrent callers asking for the same queries share a single pass
+        key: FrozenSet[str] = frozenset(missing.values())
+        fetched = self._passes.run(key, lambda: self._fetch(key))
+
+        for name, query in missing.items():
+            if query in fetched:
+                results[name] = fetched[query]
+                continue
+            with self._lock:
+                cached = self._cache.get(query)
+            if cached is not None and now - cached[0] < self.stale_ttl:
+                results[name] = cached[1]
+        return results
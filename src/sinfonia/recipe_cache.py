@@ -0,0 +1,337 @@
+#
+# Sinfonia
+#
+# Copyright (c) 2022 Carnegie Mellon University
+#
+# SPDX-License-Identifier: MIT
+#
+"""Cache of parsed deployment recipes.
+
+Every deployment request (and on Tier2 every listed deployment) needs the
+recipe for an application UUID. Fetching, parsing and validating the recipe
+each time adds a round trip to the recipe repository to the request path, so we
+keep parsed recipes around for a while.
+
+- Recipes are considered fresh for `ttl` seconds, after which they are
+  revalidated with a conditional request (ETag/Last-Modified) so unchanged
+  recipes are not downloaded and parsed again.
+- An expired recipe is still returned for up to `stale_ttl` seconds while it
+  is revalidated in the background (stale-while-revalidate).
+- Unknown or invalid recipes are remembered for `negative_ttl` seconds so that
+  repeated requests for a bad UUID don't hit the repository.
+- When the repository can not be reached the cached recipe is kept and only
+  retried after `retry_delay` seconds, instead of on every request.
+
+When the repository provides an index manifest (see recipe_index), the cache
+is populated in bulk from the index and requests for UUIDs that are not listed
+in the index are rejected without any I/O. Recipes that match the digest in
+the index don't expire until a refreshed index lists a different digest.
+"""
+
+from __future__ import annotations
+
+import logging
+import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+from uuid import UUID
+
+import yaml
+from attrs import define, field
+from jsonschema.exceptions import ValidationError
+from requests.exceptions import HTTPError, RequestException
+
+from .deployment_recipe import DeploymentRecipe
+from .deployment_repository import CacheValidators, DeploymentRepository
+from .recipe_index import INDEX_NAME, RecipeIndex, RecipeIndexEntry, recipe_digest
+
+logger = logging.getLogger(__name__)
+
+
+@define
+class RecipeCacheEntry:
+    recipe: DeploymentRecipe | None
+    error: str | None
+    validators: CacheValidators | None
+    expires: float
+    digest: str | None = None
+
+    def check(self) -> DeploymentRecipe:
+        """Return cached recipe or raise the cached (negative) result."""
+        if self.recipe is None:
+            raise ValueError(self.error)
+        return self.recipe
+
+
+def _is_missing(exc: Exception) -> bool:
+    """Did the repository tell us the recipe does not exist? Denied access
+    is more likely a credentials problem than a missing recipe."""
+    if isinstance(exc, FileNotFoundError):
+        return True
+    return (
+        isinstance(exc, HTTPError)
+        and exc.response is not None
+        and 400 <= exc.response.status_code < 500
+        and exc.response.status_code not in (401, 403)
+    )
+
+
+@define
+class RecipeCache:
+    repository: DeploymentRepository
+    ttl: float = 60
+    negative_ttl: float = 10
+    stale_ttl: float = 600
+    retry_delay: float = 10
+    clock: Callable[[], float] = field(default=time.monotonic, eq=False, repr=False)
+
+    _entries: dict[UUID, RecipeCacheEntry] = field(init=False, factory=dict, repr=False)
+    _refreshing: set[UUID] = field(init=False, factory=set, repr=False)
+    _lock: threading.Lock = field(init=False, factory=threading.Lock, repr=False)
+
+    # optional index manifest of all recipes in the repository
+    index: RecipeIndex | None = field(init=False, default=None, repr=False)
+    _index_validators: CacheValidators | None = field(
+        init=False, default=None, repr=False
+    )
+
+    def get(self, uuid: UUID) -> DeploymentRecipe:
+        """Returns the recipe for uuid.
+        Raises ValueError when the recipe is unknown or failed to validate.
+        """
+        if self.index is not None and uuid not in self.index:
+            raise ValueError(f"Request for unknown recipe {uuid}")
+
+        now = self.clock()
+        entry = self._entries.get(uuid)
+
+        if entry is not None:
+            if now < entry.expires:
+                return entry.check()
+
+            if entry.recipe is not None and now < entry.expires + self.stale_ttl:
+                self._revalidate_in_background(uuid)
+                return entry.recipe
+
+        return self.refresh(uuid).check()
+
+    def refresh(self, uuid: UUID) -> RecipeCacheEntry:
+        """(Re)load the recipe from the repository and update the cache."""
+        entry = self._entries.get(uuid)
+        validators = entry.validators if entry and entry.recipe else None
+        ref = f"{uuid}.yaml"
+
+        try:
+            recipe_yaml, validators = self.repository.fetch(ref, validators)
+        except (OSError, RequestException) as e:
+            if not _is_missing(e):
+                # transient failure, keep serving the old recipe if we have one
+                logger.warning(f"Failed to refresh recipe {uuid}: {e!r}")
+                if entry is not None and entry.recipe is not None:
+                    entry.expires = max(entry.expires, self.clock() + self.retry_delay)
+                    return entry
+                raise ValueError(f"Unable to retrieve recipe {uuid}") from e
+
+            new_entry = RecipeCacheEntry(
+                recipe=None,
+                error=f"Request for unknown recipe {uuid}",
+                validators=None,
+                expires=self.clock() + self.negative_ttl,
+            )
+        else:
+            if recipe_yaml is None:
+                assert entry is not None
+                new_entry = RecipeCacheEntry(
+                    recipe=entry.recipe,
+                    error=None,
+                    validators=validators,
+                    expires=(
+                        self._expires(uuid, entry.digest, self.ttl)
+                        if entry.digest is not None
+                        else self.clock() + self.ttl
+                    ),
+                    digest=entry.digest,
+                )
+            else:
+                new_entry = self._parse(uuid, recipe_yaml, validators)
+
+        with self._lock:
+            self._entries[uuid] = new_entry
+        return new_entry
+
+    def _parse(
+        self, uuid: UUID, recipe_yaml: str, validators: CacheValidators | None
+    ) -> RecipeCacheEntry:
+        digest = recipe_digest(recipe_yaml)
+        try:
+            recipe = DeploymentRecipe.from_yaml(self.repository, uuid, recipe_yaml)
+        except (ValidationError, yaml.YAMLError):
+            return RecipeCacheEntry(
+                recipe=None,
+                error=f"Failed to validate recipe {uuid}",
+                validators=None,
+                expires=self._expires(uuid, digest, self.negative_ttl),
+                digest=digest,
+            )
+        return RecipeCacheEntry(
+            recipe=recipe,
+            error=None,
+            validators=validators,
+            expires=self._expires(uuid, digest, self.ttl),
+            digest=digest,
+        )
+
+    def _expires(self, uuid: UUID, digest: str, ttl: float) -> float:
+        """Recipes that match the index manifest stay valid until it changes."""
+        index_entry = self.index.get(uuid) if self.index is not None else None
+        if index_entry is not None and index_entry.sha256 == digest:
+            return math.inf
+        return self.clock() + ttl
+
+    def load_index(self, name: str = INDEX_NAME) -> bool:
+        """Load or refresh the repository index manifest.
+
+        Populates the cache with any inline recipes and prefetches listed
+        recipes that are not yet cached or have changed.
+        Returns False when the repository does not provide a (valid) index.
+        """
+        try:
+            index_yaml, validators = self.repository.fetch(name, self._index_validators)
+        except (OSError, RequestException) as e:
+            if _is_missing(e):
+                self.index = self._index_validators = None
+                self._prefetch_listed()
+                return False
+            logger.warning(f"Failed to refresh recipe index: {e!r}")
+            return self.index is not None
+
+        if index_yaml is None:
+            return True
+
+        try:
+            index = RecipeIndex.from_yaml(index_yaml)
+        except (ValidationError, ValueError, yaml.YAMLError):
+            logger.exception("Failed to validate recipe index")
+            return self.index is not None
+
+        self.update_index(index)
+        self._index_validators = validators
+        logger.info(f"Loaded recipe index with {len(index)} recipes")
+        return True
+
+    def update_index(self, index: RecipeIndex) -> None:
+        """Replace the index, only changed recipes are reloaded."""
+        prefetch = []
+        with self._lock:
+            for uuid, index_entry in index.entries.items():
+                entry = self._entries.get(uuid)
+                if entry is not None and entry.digest == index_entry.sha256:
+                    entry.expires = math.inf
+                elif index_entry.recipe is not None:
+                    self._entries[uuid] = self._from_index(uuid, index_entry)
+                else:
+                    self._entries.pop(uuid, None)
+                    prefetch.append(uuid)
+
+            for uuid in set(self._entries) - set(index.entries):
+                del self._entries[uuid]
+
+            self.index = index
+
+        if prefetch:
+            self._prefetch_in_background(prefetch)
+
+    def _from_index(
+        self, uuid: UUID, index_entry: RecipeIndexEntry
+    ) -> RecipeCacheEntry:
+        try:
+            recipe = DeploymentRecipe.from_dict(
+                self.repository, uuid, index_entry.recipe
+            )
+        except ValidationError:
+            return RecipeCacheEntry(
+                recipe=None,
+                error=f"Failed to validate recipe {uuid}",
+                validators=None,
+                expires=math.inf,
+                digest=index_entry.sha256,
+            )
+        return RecipeCacheEntry(
+            recipe=recipe,
+            error=None,
+            validators=None,
+            expires=math.inf,
+            digest=index_entry.sha256,
+        )
+
+    def _prefetch_listed(self) -> None:
+        """Without an index, prefetch recipes we find by listing the repository."""
+        try:
+            listing = self.repository.list(".yaml")
+        except NotImplementedError:
+            return
+        except (OSError, RequestException) as e:
+            logger.warning(f"Failed to list recipes: {e!r}")
+            return
+
+        with self._lock:
+            cached = set(self._entries)
+        uuids = []
+        for name in listing:
+            try:
+                uuid = UUID(name[: -len(".yaml")])
+            except ValueError:
+                continue
+            if uuid not in cached:
+                uuids.append(uuid)
+
+        if uuids:
+            self._prefetch_in_background(uuids)
+
+    def _prefetch_in_background(self, uuids: list[UUID]) -> None:
+        threading.Thread(target=self.prefetch, args=(uuids,), daemon=True).start()
+
+    def prefetch(self, uuids: list[UUID], max_workers: int = 8) -> None:
+        """Load a batch of recipes into the cache."""
+
+        def load(uuid: UUID) -> None:
+            try:
+                self.refresh(uuid)
+            except ValueError:
+                pass
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            executor.map(load, uuids)
+
+    def _revalidate_in_background(self, uuid: UUID) -> None:
+        with self._lock:
+            if uuid in self._refreshing:
+                return
+            self._refreshing.add(uuid)
+
+        def revalidate() -> None:
+            try:
+                self.refresh(uuid)
+            except ValueError:
+                pass
+            finally:
+                with self._lock:
+                    self._refreshing.discard(uuid)
+
+        threading.Thread(target=revalidate, daemon=True).start()
+
+    def recipes(self) -> list[DeploymentRecipe]:
+        """Currently cached valid recipes."""
+        with self._lock:
+            entries = list(self._entries.values())
+        return [entry.recipe for entry in entries if entry.recipe is not None]
+
+    def invalidate(self, uuid: UUID | None = None) -> None:
+        """Drop a single cached recipe, or all cached recipes."""
+        with self._lock:
+            if uuid is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(uuid, None)
@@ -0,0 +1,144 @@
+#
+# Sinfonia
+#
+# Copyright (c) 2022 Carnegie Mellon University
+#
+# SPDX-License-Identifier: MIT
+#
+"""Index manifest for a repository of deployment recipes.
+
+A recipe repository can optionally contain an index manifest (index.yaml)
+which lists all available recipes, so that Tier1 and Tier2 can populate their
+recipe cache in bulk and reject requests for unknown UUIDs without having to
+ask the repository.
+
+Example index.yaml file,
+
+    version: 1
+    recipes:
+        00000000-0000-0000-0000-000000000000:
+            sha256: 5f1c...e3a0
+            recipe:
+                chart: example
+                version: 0.1.0
+                restricted: false
+
+The sha256 digest is calculated over the contents of the `<uuid>.yaml` recipe
+file, the recipe body is optional and when present is the parsed recipe file.
+"""
+
+from __future__ import annotations
+
+import hashlib
+from pathlib import Path
+from typing import Any
+from uuid import UUID
+
+import yaml
+from attrs import define, field
+from jsonschema import Draft202012Validator
+
+INDEX_NAME = "index.yaml"
+INDEX_VERSION = 1
+
+RECIPE_INDEX_SCHEMA = {
+    "$schema": "https://json-schema.org/draft/2020-12/schema",
+    "description": "Schema definition for the recipe repository index manifest",
+    "type": "object",
+    "properties": {
+        "version": {
+            "description": "Version of the index manifest format",
+            "const": INDEX_VERSION,
+        },
+        "recipes": {
+            "description": "Recipes in the repository, keyed by UUID",
+            "type": "object",
+            "additionalProperties": {
+                "type": "object",
+                "properties": {
+                    "sha256": {
+                        "description": "Digest of the recipe file",
+                        "type": "string",
+                        "pattern": "^[0-9a-f]{64}$",
+                    },
+                    "recipe": {
+                        "description": "Inline copy of the deployment recipe",
+                        "type": "object",
+                    },
+                },
+                "required": ["sha256"],
+            },
+        },
+    },
+    "required": ["version", "recipes"],
+}
+RECIPE_INDEX_VALIDATOR = Draft202012Validator(RECIPE_INDEX_SCHEMA)
+
+
+def recipe_digest(recipe_yaml: str | bytes) -> str:
+    """Content hash used to identify a version of a recipe file."""
+    if isinstance(recipe_yaml, str):
+        recipe_yaml = recipe_yaml.encode("utf-8")
+    return hashlib.sha256(recipe_yaml).hexdigest()
+
+
+@define(frozen=True)
+class RecipeIndexEntry:
+    sha256: str
+    recipe: dict[str, Any] | None = None
+
+
+@define
+class RecipeIndex:
+    entries: dict[UUID, RecipeIndexEntry] = field(factory=dict)
+
+    def __contains__(self, uuid: object) -> bool:
+        return uuid in self.entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, uuid: UUID) -> RecipeIndexEntry | None:
+        return self.entries.get(uuid)
+
+    @classmethod
+    def from_yaml(cls, index_yaml: str) -> RecipeIndex:
+        """Parse and validate index manifest.
+        May raise yaml.YAMLError, ValueError or jsonschema ValidationError.
+        """
+        index = yaml.safe_load(index_yaml)
+        RECIPE_INDEX_VALIDATOR.validate(index)
+
+        return cls(
+            {
+                UUID(uuid): RecipeIndexEntry(
+                    sha256=entry["sha256"], recipe=entry.get("recipe")
+                )
+                for uuid, entry in index["recipes"].items()
+            }
+        )
+
+    @classmethod
+    def from_directory(cls, recipes: Path, inline: bool = True) -> RecipeIndex:
+        """Build an index for all '<uuid>.yaml' recipes found in a directory."""
+        entries = {}
+        for path in sorted(recipes.glob("*.yaml")):
+            try:
+                uuid = UUID(path.stem)
+            except ValueError:
+                continue
+
+            recipe_yaml = path.read_bytes()
+            entries[uuid] = RecipeIndexEntry(
+                sha256=recipe_digest(recipe_yaml),
+                recipe=yaml.safe_load(recipe_yaml) if inline else None,
+            )
+        return cls(entries)
+
+    def to_yaml(self) -> str:
+        recipes: dict[str, Any] = {}
+        for uuid, entry in self.entries.items():
+            recipes[str(uuid)] = {"sha256": entry.sha256}
+            if entry.recipe is not None:
+                recipes[str(uuid)]["recipe"] = entry.recipe
+        return yaml.safe_dump(dict(version=INDEX_VERSION, recipes=recipes))
@@ -0,0 +1,280 @@
+#
+# Sinfonia
+#
+# Copyright (c) 2022 Carnegie Mellon University
+#
+# SPDX-License-Identifier: MIT
+#
+"""Keep recipes from a local (file://) repository in memory.
+
+The watcher scans the recipe directory once, hands all recipes to the recipe
+cache as if they came from an index manifest, and then uses inotify to find
+out when something in the directory changed. Lookups are then pure memory
+reads and unknown UUIDs are rejected without touching the filesystem.
+
+On every change notification we re-stat the recipe files and only reload the
+ones whose (resolved) file identity, size or modification time changed. Because
+stat follows symlinks this also catches the way Kubernetes updates ConfigMap
+volumes, where recipe files are symlinks through a `..data` symlink that is
+atomically renamed to point at a new timestamped directory.
+
+When inotify is not available (i.e. not running on Linux) we fall back to
+periodically re-scanning the directory.
+"""
+
+from __future__ import annotations
+
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import threading
+from pathlib import Path
+from typing import Any, Tuple
+from uuid import UUID
+
+import yaml
+from attrs import define, field
+
+from .recipe_cache import RecipeCache
+from .recipe_index import RecipeIndex, RecipeIndexEntry, recipe_digest
+
+logger = logging.getLogger(__name__)
+
+# inotify(7) event mask bits
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_IGNORED = 0x00008000
+
+WATCH_MASK = (
+    IN_MODIFY
+    | IN_ATTRIB
+    | IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+    | IN_MOVE_SELF
+)
+EVENT_HEADER = struct.Struct("iIII")
+
+# time to wait for more events before rescanning (a ConfigMap update or an
+# rsync of the recipes directory generates a burst of events)
+DEBOUNCE = 0.1
+# but rescan at least this often while events keep arriving
+MAX_DEBOUNCE = 1.0
+# shortest wait, so we don't spin when the burst window is almost over
+MIN_WAIT = 0.01
+
+FileSignature = Tuple[int, int, int, int]
+
+
+class Inotify:
+    """Minimal ctypes wrapper around the Linux inotify API."""
+
+    def __init__(self) -> None:
+        libc_name = ctypes.util.find_library("c")
+        if libc_name is None:
+            raise OSError("libc not found")
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+
+    def add_watch(self, path: Path, mask: int = WATCH_MASK) -> int:
+        wd = self._add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), str(path))
+        return wd
+
+    def wait(self, timeout: float) -> bool:
+        """Wait for events, returns True when any were available."""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        return bool(readable)
+
+    def read_masks(self) -> list[int]:
+        """Read and return the event masks of all pending events."""
+        masks = []
+        try:
+            while True:
+                buf = os.read(self.fd, 65536)
+                offset = 0
+                while offset < len(buf):
+                    _wd, mask, _cookie, length = EVENT_HEADER.unpack_from(buf, offset)
+                    masks.append(mask)
+                    offset += EVENT_HEADER.size + length
+        except BlockingIOError:
+            pass
+        return masks
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+def _signature(path: Path) -> FileSignature | None:
+    try:
+        st = path.stat()
+    except OSError:
+        return None
+    return (st.st_dev, st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+def _load_entry(path: Path) -> RecipeIndexEntry:
+    recipe_yaml = path.read_bytes()
+    try:
+        recipe: Any = yaml.safe_load(recipe_yaml)
+    except yaml.YAMLError:
+        # an empty recipe will fail validation and is cached as invalid
+        recipe = {}
+    return RecipeIndexEntry(sha256=recipe_digest(recipe_yaml), recipe=recipe or {})
+
+
+@define
+class RecipeWatcher:
+    cache: RecipeCache
+    directory: Path = field()
+    interval: float = 60  # seconds between full rescans (or polls)
+
+    _signatures: dict[UUID, FileSignature] = field(init=False, factory=dict)
+    _entries: dict[UUID, RecipeIndexEntry] = field(init=False, factory=dict)
+    _stop: threading.Event = field(init=False, factory=threading.Event)
+    _thread: threading.Thread | None = field(init=False, default=None)
+    _last_scan: float = field(init=False, default=0.0)
+
+    @directory.default
+    def _directory(self) -> Path:
+        base_url = self.cache.repository.base_url
+        assert base_url.scheme == "file"
+        return Path(base_url.path)
+
+    def scan(self) -> bool:
+        """Reload changed recipes, returns True if anything changed."""
+        self._last_scan = self.cache.clock()
+        signatures = {}
+        for path in self.directory.glob("*.yaml"):
+            try:
+                uuid = UUID(path.stem)
+            except ValueError:
+                continue
+            signature = _signature(path)
+            if signature is not None:
+                signatures[uuid] = signature
+
+        changed = False
+        for uuid in set(self._signatures) - set(signatures):
+            logger.info(f"Recipe {uuid} removed")
+            self._entries.pop(uuid, None)
+            changed = True
+
+        for uuid, signature in list(signatures.items()):
+            if self._signatures.get(uuid) == signature:
+                continue
+            try:
+                entry = _load_entry(self.directory / f"{uuid}.yaml")
+            except OSError:
+                # disappeared between stat and read, pick it up on the next scan
+                signatures.pop(uuid)
+                continue
+
+            if uuid in self._entries:
+                logger.info(f"Recipe {uuid} changed")
+            self._entries[uuid] = entry
+            changed = True
+
+        self._signatures = signatures
+        if changed or self.cache.index is None:
+            self.cache.update_index(RecipeIndex(dict(self._entries)))
+        return changed
+
+    def start(self) -> None:
+        # start watching before the initial scan so we don't miss any changes
+        inotify = self._start_inotify()
+        self.scan()
+        logger.info(f"Watching {len(self._entries)} recipes in {self.directory}")
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, args=(inotify,), daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _start_inotify(self) -> Inotify | None:
+        try:
+            inotify = Inotify()
+        except (OSError, AttributeError):
+            logger.warning("inotify unavailable, polling recipes directory")
+            return None
+
+        try:
+            inotify.add_watch(self.directory)
+        except OSError:
+            logger.warning(f"Unable to watch {self.directory}, polling instead")
+            inotify.close()
+            return None
+        return inotify
+
+    def _run(self, inotify: Inotify | None) -> None:
+        if inotify is None:
+            while not self._stop.wait(self.interval):
+                self._safe_scan()
+            return
+
+        try:
+            self._watch(inotify)
+        finally:
+            inotify.close()
+
+    def _watch(self, inotify: Inotify) -> None:
+        while not self._stop.is_set():
+            if inotify.wait(min(self.interval, 1.0)):
+                masks = self._collect(inotify)
+                if any(mask & (IN_IGNORED | IN_DELETE_SELF) for mask in masks):
+                    # directory itself was replaced (symlink swap), rewatch
+                    try:
+                        inotify.add_watch(self.directory)
+                    except OSError:
+                        logger.warning(f"Unable to watch {self.directory}")
+                self._safe_scan()
+            elif self._rescan_due():
+                self._safe_scan()
+
+    def _collect(self, inotify: Inotify) -> list[int]:
+        """Collect a burst of events before rescanning, for at most
+        MAX_DEBOUNCE seconds when events keep arriving."""
+        masks = inotify.read_masks()
+        deadline = self.cache.clock() + MAX_DEBOUNCE
+        while not self._stop.is_set():
+            remaining = deadline - self.cache.clock()
+            if remaining <= 0:
+                break
+            if not inotify.wait(max(min(DEBOUNCE, remaining), MIN_WAIT)):
+                break
+            masks.extend(inotify.read_masks())
+        return masks
+
+    def _rescan_due(self) -> bool:
+        return self.cache.clock() - self._last_scan >= self.interval
+
+    def _safe_scan(self) -> None:
+        try:
+            self.scan()
+        except Exception:
+            logger.exception(f"Failed to rescan {self.directory}")
@@ -0,0 +1,191 @@
+#
+# Sinfonia
+#
+# Copyright (c) 2022 Carnegie Mellon University
+#
+# SPDX-License-Identifier: MIT
+#
+"""Minimal S3 client for reading from a (private) recipe repository bucket.
+
+We only need to get and list objects, so instead of pulling in boto3 for the
+Tier1/Tier2 servers we sign plain requests with AWS Signature Version 4 and
+send them over a pooled requests session.
+
+Credentials and endpoint are picked up from the usual AWS environment
+variables (AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY, AWS_SESSION_TOKEN,
+AWS_REGION/AWS_DEFAULT_REGION). AWS_ENDPOINT_URL_S3 or AWS_ENDPOINT_URL select
+an S3 compatible service, such as MinIO, which is addressed with path-style
+URLs. Without credentials requests are sent unsigned.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import hmac
+import os
+import xml.etree.ElementTree as ET
+from datetime import datetime, timezone
+from typing import Iterator, Mapping
+from urllib.parse import parse_qsl, quote, urlsplit
+
+import requests
+from attrs import define, field
+from yarl import URL
+
+S3_NAMESPACE = "{http://s3.amazonaws.com/doc/2006-03-01/}"
+
+
+def _hmac(key: bytes, msg: str) -> bytes:
+    return hmac.new(key, msg.encode("utf-8"), hashlib.sha256).digest()
+
+
+def _sha256(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+@define
+class S3Auth(requests.auth.AuthBase):
+    """Sign requests with AWS Signature Version 4."""
+
+    access_key: str
+    secret_key: str = field(repr=False)
+    region: str = "us-east-1"
+    session_token: str | None = field(default=None, repr=False)
+
+    def __call__(self, r: requests.PreparedRequest) -> requests.PreparedRequest:
+        self.sign(r, datetime.now(timezone.utc))
+        return r
+
+    def sign(self, r: requests.PreparedRequest, now: datetime) -> None:
+        assert r.url is not None and r.method is not None
+        url = urlsplit(r.url)
+        body = r.body or b""
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+
+        amz_date = now.strftime("%Y%m%dT%H%M%SZ")
+        datestamp = now.strftime("%Y%m%d")
+        payload_hash = _sha256(body)
+
+        r.headers["x-amz-date"] = amz_date
+        r.headers["x-amz-content-sha256"] = payload_hash
+        if self.session_token is not None:
+            r.headers["x-amz-security-token"] = self.session_token
+
+        signed = {"host": url.netloc}
+        signed.update(
+            (name.lower(), str(value).strip())
+            for name, value in r.headers.items()
+            if name.lower().startswith("x-amz-")
+        )
+        signed_headers = ";".join(sorted(signed))
+        canonical_headers = "".join(
+            f"{name}:{signed[name]}\n" for name in sorted(signed)
+        )
+
+        canonical_query = "&".join(
+            f"{quote(key, safe='-_.~')}={quote(value, safe='-_.~')}"
+            for key, value in sorted(parse_qsl(url.query, keep_blank_values=True))
+        )
+        canonical_request = "\n".join(
+            [
+                r.method,
+                url.path or "/",
+                canonical_query,
+                canonical_headers,
+                signed_headers,
+                payload_hash,
+            ]
+        )
+
+        scope = f"{datestamp}/{self.region}/s3/aws4_request"
+        string_to_sign = "\n".join(
+            [
+                "AWS4-HMAC-SHA256",
+                amz_date,
+                scope,
+                _sha256(canonical_request.encode("utf-8")),
+            ]
+        )
+
+        key = _hmac(f"AWS4{self.secret_key}".encode("utf-8"), datestamp)
+        key = _hmac(key, self.region)
+        key = _hmac(key, "s3")
+        key = _hmac(key, "aws4_request")
+        signature = hmac.new(
+            key, string_to_sign.encode("utf-8"), hashlib.sha256
+        ).hexdigest()
+
+        r.headers["Authorization"] = (
+            f"AWS4-HMAC-SHA256 Credential={self.access_key}/{scope}, "
+            f"SignedHeaders={signed_headers}, Signature={signature}"
+        )
+
+
+@define
+class S3Endpoint:
+    region: str = "us-east-1"
+    endpoint_url: URL | None = None
+    auth: S3Auth | None = None
+
+    @classmethod
+    def from_env(cls, environ: Mapping[str, str] = os.environ) -> S3Endpoint:
+        region = (
+            environ.get("AWS_REGION")
+            or environ.get("AWS_DEFAULT_REGION")
+            or "us-east-1"
+        )
+        endpoint_url = environ.get("AWS_ENDPOINT_URL_S3") or environ.get(
+            "AWS_ENDPOINT_URL"
+        )
+
+        auth = None
+        if "AWS_ACCESS_KEY_ID" in environ and "AWS_SECRET_ACCESS_KEY" in environ:
+            auth = S3Auth(
+                access_key=environ["AWS_ACCESS_KEY_ID"],
+                secret_key=environ["AWS_SECRET_ACCESS_KEY"],
+                region=region,
+                session_token=environ.get("AWS_SESSION_TOKEN"),
+            )
+
+        return cls(
+            region=region,
+            endpoint_url=URL(endpoint_url) if endpoint_url else None,
+            auth=auth,
+        )
+
+    def bucket_url(self, bucket: str) -> URL:
+        """URL of the bucket, always ends with a '/'."""
+        if self.endpoint_url is not None:
+            # S3 compatible services generally expect path-style requests
+            base_path = self.endpoint_url.path.rstrip("/")
+            return self.endpoint_url.with_path(f"{base_path}/{bucket}/")
+        return URL.build(
+            scheme="https", host=f"{bucket}.s3.{self.region}.amazonaws.com", path="/"
+        )
+
+    def object_url(self, s3_url: URL) -> URL:
+        """Map s3://bucket/key to an http(s) URL."""
+        assert s3_url.scheme == "s3" and s3_url.host is not None
+        return self.bucket_url(s3_url.host).join(URL(s3_url.raw_path.lstrip("/")))
+
+    def list_objects(
+        self, session: requests.Session, bucket: str, prefix: str = ""
+    ) -> Iterator[tuple[str, str]]:
+        """Yields (key, etag) for all objects in the bucket matching prefix."""
+        params = {"list-type": "2", "prefix": prefix}
+        while True:
+            r = session.get(str(self.bucket_url(bucket)), params=params, auth=self.auth)
+            r.raise_for_status()
+
+            result = ET.fromstring(r.content)
+            for item in result.iter(f"{S3_NAMESPACE}Contents"):
+                yield (
+                    item.findtext(f"{S3_NAMESPACE}Key", ""),
+                    item.findtext(f"{S3_NAMESPACE}ETag", ""),
+                )
+
+            token = result.findtext(f"{S3_NAMESPACE}NextContinuationToken")
+            if result.findtext(f"{S3_NAMESPACE}IsTruncated") != "true" or not token:
+                break
+            params["continuation-token"] = token
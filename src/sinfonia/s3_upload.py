@@ -5,25 +5,183 @@
 #
 # SPDX-License-Identifier: MIT
 #
+"""Push Sinfonia recipes (and charts) to an S3 bucket.
+
+Objects are only uploaded when they are new or when the ETag reported by S3
+differs from the one calculated for the local file, uploads run in parallel
+and stale objects are removed with batched deletes.
+
+The AWS credentials file is passed as keyword arguments to boto3.client, so
+it can also contain an `endpoint_url` to sync with a local S3 compatible
+service such as MinIO.
+"""
 
 from __future__ import annotations
 
 import argparse
+import hashlib
+import io
 import json
 import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
+from typing import Any, BinaryIO, Dict, Iterator, Mapping, Union
 
 import boto3
+from attrs import define, field
+from boto3.s3.transfer import TransferConfig
 from tqdm import tqdm
 
+from .recipe_index import INDEX_NAME, RecipeIndex
+
+# objects of at least this size are uploaded in parts of this size
+MULTIPART_CHUNKSIZE = 8 * 1024 * 1024
+
+# S3 DeleteObjects accepts at most 1000 keys per request
+DELETE_BATCH_SIZE = 1000
+
+# local files, or generated content such as the index manifest
+Source = Union[Path, bytes]
+SourceMap = Dict[str, Source]
+
+
+def _open(source: Source) -> BinaryIO:
+    return source.open("rb") if isinstance(source, Path) else io.BytesIO(source)
+
+
+def local_etag(source: Source, chunksize: int = MULTIPART_CHUNKSIZE) -> str:
+    """Calculate the ETag S3 will report for an object uploaded with boto3.
+
+    Single part uploads use the MD5 of the content, multipart uploads use the
+    MD5 of the concatenated part digests followed by the number of parts.
+    """
+    whole = hashlib.md5()
+    parts = []
+    size = 0
+    with _open(source) as fh:
+        for chunk in iter(lambda: fh.read(chunksize), b""):
+            whole.update(chunk)
+            parts.append(hashlib.md5(chunk).digest())
+            size += len(chunk)
+
+    if size < chunksize:
+        return f'"{whole.hexdigest()}"'
+
+    multipart = hashlib.md5(b"".join(parts)).hexdigest()
+    return f'"{multipart}-{len(parts)}"'
+
+
+def local_objects(recipes: Path) -> Iterator[tuple[str, Path]]:
+    """Yield (key, path) for the recipes, charts and other files to upload."""
+    for path in sorted(recipes.rglob("*")):
+        relpath = path.relative_to(recipes)
+        # skip hidden files, this also skips ConfigMap '..data' directories
+        if not path.is_file() or any(p.startswith(".") for p in relpath.parts):
+            continue
+        if relpath.as_posix() == INDEX_NAME:
+            continue
+        yield relpath.as_posix(), path
+
+
+@define
+class SyncPlan:
+    uploads: SourceMap = field(factory=dict)
+    unchanged: set[str] = field(factory=set)
+    deletes: set[str] = field(factory=set)
 
-def parse_args():
+    @classmethod
+    def compare(
+        cls,
+        local: Mapping[str, Source],
+        remote: dict[str, str],
+        force: bool = False,
+        chunksize: int = MULTIPART_CHUNKSIZE,
+    ) -> SyncPlan:
+        """Compare local content with the ETags of objects in the bucket."""
+        plan = cls(deletes=set(remote) - set(local))
+        for key, source in local.items():
+            if not force and remote.get(key) == local_etag(source, chunksize):
+                plan.unchanged.add(key)
+            else:
+                plan.uploads[key] = source
+        return plan
+
+
+def list_bucket(client: Any, bucket: str) -> dict[str, str]:
+    """Returns the ETags of all objects in the bucket."""
+    paginator = client.get_paginator("list_objects_v2")
+    return {
+        item["Key"]: item["ETag"]
+        for page in paginator.paginate(Bucket=bucket)
+        for item in page.get("Contents", [])
+    }
+
+
+def content_type(key: str) -> str:
+    if key.endswith(".yaml"):
+        return "application/yaml"
+    if key.endswith(".tgz"):
+        return "application/gzip"
+    return "application/octet-stream"
+
+
+def upload_objects(
+    client: Any,
+    bucket: str,
+    uploads: SourceMap,
+    extra_args: dict[str, str],
+    max_workers: int = 8,
+) -> list[str]:
+    """Upload objects in parallel, returns the keys that failed to upload."""
+    config = TransferConfig(
+        multipart_threshold=MULTIPART_CHUNKSIZE,
+        multipart_chunksize=MULTIPART_CHUNKSIZE,
+        max_concurrency=4,
+    )
+
+    def upload(key: str, source: Source) -> None:
+        args = dict(extra_args, ContentType=content_type(key))
+        with _open(source) as fh:
+            client.upload_fileobj(fh, bucket, key, ExtraArgs=args, Config=config)
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(upload, key, source): key for key, source in uploads.items()
+        }
+        with tqdm(as_completed(futures), total=len(futures)) as progress:
+            for future in progress:
+                key = futures[future]
+                error = future.exception()
+                if error is not None:
+                    print(f"Failed to upload {key}: {error!r}")
+                    failed.append(key)
+                else:
+                    progress.set_description(f"Uploaded {key}")
+    return failed
+
+
+def delete_objects(client: Any, bucket: str, keys: set[str]) -> list[str]:
+    """Batch delete objects, returns the keys that failed to delete."""
+    failed: list[str] = []
+    ordered = sorted(keys)
+    for start in range(0, len(ordered), DELETE_BATCH_SIZE):
+        batch = ordered[start : start + DELETE_BATCH_SIZE]
+        response = client.delete_objects(
+            Bucket=bucket,
+            Delete=dict(Objects=[dict(Key=key) for key in batch], Quiet=True),
+        )
+        failed.extend(error["Key"] for error in response.get("Errors", []))
+    return failed
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "--aws-creds",
         default="aws_creds.json",
         type=argparse.FileType("r"),
-        help="extra args (AWS credentials) for boto3.resource(s3) [aws_creds.json]",
+        help="extra args (AWS credentials) for boto3.client(s3) [aws_creds.json]",
     )
     parser.add_argument(
         "bucket_name",
@@ -40,7 +198,9 @@ def parse_args():
         "--create", action="store_true", help="Create bucket if it doesn't exist"
     )
     parser.add_argument(
-        "--update", action="store_true", help="Re-upload already existing recipes"
+        "--update",
+        action="store_true",
+        help="Re-upload already existing recipes, even when they are unchanged",
     )
     parser.add_argument(
         "--delete", action="store_true", help="Remove old recipes from S3 bucket"
@@ -48,55 +208,113 @@ def parse_args():
     parser.add_argument(
         "--public", action="store_true", help="Make recipes readable by anyone"
     )
-    return parser.parse_args()
-
-
-def main() -> int:
-    """Push Sinfonia recipes to an S3 bucket"""
-    args = parse_args()
-
-    # check if source folder exists
-    if not args.RECIPES:
-        print(f"Missing {args.RECIPES}")
-        return 1
+    parser.add_argument(
+        "--no-index",
+        dest="index",
+        action="store_false",
+        help=f"Do not generate and upload an {INDEX_NAME} manifest",
+    )
+    parser.add_argument(
+        "--no-inline",
+        dest="inline",
+        action="store_false",
+        help="Do not include recipe bodies in the index manifest",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Only show what would be uploaded and deleted",
+    )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=8,
+        help="Number of parallel uploads [8]",
+    )
+    return parser.parse_args(argv)
 
-    # connect to S3 resource
-    creds = json.load(args.aws_creds)
-    s3 = boto3.resource("s3", **creds)
 
-    # make sure bucket exists
-    bucket = s3.Bucket(args.bucket_name)
-    if args.create:
-        bucket.create()
-        bucket.wait_until_exists()
+def sync(client: Any, args: argparse.Namespace) -> int:
+    """Synchronize the local recipes folder with the S3 bucket"""
+    local: SourceMap = dict(local_objects(args.RECIPES))
+    if args.index:
+        index = RecipeIndex.from_directory(args.RECIPES, inline=args.inline)
+        local[INDEX_NAME] = index.to_yaml().encode("utf-8")
 
     # list existing recipes in bucket (also tests if bucket exists)
     try:
-        existing = {item.key for item in bucket.objects.all()}
-    except s3.meta.client.exceptions.NoSuchBucket:
+        remote = list_bucket(client, args.bucket_name)
+    except client.exceptions.NoSuchBucket:
         print(f"Bucket {args.bucket_name} does not exist")
         return 1
 
-    with tqdm(list(args.RECIPES.iterdir())) as recipes:
-        ACL = dict(ACL="public-read" if args.public else "private")
-        for recipe in recipes:
-            if args.update or recipe.name not in existing:
-                action = "Updating" if recipe.name in existing else "Creating"
-                recipes.set_description(f"{action} {recipe.name}")
+    plan = SyncPlan.compare(local, remote, force=args.update)
+    if not args.delete:
+        plan.deletes.clear()
 
-                with recipe.open("rb") as fh:
-                    bucket.upload_fileobj(fh, recipe.name, ExtraArgs=ACL)
-            existing.discard(recipe.name)
+    print(
+        f"{len(plan.uploads)} to upload, {len(plan.unchanged)} unchanged, "
+        f"{len(plan.deletes)} to delete"
+    )
+    if args.dry_run:
+        for key in sorted(plan.uploads):
+            action = "update" if key in remote else "create"
+            print(f"would {action} {key}")
+        for key in sorted(plan.deletes):
+            print(f"would delete {key}")
+        return 0
 
-    if args.delete and existing:
-        if input(f"Ok to delete {len(existing)} old recipes? [yN] ") != "y":
-            return 0
+    ACL = dict(ACL="public-read" if args.public else "private")
+    # the index goes last, so readers never see it list objects that are
+    # not uploaded yet
+    index_upload = plan.uploads.pop(INDEX_NAME, None)
+    failed = upload_objects(
+        client, args.bucket_name, plan.uploads, ACL, max_workers=args.jobs
+    )
+    if index_upload is not None:
+        if failed:
+            print(f"Not uploading {INDEX_NAME}, some recipes failed to upload")
+            failed.append(INDEX_NAME)
+        else:
+            failed = upload_objects(
+                client, args.bucket_name, {INDEX_NAME: index_upload}, ACL
+            )
 
-        for key in tqdm(existing):
-            bucket.Object(key).delete()
+    if plan.deletes:
+        if input(f"Ok to delete {len(plan.deletes)} old recipes? [yN] ") != "y":
+            return 1 if failed else 0
+        failed.extend(delete_objects(client, args.bucket_name, plan.deletes))
 
+    if failed:
+        print(f"Failed to sync {len(failed)} objects")
+        return 1
     return 0
 
 
+def main(argv: list[str] | None = None) -> int:
+    """Push Sinfonia recipes to an S3 bucket"""
+    args = parse_args(argv)
+
+    # check if source folder exists
+    if not args.RECIPES.is_dir():
+        print(f"Missing {args.RECIPES}")
+        return 1
+
+    # connect to S3
+    creds = json.load(args.aws_creds)
+    client = boto3.client("s3", **creds)
+
+    # make sure bucket exists
+    if args.create and not args.dry_run:
+        try:
+            client.create_bucket(Bucket=args.bucket_name)
+        except client.exceptions.BucketAlreadyOwnedByYou:
+            pass
+        client.get_waiter("bucket_exists").wait(Bucket=args.bucket_name)
+
+    return sync(client, args)
+
+
 if __name__ == "__main__":
     sys.exit(main())
@@ -0,0 +1,152 @@
+#
+# Sinfonia
+#
+# Copyright (c) 2022 Carnegie Mellon University
+#
+# SPDX-License-Identifier: MIT
+#
+"""Push deployment status changes to waiting clients as server-sent events.
+
+Instead of polling the deployment status until the backend is ready, a
+client can keep a single request open and receive an event whenever the
+status changes (Pending -> Installing -> Ready, Suspended, Expired).
+
+The broker is notified by the installer when an install changes state and
+by the peer informer when a deployment Peer changes or is removed. Each
+notification wakes up the streams for that deployment, which then read the
+current status from the in-memory caches and send it when it changed. Missed
+or spurious notifications are harmless, streams also look at the status
+whenever they send a keepalive.
+
+Streams end when the deployment expired, or after a while so that clients
+reconnect and idle connections don't pile up. New streams are refused while
+too many are open. An open stream occupies a server worker (thread) for its
+whole duration, so the limit has to stay well below the number of workers of
+the WSGI server or streams starve the other requests.
+"""
+
+from __future__ import annotations
+
+import json
+import queue
+import threading
+import time
+from typing import TYPE_CHECKING, Any, Callable, Dict, Generator
+
+from attrs import define, field
+
+from .metrics import REGISTRY
+
+if TYPE_CHECKING:
+    from .installer import InstallStatus
+
+EXPIRED = "Expired"
+
+STREAMS = REGISTRY.gauge("sinfonia_status_streams", "Open status event streams")
+EVENTS = REGISTRY.counter("sinfonia_status_events", "Status events sent")
+
+Peer = Dict[str, Any]
+Event = Dict[str, Any]
+EventStream = Generator[str, None, None]
+
+
+class TooManyStreams(Exception):
+    pass
+
+
+def format_event(event: str, data: Any) -> str:
+    """Encode an event in the text/event-stream format."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@define
+class StatusBroker:
+    max_streams: int = 8  # keep below the number of WSGI server workers
+    keepalive: float = 15.0  # seconds between keepalive comments
+    max_duration: float = 600.0  # seconds before a stream is closed
+    clock: Callable[[], float] = time.monotonic
+
+    _subscribers: dict[str, set[queue.SimpleQueue[None]]] = field(
+        init=False, factory=dict
+    )
+    _streams: int = field(init=False, default=0)
+    _lock: threading.Lock = field(init=False, factory=threading.Lock)
+
+    def __attrs_post_init__(self) -> None:
+        STREAMS.set_function(lambda: self._streams)
+
+    def notify(self, name: str) -> None:
+        """Wake up streams of a deployment whose status may have changed."""
+        with self._lock:
+            subscribers = list(self._subscribers.get(name, ()))
+        for subscriber in subscribers:
+            subscriber.put(None)
+
+    def peer_changed(self, old: Peer | None, new: Peer | None) -> None:
+        """PeerInformer listener."""
+        peer = new if new is not None else old
+        if peer is not None:
+            self.notify(peer["metadata"]["name"])
+
+    def install_changed(self, name: str, _status: InstallStatus) -> None:
+        """Installer listener."""
+        self.notify(name)
+
+    def _subscribe(self, name: str) -> queue.SimpleQueue[None]:
+        subscriber: queue.SimpleQueue[None] = queue.SimpleQueue()
+        with self._lock:
+            if self._streams >= self.max_streams:
+                raise TooManyStreams(f"{self._streams} status streams open")
+            self._streams += 1
+            self._subscribers.setdefault(name, set()).add(subscriber)
+        return subscriber
+
+    def _unsubscribe(self, name: str, subscriber: queue.SimpleQueue[None]) -> None:
+        with self._lock:
+            self._streams -= 1
+            subscribers = self._subscribers.get(name, set())
+            subscribers.discard(subscriber)
+            if not subscribers:
+                self._subscribers.pop(name, None)
+
+    def stream(self, name: str, describe: Callable[[], Event]) -> EventStream:
+        """Events whenever the deployment's description, as returned by
+        describe, changes. Starting with the current description and until
+        the deployment expired.
+        Raises TooManyStreams when the limit on open streams was reached.
+        """
+        subscriber = self._subscribe(name)
+        events = self._events(name, describe, subscriber)
+        # run up to the first yield, so closing the stream before it is
+        # iterated still unsubscribes
+        next(events)
+        return events
+
+    def _events(
+        self,
+        name: str,
+        describe: Callable[[], Event],
+        subscriber: queue.SimpleQueue[None],
+    ) -> EventStream:
+        try:
+            yield ""
+            deadline = self.clock() + self.max_duration
+            last = None
+            while True:
+                event = describe()
+                if event != last:
+                    EVENTS.inc()
+                    yield format_event("status", event)
+                    last = event
+                if event["Status"] == EXPIRED:
+                    return
+
+                remaining = deadline - self.clock()
+                if remaining <= 0:
+                    return
+                try:
+                    subscriber.get(timeout=min(self.keepalive, remaining))
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+        finally:
+            self._unsubscribe(name, subscriber)
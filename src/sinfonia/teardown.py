@@ -0,0 +1,275 @@
+#
+# Sinfonia
+#
+# Copyright (c) 2022 Carnegie Mellon University
+#
+# SPDX-License-Identifier: MIT
+#
+"""Remove expired deployments in batches.
+
+Expiring a deployment used to delete its Peer, uninstall the helm release and
+delete the namespace one after another, each waiting for the API server or a
+helm process. When many leases run out at the same time that held up the
+expiry job for minutes. Expired deployments are now queued and a background
+job removes them in batches:
+
+- the Peers of a batch are removed with a single label selector delete,
+  which also immediately stops their tunnels,
+- a single list of helm release secrets tells us which namespaces still
+  hold a helm release, only those are uninstalled with helm,
+- namespaces are deleted with background propagation, so we don't wait for
+  the garbage collector to remove their contents.
+
+Helm uninstalls and namespace deletes run concurrently on a bounded pool of
+workers. Failed deployments are retried with exponential backoff, only
+repeating the steps that did not complete yet. After a few attempts they are
+handed back to the lease scheduler, so they expire again later, as long as
+their Peer still exists. Once its Peer is deleted a deployment can no longer
+be cancelled, and it can't be deployed again until the removal is done and
+its namespace has actually disappeared, installing into a namespace that is
+still terminating fails.
+"""
+
+from __future__ import annotations
+
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Callable, Iterable
+
+from attrs import define, evolve, field
+from plumbum.commands.processes import ProcessExecutionError
+from requests.exceptions import RequestException
+
+from .ipam import address_to_k8s_label
+from .kube_client import NAMESPACES, PEERS
+from .metrics import REGISTRY
+from .peer_informer import DEPLOYMENT_SELECTOR
+
+if TYPE_CHECKING:
+    from .cluster import Cluster
+    from .deployment import Deployment
+
+logger = logging.getLogger(__name__)
+
+SECRETS = "/api/v1/secrets"
+
+TEARDOWNS = REGISTRY.counter(
+    "sinfonia_teardowns", "Deployment teardowns by outcome", ["result"]
+)
+TEARDOWN_QUEUE = REGISTRY.gauge(
+    "sinfonia_teardown_queue_depth", "Deployments waiting to be torn down"
+)
+BATCH_TIME = REGISTRY.histogram(
+    "sinfonia_teardown_batch_seconds", "Time taken to tear down a batch"
+)
+
+
+class TeardownInProgress(Exception):
+    """The deployment is being removed and can't be deployed again yet."""
+
+
+@define(frozen=True)
+class TeardownItem:
+    name: str
+    namespace: str
+    client: str  # client address label, unique among existing peers
+    attempts: int = 0
+    not_before: float = 0.0
+    # the Peer is gone, retries only remove the backend
+    peer_deleted: bool = False
+
+
+@define
+class Teardown:
+    cluster: Cluster
+    max_workers: int = 4
+    batch_size: int = 50
+    max_attempts: int = 5
+    retry_delay: float = 10.0  # seconds, doubled on every attempt
+    clock: Callable[[], float] = time.monotonic
+
+    # queued teardowns by deployment name, in submission order
+    _queue: dict[str, TeardownItem] = field(init=False, factory=dict)
+    # deployment names in the batch that is being torn down
+    _removing: set[str] = field(init=False, factory=set)
+    # namespaces by deployment name that were deleted but may still exist
+    _terminating: dict[str, str] = field(init=False, factory=dict)
+    _lock: threading.Lock = field(init=False, factory=threading.Lock)
+    _executor: ThreadPoolExecutor = field(init=False)
+
+    def __attrs_post_init__(self) -> None:
+        TEARDOWN_QUEUE.set_function(lambda: len(self._queue))
+
+    @_executor.default
+    def _default_executor(self) -> ThreadPoolExecutor:
+        return ThreadPoolExecutor(
+            max_workers=self.max_workers, thread_name_prefix="teardown"
+        )
+
+    def __len__(self) -> int:
+        return len(self._queue)
+
+    def __contains__(self, name: object) -> bool:
+        return name in self._queue
+
+    def submit(self, deployment: Deployment) -> None:
+        """Queue an expired deployment for removal."""
+        with self._lock:
+            if deployment.name in self._queue:
+                return
+            self._queue[deployment.name] = TeardownItem(
+                deployment.name,
+                deployment.namespace,
+                address_to_k8s_label(deployment.client_ip),
+            )
+
+    def cancel(self, name: str) -> bool:
+        """Keep a deployment that was queued but not yet torn down, returns
+        False when it wasn't queued or removal already started."""
+        with self._lock:
+            item = self._queue.get(name)
+            if item is None or item.peer_deleted:
+                return False
+            del self._queue[name]
+            return True
+
+    def removing(self, name: str) -> bool:
+        """Removal of the deployment started and has not completed yet, or
+        its namespace is still terminating."""
+        with self._lock:
+            item = self._queue.get(name)
+            if name in self._removing or (item is not None and item.peer_deleted):
+                return True
+            namespace = self._terminating.get(name)
+        return namespace is not None and self._still_terminating(name, namespace)
+
+    def _still_terminating(self, name: str, namespace: str) -> bool:
+        try:
+            if self.cluster.api.exists(f"{NAMESPACES}/{namespace}"):
+                return True
+        except RequestException as e:
+            logger.warning(f"Failed to check namespace {namespace}: {e!r}")
+            return True
+        with self._lock:
+            if self._terminating.get(name) == namespace:
+                del self._terminating[name]
+        return False
+
+    def _reap(self) -> None:
+        """Forget deleted namespaces that have disappeared."""
+        with self._lock:
+            terminating = list(self._terminating.items())
+        for name, namespace in terminating:
+            self._still_terminating(name, namespace)
+
+    def _take(self) -> list[TeardownItem]:
+        now = self.clock()
+        with self._lock:
+            ready = [item for item in self._queue.values() if item.not_before <= now]
+            batch = ready[: self.batch_size]
+            for item in batch:
+                del self._queue[item.name]
+                self._removing.add(item.name)
+        return batch
+
+    def _done(self, item: TeardownItem) -> None:
+        with self._lock:
+            self._removing.discard(item.name)
+            self._terminating[item.name] = item.namespace
+        TEARDOWNS.inc(result="removed")
+
+    def _retry(self, item: TeardownItem, error: Exception) -> None:
+        with self._lock:
+            self._removing.discard(item.name)
+        attempts = item.attempts + 1
+        if attempts >= self.max_attempts:
+            logger.error(f"Giving up on tearing down {item.name}: {error!r}")
+            TEARDOWNS.inc(result="failed")
+            # expire it again later, a no-op when its Peer is already gone
+            leases = self.cluster.leases
+            leases.schedule(item.name, leases.clock() + self.retry_delay * 2**attempts)
+            return
+        logger.warning(f"Failed to tear down {item.name}, will retry: {error!r}")
+        delay = self.retry_delay * 2 ** (attempts - 1)
+        with self._lock:
+            self._queue.setdefault(
+                item.name,
+                evolve(item, attempts=attempts, not_before=self.clock() + delay),
+            )
+
+    def run(self) -> None:
+        """Tear down queued deployments until none are ready to go."""
+        self._reap()
+        while True:
+            batch = self._take()
+            if not batch:
+                return
+            start = self.clock()
+            self._teardown(batch)
+            BATCH_TIME.observe(self.clock() - start)
+
+    def _delete_peers(self, batch: Iterable[TeardownItem]) -> None:
+        clients = ",".join(item.client for item in batch)
+        self.cluster.api.delete_collection(
+            PEERS, f"{DEPLOYMENT_SELECTOR},findcloudlet.org/client in ({clients})"
+        )
+
+    def _helm_releases(self, batch: Iterable[TeardownItem]) -> set[str]:
+        """Namespaces of the batch that contain a helm release, by listing
+        helm's release secrets."""
+        namespaces = {item.namespace for item in batch}
+        try:
+            secrets = self.cluster.api.list(
+                SECRETS, label_selector=f"owner=helm,name in ({','.join(namespaces)})"
+            )
+        except RequestException as e:
+            logger.warning(f"Failed to list helm releases: {e!r}")
+            return namespaces
+        return {
+            secret["metadata"]["namespace"]
+            for secret in secrets["items"]
+            if secret["metadata"]["namespace"] in namespaces
+        }
+
+    def _remove(self, item: TeardownItem, helm_release: bool) -> None:
+        if helm_release:
+            self.cluster.helm(
+                "uninstall", "--namespace", item.namespace, item.namespace
+            )
+        self.cluster.api.delete(
+            f"{NAMESPACES}/{item.namespace}", propagationPolicy="Background"
+        )
+
+    def _teardown(self, batch: list[TeardownItem]) -> None:
+        logger.info(f"Tearing down {len(batch)} deployments")
+        deleted = [item for item in batch if item.peer_deleted]
+        pending = [item for item in batch if not item.peer_deleted]
+        if pending:
+            try:
+                self._delete_peers(pending)
+            except RequestException as e:
+                for item in pending:
+                    self._retry(item, e)
+            else:
+                for item in pending:
+                    self.cluster.informer.remove(item.name)
+                    if self.cluster.installer is not None:
+                        self.cluster.installer.forget(item.name)
+                deleted.extend(evolve(item, peer_deleted=True) for item in pending)
+        if not deleted:
+            return
+
+        releases = self._helm_releases(deleted)
+        futures = {
+            item: self._executor.submit(self._remove, item, item.namespace in releases)
+            for item in deleted
+        }
+        for item, future in futures.items():
+            try:
+                future.result()
+            except (RequestException, ProcessExecutionError) as e:
+                self._retry(item, e)
+            else:
+                self._done(item)
@@ -0,0 +1,309 @@
+#
+# Sinfonia
+#
+# Copyright (c) 2022 Carnegie Mellon University
+#
+# SPDX-License-Identifier: MIT
+#
+"""Pool of pre-provisioned backends for frequently used recipes.
+
+A cold deploy has to create a namespace, install the helm chart and wait for
+images to be pulled and pods to start. For recipes with a configured warm
+pool we keep a number of namespaces with the chart already installed, a new
+deployment claims one of those and a replacement is provisioned in the
+background.
+
+The pool lives in the cluster, warm namespaces are labeled with the recipe
+UUID and their state (installing, ready, claimed, failed). A namespace is
+claimed by updating its state label with a resourceVersion precondition, so
+concurrent claims (even from multiple Tier2 instances) can never hand out the
+same backend twice.
+
+The number of warm backends adapts to recent demand, enough to cover the
+claims we expect during the time it takes to provision a replacement, bound
+by the configured minimum and maximum. No new backends are provisioned while
+the cluster is short on cpu, memory or gpu. Charts of new backends are
+installed on a few background workers, so a refill doesn't wait for them.
+Namespaces that are still installing after `install_timeout`, but that none
+of our workers is installing, were abandoned (e.g. by a restart) and are
+removed.
+"""
+
+from __future__ import annotations
+
+import logging
+import math
+import secrets
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import TYPE_CHECKING, Any, Callable, Deque
+from uuid import UUID
+
+from attrs import define, field
+from requests.exceptions import RequestException
+
+from .deployment import install_chart
+from .deployment_recipe import DeploymentRecipe
+from .kube_client import NAMESPACES, KubeApiError
+from .metrics import REGISTRY
+from .node_resources import over_utilized
+
+if TYPE_CHECKING:
+    from .cluster import Cluster
+    from .deployment import Deployment
+
+logger = logging.getLogger(__name__)
+
+WARM_LABEL = "findcloudlet.org/warm"
+STATE_LABEL = "findcloudlet.org/state"
+CLAIMED_BY = "findcloudlet.org/claimed-by"
+
+INSTALLING = "installing"
+READY = "ready"
+CLAIMED = "claimed"
+FAILED = "failed"
+
+# window over which we measure demand for a recipe
+DEMAND_WINDOW = 600  # seconds
+
+# don't provision warm backends when the cluster is busier than this
+MAX_UTILIZATION = 0.8
+
+CLAIMS = REGISTRY.counter(
+    "sinfonia_warm_pool_claims", "Deploys by warm pool outcome", ["uuid", "result"]
+)
+POOL_SIZE = REGISTRY.gauge(
+    "sinfonia_warm_pool_size", "Warm backends by state", ["uuid", "state"]
+)
+
+
+def _state(namespace: dict[str, Any]) -> str:
+    return namespace["metadata"].get("labels", {}).get(STATE_LABEL, "")
+
+
+@define
+class WarmPool:
+    cluster: Cluster
+    min_sizes: dict[UUID, int] = field(factory=dict)  # configured per recipe
+    max_size: int = 4
+    provision_time: float = 120.0  # initial estimate, in seconds
+    max_workers: int = 2  # concurrent installs of warm backends
+    install_timeout: float = 1800.0  # seconds before installs are abandoned
+    clock: Callable[[], float] = time.monotonic
+
+    _demand: dict[UUID, Deque[float]] = field(init=False, factory=dict)
+    # namespaces our workers are installing
+    _installing: set[str] = field(init=False, factory=set)
+    # when we first saw other namespaces in the installing state
+    _first_seen: dict[str, float] = field(init=False, factory=dict)
+    _lock: threading.Lock = field(init=False, factory=threading.Lock)
+    _executor: ThreadPoolExecutor = field(init=False)
+
+    @_executor.default
+    def _default_executor(self) -> ThreadPoolExecutor:
+        return ThreadPoolExecutor(
+            max_workers=self.max_workers, thread_name_prefix="warm-pool"
+        )
+
+    def __contains__(self, uuid: object) -> bool:
+        return uuid in self.min_sizes
+
+    def _record_demand(self, uuid: UUID) -> None:
+        now = self.clock()
+        with self._lock:
+            demand = self._demand.setdefault(uuid, deque())
+            demand.append(now)
+            while demand and demand[0] < now - DEMAND_WINDOW:
+                demand.popleft()
+
+    def target(self, uuid: UUID) -> int:
+        """Number of warm backends to keep for a recipe."""
+        now = self.clock()
+        with self._lock:
+            recent = [t for t in self._demand.get(uuid, ()) if t >= now - DEMAND_WINDOW]
+        rate = len(recent) / DEMAND_WINDOW
+        expected = math.ceil(rate * self.provision_time)
+        return min(self.max_size, max(self.min_sizes.get(uuid, 0), expected))
+
+    def _list(self, uuid: UUID, state: str = "") -> list[dict[str, Any]]:
+        selector = f"{WARM_LABEL}={uuid}"
+        if state:
+            selector += f",{STATE_LABEL}={state}"
+        namespaces = self.cluster.api.list(NAMESPACES, label_selector=selector)
+        return sorted(
+            namespaces["items"], key=lambda ns: ns["metadata"]["creationTimestamp"]
+        )
+
+    def _set_state(
+        self, namespace: dict[str, Any], state: str, claimed_by: str | None = None
+    ) -> dict[str, Any]:
+        """Update state, fails with a 409 conflict when the namespace changed
+        since we read it."""
+        metadata = namespace["metadata"]
+        return self.cluster.api.patch(
+            f"{NAMESPACES}/{metadata['name']}",
+            {
+                "metadata": {
+                    "resourceVersion": metadata["resourceVersion"],
+                    "labels": {STATE_LABEL: state},
+                    "annotations": {CLAIMED_BY: claimed_by},
+                }
+            },
+        )
+
+    def claim(self, deployment: Deployment) -> bool:
+        """Try to bind a ready warm backend to the deployment."""
+        uuid = deployment.uuid
+        if uuid not in self:
+            return False
+
+        self._record_demand(uuid)
+        try:
+            for namespace in self._list(uuid, READY):
+                try:
+                    self._set_state(namespace, CLAIMED, deployment.name)
+                except KubeApiError as e:
+                    if e.conflict:
+                        continue  # somebody else got it first
+                    raise
+                deployment.namespace = namespace["metadata"]["name"]
+                logger.info(f"Claimed {deployment.namespace} for {deployment.name}")
+                CLAIMS.inc(uuid=str(uuid), result="hit")
+                return True
+        except RequestException:
+            logger.exception(f"Failed to claim warm backend for {uuid}")
+
+        CLAIMS.inc(uuid=str(uuid), result="miss")
+        return False
+
+    def unclaim(self, deployment: Deployment) -> None:
+        """Return a claimed backend to the pool when the deploy failed."""
+        try:
+            namespace = self.cluster.api.get(f"{NAMESPACES}/{deployment.namespace}")
+            self._set_state(namespace, READY)
+        except RequestException:
+            logger.exception(f"Failed to return {deployment.namespace} to the pool")
+        deployment.namespace = deployment.name
+
+    def provision(self, recipe: DeploymentRecipe) -> Future[None]:
+        """Create a namespace and install the recipe's chart into it in the
+        background, the namespace counts as installing until it is done."""
+        name = f"sinfonia-warm-{secrets.token_hex(5)}"
+        namespace = self.cluster.api.create(
+            NAMESPACES,
+            {
+                "apiVersion": "v1",
+                "kind": "Namespace",
+                "metadata": {
+                    "name": name,
+                    "labels": {WARM_LABEL: str(recipe.uuid), STATE_LABEL: INSTALLING},
+                },
+            },
+        )
+
+        name = namespace["metadata"]["name"]
+        logger.info(f"Provisioning warm backend {name} for {recipe.uuid}")
+        with self._lock:
+            self._installing.add(name)
+        return self._executor.submit(self._install, recipe, name)
+
+    def _install(self, recipe: DeploymentRecipe, name: str) -> None:
+        start = self.clock()
+        try:
+            install_chart(self.cluster, recipe, name, wait=True)
+        except Exception:
+            logger.exception(f"Failed to provision {name}")
+            state = FAILED
+        else:
+            # provisioning time is used to estimate how many we need
+            self.provision_time += 0.2 * (self.clock() - start - self.provision_time)
+            state = READY
+
+        # installing may have updated the namespace, so read it again
+        try:
+            self._set_state(self.cluster.api.get(f"{NAMESPACES}/{name}"), state)
+        except RequestException:
+            logger.exception(f"Failed to mark {name} as {state}")
+        finally:
+            with self._lock:
+                self._installing.discard(name)
+
+    def remove(self, namespace: dict[str, Any]) -> None:
+        name = namespace["metadata"]["name"]
+        self.cluster.helm("uninstall", "--namespace", name, name, retcode=None)
+        self.cluster.api.delete(f"{NAMESPACES}/{name}")
+
+    def _abandoned(self, namespace: dict[str, Any], now: float) -> bool:
+        """Installing, but not by us, for longer than the install timeout."""
+        name = namespace["metadata"]["name"]
+        with self._lock:
+            if name in self._installing:
+                return False
+            first_seen = self._first_seen.setdefault(name, now)
+        return now - first_seen >= self.install_timeout
+
+    def _over_capacity(self) -> bool:
+        return over_utilized(self.cluster.get_resources(), MAX_UTILIZATION)
+
+    def refill(self) -> None:
+        """Provision or remove warm backends to match the target pool sizes."""
+        over_capacity = None
+        now = self.clock()
+        seen_installing = set()
+        for uuid in list(self.min_sizes):
+            namespaces = self._list(uuid)
+            by_state: dict[str, list[dict[str, Any]]] = {}
+            for namespace in namespaces:
+                by_state.setdefault(_state(namespace), []).append(namespace)
+
+            for state in (INSTALLING, READY, CLAIMED, FAILED):
+                POOL_SIZE.set(len(by_state.get(state, [])), uuid=str(uuid), state=state)
+
+            for namespace in by_state.get(FAILED, []):
+                self.remove(namespace)
+
+            installing = []
+            for namespace in by_state.get(INSTALLING, []):
+                seen_installing.add(namespace["metadata"]["name"])
+                if self._abandoned(namespace, now):
+                    logger.warning(
+                        f"Removing abandoned {namespace['metadata']['name']}"
+                    )
+                    self.remove(namespace)
+                else:
+                    installing.append(namespace)
+
+            ready = by_state.get(READY, [])
+            pooled = len(ready) + len(installing)
+            target = self.target(uuid)
+
+            # shrink, oldest first, when demand went down
+            for namespace in ready[: max(0, pooled - target)]:
+                self.remove(namespace)
+
+            if pooled >= target:
+                continue
+
+            if over_capacity is None:
+                over_capacity = self._over_capacity()
+            if over_capacity:
+                logger.info("Cluster resources low, not provisioning warm backends")
+                break
+
+            try:
+                recipe = DeploymentRecipe.from_uuid(uuid)
+            except ValueError:
+                logger.warning(f"Unable to find recipe for warm pool {uuid}")
+                continue
+
+            for _ in range(target - pooled):
+                self.provision(recipe)
+
+        with self._lock:
+            self._first_seen = {
+                name: first_seen
+                for name, first_seen in self._first_seen.items()
+                if name in seen_installing
+            }
@@ -0,0 +1,144 @@
+# Copyright (c) 2022 Carnegie Mellon University
+# SPDX-License-Identifier: MIT
+
+from uuid import uuid4
+
+import pytest
+from requests.exceptions import HTTPError
+
+from sinfonia.chart_cache import REQUESTS, ChartCache
+from sinfonia.deployment_recipe import DeploymentRecipe
+from sinfonia.deployment_repository import DeploymentRepository
+
+
+def make_recipe(repository, chart="example", version="0.1.0"):
+    return DeploymentRecipe(
+        repository=repository,
+        uuid=uuid4(),
+        description=None,
+        chart=chart,
+        version=version,
+        values={},
+        restricted=False,
+    )
+
+
+@pytest.fixture
+def remote():
+    return DeploymentRepository("http://test/")
+
+
+def test_get(tmp_path, remote, requests_mock):
+    chart = requests_mock.get("http://test/example-0.1.0.tgz", content=b"chart")
+    cache = ChartCache(tmp_path)
+    hits = REQUESTS.value(result="hit")
+
+    path = cache.get(make_recipe(remote))
+    assert path.read_bytes() == b"chart"
+    assert path.parent == tmp_path
+
+    assert cache.get(make_recipe(remote)) == path
+    assert chart.call_count == 1
+    assert REQUESTS.value(result="hit") == hits + 1
+
+    # charts with identical contents are stored once
+    requests_mock.get("http://test/other-0.1.0.tgz", content=b"chart")
+    assert cache.get(make_recipe(remote, chart="other")) == path
+    assert list(tmp_path.iterdir()) == [path]
+
+
+def test_get_local(tmp_path, repository, good_uuid):
+    recipe = DeploymentRecipe.from_repo(repository, good_uuid)
+    assert str(ChartCache(tmp_path).get(recipe)) == recipe.chart_ref.path
+
+
+def test_download_failed(tmp_path, remote, requests_mock):
+    requests_mock.get("http://test/example-0.1.0.tgz", status_code=404)
+    cache = ChartCache(tmp_path)
+
+    with pytest.raises(HTTPError):
+        cache.get(make_recipe(remote))
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_evict_lru(tmp_path, remote, requests_mock):
+    for version in ("1", "2", "3"):
+        requests_mock.get(
+            f"http://test/example-{version}.tgz", content=version.encode() * 10
+        )
+    cache = ChartCache(tmp_path, max_size=25)
+
+    first = cache.get(make_recipe(remote, version="1"))
+    cache.get(make_recipe(remote, version="2"))
+    cache.get(make_recipe(remote, version="1"))
+    cache.get(make_recipe(remote, version="3"))
+
+    assert cache.size == 20
+    assert first.exists()
+    assert len(list(tmp_path.iterdir())) == 2
+
+    # existing charts are picked up by a new cache
+    assert ChartCache(tmp_path).size == 20
+
+
+def test_revalidate(tmp_path, remote, requests_mock):
+    now = [0.0]
+    url = "http://test/example-0.0.0.tgz"
+    chart = requests_mock.get(url, content=b"chart", headers={"ETag": '"1"'})
+    cache = ChartCache(tmp_path, ttl=60, clock=lambda: now[0])
+
+    path = cache.get(make_recipe(remote, version="0.0.0"))
+    now[0] = 61
+    requests_mock.get(url, status_code=304)
+    assert cache.get(make_recipe(remote, version="0.0.0")) == path
+    assert chart.called_once
+    assert requests_mock.last_request.headers["If-None-Match"] == '"1"'
+
+    # republished under the same version
+    now[0] = 122
+    requests_mock.get(url, content=b"fixed", headers={"ETag": '"2"'})
+    path = cache.get(make_recipe(remote, version="0.0.0"))
+    assert path.read_bytes() == b"fixed"
+
+    # the cached chart is used while the repository is unreachable
+    now[0] = 183
+    requests_mock.get(url, status_code=503)
+    assert cache.get(make_recipe(remote, version="0.0.0")) == path
+
+
+def test_no_eviction_while_in_use(tmp_path, remote, requests_mock):
+    for version in ("1", "2", "3"):
+        requests_mock.get(
+            f"http://test/example-{version}.tgz", content=version.encode() * 10
+        )
+    cache = ChartCache(tmp_path, max_size=15)
+
+    with cache.use(make_recipe(remote, version="1")) as first:
+        cache.get(make_recipe(remote, version="2"))
+        cache.get(make_recipe(remote, version="3"))
+        assert first.exists()
+    assert not first.exists()
+    assert cache.size == 10
+
+
+def test_evicted_before_hold(tmp_path, remote, requests_mock, mocker):
+    chart = requests_mock.get("http://test/example-1.tgz", content=b"chart")
+    cache = ChartCache(tmp_path)
+    download = ChartCache._download
+
+    def download_then_evict(self, recipe):
+        digest = download(self, recipe)
+        if chart.call_count == 1:
+            # a concurrent download evicts the blob before it is held
+            with self._lock:
+                self._blobs.pop(digest)
+                self._path(digest).unlink()
+        return digest
+
+    mocker.patch.object(
+        ChartCache, "_download", autospec=True, side_effect=download_then_evict
+    )
+
+    with cache.use(make_recipe(remote, version="1")) as path:
+        assert path.read_bytes() == b"chart"
+    assert chart.call_count == 2
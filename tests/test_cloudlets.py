@@ -1,15 +1,21 @@
 # Copyright (c) 2022 Carnegie Mellon University
 # SPDX-License-Identifier: MIT
 
+from concurrent.futures import ThreadPoolExecutor
 from io import StringIO
-from ipaddress import IPv4Network
+from ipaddress import IPv4Network, ip_address
+from uuid import UUID
 
 import pytest
 from jsonschema import ValidationError
+from wireguard_tools import WireguardKey
 
 from sinfonia import cloudlets
+from sinfonia.client_info import ClientInfo
 from sinfonia.geo_location import GeoLocation
 
+from .conftest import GOOD_UUID
+
 
 class TestValidation:
     def load(self, string):
@@ -91,3 +97,44 @@ locations:
             for config in failures:
                 with pytest.raises(ValidationError):
                     self.load(config)
+
+
+class TestDeploy:
+    @pytest.fixture
+    def cloudlet(self, flask_app):
+        with flask_app.app_context(), ThreadPoolExecutor(1) as executor:
+            flask_app.config["executor"] = executor
+            yield self.load("endpoint: http://cloudlet/api/v1/deploy")
+            del flask_app.config["executor"]
+
+    def load(self, string):
+        return cloudlets.load(StringIO(string))[0]
+
+    def test_deploy(self, cloudlet, example_wgkey, requests_mock):
+        client_info = ClientInfo(WireguardKey(example_wgkey), ip_address("::1"), None)
+        url = (
+            f"http://cloudlet/api/v1/deploy/{GOOD_UUID}/{client_info.publickey.urlsafe}"
+        )
+
+        requests_mock.post(url, json=[{"UUID": GOOD_UUID}])
+        result = cloudlet.deploy_async(UUID(GOOD_UUID), client_info).result()
+        assert result == [{"UUID": GOOD_UUID, "Cloudlet": str(cloudlet.uuid)}]
+
+        requests_mock.post(url, status_code=500)
+        assert cloudlet.deploy_async(UUID(GOOD_UUID), client_info).result() == []
+
+    def test_busy(self, cloudlet, example_wgkey, requests_mock):
+        client_info = ClientInfo(WireguardKey(example_wgkey), ip_address("::1"), None)
+        url = (
+            f"http://cloudlet/api/v1/deploy/{GOOD_UUID}/{client_info.publickey.urlsafe}"
+        )
+
+        requests_mock.post(url, status_code=503, headers={"Retry-After": "7"})
+        with pytest.raises(cloudlets.CloudletBusy) as e:
+            cloudlet.deploy_async(UUID(GOOD_UUID), client_info).result()
+        assert e.value.retry_after == 7
+
+        requests_mock.post(url, status_code=503)
+        with pytest.raises(cloudlets.CloudletBusy) as e:
+            cloudlet.deploy_async(UUID(GOOD_UUID), client_info).result()
+        assert e.value.retry_after == cloudlets.DEFAULT_RETRY_AFTER
@@ -0,0 +1,77 @@
+# Copyright (c) 2022 Carnegie Mellon University
+# SPDX-License-Identifier: MIT
+
+from ipaddress import ip_address
+
+import pytest
+from wireguard_tools import WireguardKey
+from yarl import URL
+
+from sinfonia.cluster_metadata import (
+    KILO_ENDPOINT,
+    KILO_KEY,
+    KILO_LEADER,
+    MetadataCache,
+    MetadataUnavailable,
+)
+from sinfonia.kube_client import KUBE_DNS, NODES, KubeClient
+
+SERVER = "https://cluster.example:6443"
+
+
+def make_node(key, endpoint="", leader=False):
+    annotations = {KILO_KEY: str(key), KILO_ENDPOINT: endpoint}
+    if leader:
+        annotations[KILO_LEADER] = "true"
+    return {"metadata": {"annotations": annotations}}
+
+
+@pytest.fixture
+def api():
+    return KubeClient(URL(SERVER))
+
+
+def test_metadata(api, requests_mock):
+    keys = [WireguardKey.generate().public_key() for _ in range(3)]
+    requests_mock.get(
+        f"{SERVER}{NODES}",
+        [
+            {
+                "json": {
+                    "items": [
+                        {"metadata": {}},
+                        make_node(keys[0], "10.0.0.1:51820"),
+                        make_node(keys[1], "10.0.0.2:51820", leader=True),
+                    ]
+                }
+            },
+            {"json": {"items": [make_node(keys[2], "10.0.0.3:51820")]}},
+        ],
+    )
+    requests_mock.get(f"{SERVER}{KUBE_DNS}", json={"spec": {"clusterIP": "10.96.0.10"}})
+
+    clock = [0.0]
+    cache = MetadataCache(api, max_age=300, clock=lambda: clock[0])
+    metadata = cache.get()
+    assert metadata.tunnel_public_key == keys[1]
+    assert metadata.tunnel_endpoint == "10.0.0.2:51820"
+    assert metadata.kubedns_address == ip_address("10.96.0.10")
+    assert cache.get() is metadata
+
+    # rotated key is picked up once the metadata is out of date
+    clock[0] += 300
+    assert cache.get().tunnel_public_key == keys[2]
+
+
+def test_metadata_unavailable(api, requests_mock):
+    requests_mock.get(f"{SERVER}{NODES}", json={"items": [{"metadata": {}}]})
+    requests_mock.get(f"{SERVER}{KUBE_DNS}", json={"spec": {"clusterIP": "10.96.0.10"}})
+
+    cache = MetadataCache(api)
+    assert cache.refresh() is None
+    with pytest.raises(MetadataUnavailable):
+        cache.get()
+
+    requests_mock.get(f"{SERVER}{NODES}", status_code=503)
+    with pytest.raises(MetadataUnavailable):
+        cache.get()
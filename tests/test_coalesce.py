@@ -0,0 +1,63 @@
+# Copyright (c) 2022 Carnegie Mellon University
+# SPDX-License-Identifier: MIT
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from sinfonia.coalesce import COALESCED, Coalescer
+
+
+def test_coalesce_same_key():
+    coalescer: Coalescer[int] = Coalescer("test-same")
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def operation():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return len(calls)
+
+    with ThreadPoolExecutor(4) as executor:
+        leader = executor.submit(coalescer.run, "key", operation)
+        started.wait(5)
+        waiters = [executor.submit(coalescer.run, "key", operation) for _ in range(3)]
+        while COALESCED.value(operation="test-same") < 3:
+            threading.Event().wait(0.01)
+        release.set()
+
+        assert leader.result() == 1
+        assert [waiter.result() for waiter in waiters] == [1, 1, 1]
+
+    assert len(calls) == 1
+    assert len(coalescer) == 0
+
+
+def test_different_keys_run_in_parallel():
+    coalescer: Coalescer[str] = Coalescer("test-parallel")
+    barrier = threading.Barrier(2, timeout=5)
+
+    def operation(key):
+        barrier.wait()
+        return key
+
+    with ThreadPoolExecutor(2) as executor:
+        a = executor.submit(coalescer.run, "a", lambda: operation("a"))
+        b = executor.submit(coalescer.run, "b", lambda: operation("b"))
+        assert (a.result(), b.result()) == ("a", "b")
+
+
+def test_errors_are_not_cached():
+    coalescer: Coalescer[None] = Coalescer("test-error")
+
+    def operation():
+        raise RuntimeError("failed")
+
+    with pytest.raises(RuntimeError):
+        coalescer.run("key", operation)
+
+    # a failed operation is not cached
+    assert coalescer.run("key", lambda: None) is None
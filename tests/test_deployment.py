@@ -0,0 +1,219 @@
+# Copyright (c) 2022 Carnegie Mellon University
+# SPDX-License-Identifier: MIT
+
+import re
+from ipaddress import ip_address
+from types import SimpleNamespace
+from typing import Any, Dict
+
+import pytest
+from wireguard_tools import WireguardKey
+from yarl import URL
+
+from sinfonia.deployment import (
+    REPLICAS,
+    SUSPENDED,
+    Deployment,
+    chart_file,
+    deployment_name,
+)
+from sinfonia.deployment_recipe import DeploymentRecipe
+from sinfonia.deployment_repository import DeploymentRepository
+from sinfonia.installer import FAILED, READY, Installer
+from sinfonia.ipam import ClientAddressPool
+from sinfonia.kube_client import NAMESPACES, PEERS, KubeApiError, KubeClient
+from sinfonia.peer_informer import PeerInformer
+from sinfonia.s3_client import S3Endpoint
+from sinfonia.teardown import TeardownInProgress
+
+SERVER = "https://cluster.example:6443"
+
+
+@pytest.fixture
+def cluster(mocker):
+    """Enough of a Cluster to deploy, without depending on the helm binary."""
+    api = KubeClient(URL(SERVER))
+    ipam = ClientAddressPool("10.5.0.0/16")
+    return SimpleNamespace(
+        api=api,
+        ipam=ipam,
+        informer=PeerInformer(api, listeners=[ipam.peer_changed]),
+        helm=mocker.MagicMock(),
+        installer=None,
+        warm_pool=None,
+        teardown=None,
+        charts=None,
+        manifests=None,
+        placement=lambda recipe: None,
+        get_unique_client_address=ipam.allocate,
+    )
+
+
+@pytest.fixture
+def recipe(flask_app, repository, good_uuid):
+    with flask_app.app_context():
+        flask_app.config["deployment_repository"] = repository
+        yield DeploymentRecipe.from_repo(repository, good_uuid)
+
+
+def test_deployment_name(good_uuid, example_wgkey):
+    key = WireguardKey(example_wgkey)
+    name = deployment_name(good_uuid, key)
+
+    assert name == deployment_name(good_uuid, key)
+    assert name != deployment_name(good_uuid, WireguardKey.generate())
+    assert re.fullmatch(r"[a-z]([-a-z0-9]{0,51}[a-z0-9])?", name)
+
+
+def test_chart_file(cluster, recipe, requests_mock):
+    with chart_file(cluster, recipe) as chart:
+        assert chart == str(recipe.chart_ref)
+
+    # helm can't fetch from s3 by itself
+    repository = DeploymentRepository("s3://bucket/charts", s3=S3Endpoint())
+    requests_mock.get(
+        "https://bucket.s3.us-east-1.amazonaws.com/charts/example-0.1.0.tgz",
+        content=b"chart",
+    )
+    s3_recipe = DeploymentRecipe.from_yaml(
+        repository, recipe.uuid, "chart: example\nversion: 0.1.0\n"
+    )
+    with chart_file(cluster, s3_recipe) as chart:
+        assert open(chart, "rb").read() == b"chart"
+
+
+def test_deploy(cluster, recipe, example_wgkey, requests_mock):
+    deployment = Deployment.from_recipe(cluster, recipe, WireguardKey(example_wgkey))
+    requests_mock.get(f"{SERVER}{PEERS}/{deployment.name}", status_code=404)
+    requests_mock.post(f"{SERVER}{PEERS}", json=deployment.peer_manifest())
+
+    assert deployment.deploy() is deployment
+    assert requests_mock.last_request.json()["metadata"]["name"] == deployment.name
+    assert cluster.helm.call_args.args[0] == "install"
+    assert deployment.client_ip in cluster.ipam
+
+
+def test_deploy_conflict(cluster, recipe, example_wgkey, requests_mock):
+    key = WireguardKey(example_wgkey)
+    existing = Deployment(
+        cluster=cluster, recipe=recipe, client_public_key=key, client_ip="10.5.0.9"
+    )
+    deployment = Deployment.from_recipe(cluster, recipe, key)
+    assert deployment.name == existing.name
+
+    peer = f"{SERVER}{PEERS}/{deployment.name}"
+    requests_mock.get(peer, [{"status_code": 404}, {"json": existing.peer_manifest()}])
+    requests_mock.post(f"{SERVER}{PEERS}", status_code=409, json={"reason": "exists"})
+
+    winner = deployment.deploy()
+    assert winner.client_ip == ip_address("10.5.0.9")
+    assert deployment.client_ip not in cluster.ipam
+    cluster.helm.assert_not_called()
+
+
+def test_deploy_async(cluster, recipe, example_wgkey, requests_mock, mocker):
+    cluster.installer = Installer(max_workers=1)
+    submit = mocker.spy(Installer, "submit")
+    deployment = Deployment.from_recipe(cluster, recipe, WireguardKey(example_wgkey))
+    peer = f"{SERVER}{PEERS}/{deployment.name}"
+    requests_mock.get(peer, status_code=404)
+    requests_mock.post(f"{SERVER}{PEERS}", json=deployment.peer_manifest())
+
+    cluster.helm.side_effect = [RuntimeError("helm failed"), None]
+    deployment.deploy()
+    submit.spy_return.result()
+    requests_mock.get(peer, json=deployment.peer_manifest())
+    assert deployment.status() == FAILED
+    assert "--wait" in cluster.helm.call_args.args
+
+    # deploying again retries the failed install
+    assert deployment.deploy() is deployment
+    submit.spy_return.result()
+    assert deployment.status() == READY
+    assert cluster.helm.call_count == 2
+
+
+def test_suspend_resume(cluster, recipe, example_wgkey, requests_mock):
+    deployment = Deployment.from_recipe(cluster, recipe, WireguardKey(example_wgkey))
+    peer = f"{SERVER}{PEERS}/{deployment.name}"
+    apps = f"{SERVER}/apis/apps/v1/namespaces/{deployment.namespace}"
+    backend: Dict[str, Any] = {"metadata": {"name": "backend"}, "spec": {"replicas": 2}}
+    requests_mock.get(f"{apps}/deployments", json={"items": [backend]})
+    requests_mock.get(f"{apps}/statefulsets", json={"items": []})
+    scale = requests_mock.patch(f"{apps}/deployments/backend", json={})
+    annotate = requests_mock.patch(peer, json=deployment.peer_manifest())
+
+    deployment.suspend()
+    assert scale.last_request.json() == {
+        "metadata": {"annotations": {REPLICAS: "2"}},
+        "spec": {"replicas": 0},
+    }
+    annotations = annotate.last_request.json()["metadata"]["annotations"]
+    assert annotations[SUSPENDED] == str(deployment.suspended)
+    requests_mock.get(peer, json=deployment.peer_manifest())
+    assert deployment.status() == "Suspended"
+
+    # deploying again scales the backend back up
+    backend["metadata"]["annotations"] = {REPLICAS: "2"}
+    backend["spec"]["replicas"] = 0
+    requests_mock.get(f"{apps}/deployments", json={"items": [backend]})
+    assert deployment.deploy() is deployment
+    assert scale.last_request.json() == {
+        "metadata": {"annotations": {REPLICAS: None}},
+        "spec": {"replicas": 2},
+    }
+    assert annotate.last_request.json()["metadata"]["annotations"][SUSPENDED] is None
+    assert deployment.status() == "Deployed"
+    cluster.helm.assert_not_called()
+
+
+def test_expire(cluster, recipe, example_wgkey, requests_mock):
+    deployment = Deployment.from_recipe(cluster, recipe, WireguardKey(example_wgkey))
+    peer = f"{SERVER}{PEERS}/{deployment.name}"
+    requests_mock.delete(peer, status_code=500)
+    namespace = requests_mock.delete(
+        f"{SERVER}{NAMESPACES}/{deployment.namespace}", json={}
+    )
+
+    # the backend stays until the peer is gone, so expiring can be retried
+    with pytest.raises(KubeApiError):
+        deployment.expire()
+    cluster.helm.assert_not_called()
+    assert namespace.call_count == 0
+
+    requests_mock.delete(peer, status_code=404)
+    deployment.expire()
+    assert cluster.helm.call_args.args[0] == "uninstall"
+    assert namespace.call_count == 1
+
+
+def test_deploy_while_removing(cluster, recipe, example_wgkey, requests_mock, mocker):
+    cluster.teardown = mocker.MagicMock()
+    cluster.teardown.cancel.return_value = False
+    cluster.teardown.removing.return_value = True
+    deployment = Deployment.from_recipe(cluster, recipe, WireguardKey(example_wgkey))
+    requests_mock.get(f"{SERVER}{PEERS}/{deployment.name}", status_code=404)
+
+    with pytest.raises(TeardownInProgress):
+        deployment.deploy()
+    assert deployment.client_ip not in cluster.ipam
+    cluster.helm.assert_not_called()
+
+
+def test_deploy_releases_admission(cluster, recipe, example_wgkey, requests_mock):
+    cluster.installer = Installer(max_workers=1, max_queue=1)
+    key = WireguardKey(example_wgkey)
+    existing = Deployment(
+        cluster=cluster, recipe=recipe, client_public_key=key, client_ip="10.5.0.9"
+    )
+    cluster.installer.admit()
+    deployment = Deployment.from_recipe(cluster, recipe, key, admitted=True)
+
+    peer = f"{SERVER}{PEERS}/{deployment.name}"
+    requests_mock.get(peer, [{"status_code": 404}, {"json": existing.peer_manifest()}])
+    requests_mock.post(f"{SERVER}{PEERS}", status_code=409, json={"reason": "exists"})
+
+    # a concurrent deploy won, the reserved place in the queue is given back
+    deployment.deploy()
+    cluster.installer.admit()
+    cluster.installer.shutdown()
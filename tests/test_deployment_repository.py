@@ -1,6 +1,8 @@
 # Copyright (c) 2022 Carnegie Mellon University
 # SPDX-License-Identifier: MIT
 
+import io
+
 import pytest
 from yarl import URL
 
@@ -52,3 +54,40 @@ class TestDeploymentRepository:
         requests_mock.get("http://test/good.yaml", text=GOOD_CONTENT)
         repo = DeploymentRepository("http://test/")
         assert repo.get("good.yaml") == GOOD_CONTENT
+
+    def test_download(self, repository, requests_mock):
+        buffer = io.BytesIO()
+        repository.download(f"{GOOD_UUID}.yaml", buffer)
+        assert buffer.getvalue() == GOOD_CONTENT.encode()
+
+        requests_mock.get("http://test/chart.tgz", content=b"chart")
+        buffer = io.BytesIO()
+        DeploymentRepository("http://test/").download("chart.tgz", buffer)
+        assert buffer.getvalue() == b"chart"
+
+    def test_fetch_local(self, repository):
+        content, validators = repository.fetch(f"{GOOD_UUID}.yaml")
+        assert content == GOOD_CONTENT
+        assert validators.etag is not None
+
+        content, validators2 = repository.fetch(f"{GOOD_UUID}.yaml", validators)
+        assert content is None
+        assert validators2 == validators
+
+    def test_fetch_remote(self, requests_mock):
+        requests_mock.get(
+            "http://test/good.yaml",
+            [
+                dict(text=GOOD_CONTENT, headers={"ETag": '"v1"'}),
+                dict(status_code=304),
+            ],
+        )
+        repo = DeploymentRepository("http://test/")
+
+        content, validators = repo.fetch("good.yaml")
+        assert content == GOOD_CONTENT
+        assert validators.etag == '"v1"'
+
+        content, _ = repo.fetch("good.yaml", validators)
+        assert content is None
+        assert requests_mock.last_request.headers["If-None-Match"] == '"v1"'
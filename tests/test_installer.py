@@ -0,0 +1,87 @@
+# Copyright (c) 2022 Carnegie Mellon University
+# SPDX-License-Identifier: MIT
+
+import threading
+from typing import Any
+
+import pytest
+
+from sinfonia.installer import INSTALLING, PENDING, READY, Installer, InstallQueueFull
+
+
+class FakeDeployment:
+    def __init__(self, name, release):
+        self.name = name
+        self.release = release
+
+    def install_chart(self, wait=False):
+        assert wait
+        self.release.wait(5)
+
+
+def test_bounded_queue():
+    installer = Installer(max_workers=1, max_queue=2)
+    release = threading.Event()
+    deployments: list[Any] = [FakeDeployment(f"test-{i}", release) for i in range(3)]
+
+    futures = []
+    for deployment in deployments:
+        installer.admit()
+        futures.append(installer.submit(deployment, admitted=True))
+
+    # one is installing, two are queued
+    def state(name):
+        status = installer.status(name)
+        return status.state if status is not None else None
+
+    while state("test-0") != INSTALLING:
+        release.wait(0.01)
+    assert state("test-2") == PENDING
+    resources = installer.resources()
+    assert resources["install_queue_depth"] == 2
+    assert resources["install_active"] == 1
+
+    with pytest.raises(InstallQueueFull) as excinfo:
+        installer.admit()
+    assert excinfo.value.retry_after >= 1
+    # retried installs that were not admitted are also held to the limit
+    retry: Any = FakeDeployment("retry", release)
+    with pytest.raises(InstallQueueFull):
+        installer.submit(retry)
+
+    release.set()
+    for future in futures:
+        future.result()
+    assert all(state(d.name) == READY for d in deployments)
+
+    installer.admit()
+    assert installer.resources()["install_queue_depth"] == 0
+    installer.shutdown()
+
+
+def test_concurrent_admission():
+    installer = Installer(max_workers=1, max_queue=4)
+    barrier = threading.Barrier(16)
+    admitted = []
+
+    def admit():
+        barrier.wait()
+        try:
+            installer.admit()
+        except InstallQueueFull:
+            return
+        admitted.append(True)
+
+    threads = [threading.Thread(target=admit) for _ in range(16)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(admitted) == 4
+
+    # unused places are given back
+    with pytest.raises(InstallQueueFull):
+        installer.admit()
+    installer.release()
+    installer.admit()
+    installer.shutdown()
@@ -0,0 +1,141 @@
+# Copyright (c) 2022 Carnegie Mellon University
+# SPDX-License-Identifier: MIT
+
+import threading
+from ipaddress import ip_address
+
+import pytest
+
+from sinfonia.ipam import (
+    AddressPoolExhausted,
+    ClientAddressPool,
+    address_from_k8s_label,
+    address_to_k8s_label,
+)
+from sinfonia.peer_informer import PeerInformer
+
+
+def test_allocate():
+    pool = ClientAddressPool("10.5.0.0/29")
+    assert pool.available == 6
+
+    addresses = [pool.allocate() for _ in range(6)]
+    assert addresses == [ip_address(f"10.5.0.{i}") for i in range(1, 7)]
+    assert pool.used == 6
+
+    with pytest.raises(AddressPoolExhausted):
+        pool.allocate()
+
+    # released addresses become available again after wrapping around
+    assert pool.release(ip_address("10.5.0.3"))
+    assert not pool.release(ip_address("10.5.0.3"))
+    assert pool.allocate() == ip_address("10.5.0.3")
+
+
+def test_next_fit():
+    pool = ClientAddressPool("10.5.0.0/16")
+    first = pool.allocate()
+    second = pool.allocate()
+    pool.release(first)
+    assert pool.allocate() != first
+    assert second in pool
+    assert first not in pool
+
+
+def test_reserve_and_reset():
+    pool = ClientAddressPool("10.5.0.0/16")
+    assert pool.available == 65534
+
+    assert pool.reserve(ip_address("10.5.0.1"))
+    assert not pool.reserve(ip_address("10.5.0.1"))
+    assert not pool.reserve(ip_address("10.6.0.1"))  # outside the network
+    assert not pool.reserve(ip_address("10.5.255.255"))  # broadcast
+    assert pool.allocate() == ip_address("10.5.0.2")
+
+    pool.reset([ip_address("10.5.0.1"), ip_address("10.5.0.2")])
+    assert pool.used == 2
+    assert pool.allocate() == ip_address("10.5.0.3")
+
+
+def test_reset_keeps_recent_allocations():
+    clock = [0.0]
+    pool = ClientAddressPool("10.5.0.0/24", pending_timeout=60, clock=lambda: clock[0])
+    peers = [pool.allocate() for _ in range(2)]
+    pending = pool.allocate()  # peer not created yet
+
+    pool.reset(peers)
+    assert pending in pool
+    assert pool.allocate() == ip_address("10.5.0.4")  # cursor is not rewound
+
+    # allocations without a peer are eventually reclaimed
+    clock[0] = 61
+    pool.reset(peers)
+    assert pending not in pool
+    assert pool.used == 2
+
+
+def test_concurrent_allocations_while_resyncing():
+    """Allocations while the informer is unhealthy rebuild the pool from a
+    list of peers, which misses the peers of concurrent deploys."""
+    pool = ClientAddressPool("10.5.0.0/24")
+    peers = [pool.allocate() for _ in range(4)]
+    workers = 16
+    listed = threading.Barrier(workers)
+    allocated = []
+
+    def deploy():
+        snapshot = list(peers)
+        listed.wait()
+        pool.reset(snapshot)
+        address = pool.allocate()
+        allocated.append(address)
+        peers.append(address)
+
+    threads = [threading.Thread(target=deploy) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(set(peers)) == len(peers) == 4 + workers
+    assert all(address in pool for address in peers)
+
+
+def test_ipv6():
+    pool = ClientAddressPool("fd00:5::/112")
+    address = pool.allocate()
+    assert address == ip_address("fd00:5::1")
+
+    label = address_to_k8s_label(address)
+    assert label == "fd00-0005-0000-0000-0000-0000-0000-0001"
+    assert address_from_k8s_label(label) == address
+    assert address_from_k8s_label("10.5.0.1") == ip_address("10.5.0.1")
+
+    large = ClientAddressPool("fd00:5::/64")
+    assert large.allocate() == ip_address("fd00:5::1")
+
+
+def test_follows_informer():
+    pool = ClientAddressPool("10.5.0.0/24")
+    informer = PeerInformer(api=None, listeners=[pool.peer_changed])  # type: ignore
+
+    def peer(name, client, version):
+        return {
+            "metadata": {
+                "name": name,
+                "resourceVersion": version,
+                "labels": {"findcloudlet.org/client": client},
+            }
+        }
+
+    informer.replace([peer("one", "10.5.0.1", "1"), peer("two", "10.5.0.2", "1")], "1")
+    assert pool.used == 2
+    assert pool.allocate() == ip_address("10.5.0.3")
+
+    informer.update(peer("two", "10.5.0.4", "2"))
+    assert ip_address("10.5.0.2") not in pool
+    assert ip_address("10.5.0.4") in pool
+
+    informer.replace([peer("two", "10.5.0.4", "3")], "3")
+    assert ip_address("10.5.0.1") not in pool
+    assert pool.used == 2  # 10.5.0.3 is still allocated
@@ -0,0 +1,211 @@
+# Copyright (c) 2022 Carnegie Mellon University
+# SPDX-License-Identifier: MIT
+
+import json
+from base64 import b64encode
+from pathlib import Path
+
+import pytest
+import yaml
+from yarl import URL
+
+from sinfonia.kube_client import (
+    PEERS,
+    KubeApiError,
+    KubeClient,
+    KubeConfigError,
+    TokenFileAuth,
+)
+
+SERVER = "https://cluster.example:6443"
+
+
+def b64(data: bytes) -> str:
+    return b64encode(data).decode()
+
+
+@pytest.fixture
+def kubeconfig(tmp_path):
+    config = {
+        "apiVersion": "v1",
+        "kind": "Config",
+        "current-context": "default",
+        "clusters": [
+            {
+                "name": "cluster",
+                "cluster": {
+                    "server": SERVER,
+                    "certificate-authority-data": b64(b"CA"),
+                },
+            },
+            {
+                "name": "other",
+                "cluster": {
+                    "server": "https://other.example:6443",
+                    "insecure-skip-tls-verify": True,
+                },
+            },
+        ],
+        "users": [
+            {
+                "name": "admin",
+                "user": {
+                    "client-certificate-data": b64(b"CERT"),
+                    "client-key-data": b64(b"KEY"),
+                },
+            },
+            {"name": "token", "user": {"tokenFile": "token"}},
+        ],
+        "contexts": [
+            {"name": "default", "context": {"cluster": "cluster", "user": "admin"}},
+            {
+                "name": "other",
+                "context": {"cluster": "other", "user": "token", "namespace": "ns"},
+            },
+        ],
+    }
+    path = tmp_path / "config"
+    path.write_text(yaml.safe_dump(config))
+    (tmp_path / "token").write_text("secret-token\n")
+    return path
+
+
+def test_kubeconfig_current_context(kubeconfig):
+    client = KubeClient.from_kubeconfig(kubeconfig)
+
+    assert client.server == URL(SERVER)
+    assert client.namespace == "default"
+    assert isinstance(client.session.verify, str)
+    assert Path(client.session.verify).read_bytes() == b"CA"
+    assert isinstance(client.session.cert, tuple)
+    cert, key = client.session.cert
+    assert Path(cert).read_bytes() == b"CERT"
+    assert Path(key).read_bytes() == b"KEY"
+
+
+def test_kubeconfig_select_context(kubeconfig, requests_mock):
+    client = KubeClient.connect(kubeconfig, "other")
+
+    assert client.server == URL("https://other.example:6443")
+    assert client.namespace == "ns"
+    assert client.session.verify is False
+    assert isinstance(client.session.auth, TokenFileAuth)
+
+    requests_mock.get(f"https://other.example:6443{PEERS}", json={"items": []})
+    client.list(PEERS, label_selector="findcloudlet.org=deployment")
+
+    request = requests_mock.last_request
+    assert request.headers["Authorization"] == "Bearer secret-token"
+    assert request.qs == {"labelselector": ["findcloudlet.org=deployment"]}
+
+
+def test_kubeconfig_errors(kubeconfig):
+    with pytest.raises(KubeConfigError):
+        KubeClient.from_kubeconfig(kubeconfig, "missing")
+
+
+def test_kubeconfig_merge(kubeconfig, tmp_path, monkeypatch, requests_mock):
+    other = tmp_path / "other"
+    other.mkdir()
+    (other / "token").write_text("other-token\n")
+    config = {
+        "current-context": "proxied",
+        "clusters": [
+            {"name": "cluster", "cluster": {"server": "https://ignored.example"}},
+            {
+                "name": "proxied",
+                "cluster": {"server": "https://rancher.example/k8s/clusters/c-1"},
+            },
+        ],
+        "users": [{"name": "proxied", "user": {"tokenFile": "token"}}],
+        "contexts": [
+            {"name": "proxied", "context": {"cluster": "proxied", "user": "proxied"}}
+        ],
+    }
+    (other / "config").write_text(yaml.safe_dump(config))
+    missing = tmp_path / "missing"
+    monkeypatch.setenv(
+        "KUBECONFIG", ":".join([str(missing), str(kubeconfig), str(other / "config")])
+    )
+
+    # the first file to set the current context wins
+    assert KubeClient.connect().server == URL(SERVER)
+
+    # entries from later files are available, with their own relative paths
+    client = KubeClient.connect(context="proxied")
+    requests_mock.get(
+        f"https://rancher.example/k8s/clusters/c-1{PEERS}", json={"items": []}
+    )
+    client.list(PEERS)
+    assert requests_mock.last_request.headers["Authorization"] == "Bearer other-token"
+
+
+def test_request_errors(kubeconfig, requests_mock):
+    client = KubeClient.from_kubeconfig(kubeconfig)
+    peer = f"{SERVER}{PEERS}/test"
+    status = {"kind": "Status", "reason": "NotFound", "message": "not found"}
+
+    requests_mock.get(peer, status_code=404, json=status)
+    assert not client.exists(f"{PEERS}/test")
+
+    requests_mock.delete(peer, status_code=404, json=status)
+    assert client.delete(f"{PEERS}/test") is None
+
+    requests_mock.post(f"{SERVER}{PEERS}", status_code=409, json=status)
+    with pytest.raises(KubeApiError) as excinfo:
+        client.create(PEERS, {"metadata": {"name": "test"}})
+    assert excinfo.value.conflict
+
+
+def test_apply(kubeconfig, requests_mock):
+    client = KubeClient.from_kubeconfig(kubeconfig)
+    body = {"metadata": {"name": "test"}}
+    requests_mock.patch(f"{SERVER}{PEERS}/test", json=body)
+
+    assert client.apply(f"{PEERS}/test", body) == body
+
+    request = requests_mock.last_request
+    assert request.headers["Content-Type"] == "application/apply-patch+yaml"
+    assert request.qs["fieldmanager"] == ["sinfonia"]
+    assert json.loads(request.body) == body
+
+
+def test_resource_path(kubeconfig, requests_mock):
+    client = KubeClient.from_kubeconfig(kubeconfig)
+    discovery = requests_mock.get(
+        f"{SERVER}/apis/apps/v1",
+        json={
+            "resources": [
+                {"name": "deployments", "kind": "Deployment", "namespaced": True},
+                {"name": "deployments/scale", "kind": "Scale", "namespaced": True},
+            ]
+        },
+    )
+    requests_mock.get(
+        f"{SERVER}/api/v1",
+        json={"resources": [{"name": "nodes", "kind": "Node", "namespaced": False}]},
+    )
+
+    path = client.resource_path("apps/v1", "Deployment", "test", "backend")
+    assert path == "/apis/apps/v1/namespaces/test/deployments/backend"
+    assert client.resource_path("apps/v1", "Deployment") == (
+        "/apis/apps/v1/namespaces/default/deployments"
+    )
+    assert client.resource_path("v1", "Node", "test") == "/api/v1/nodes"
+    assert discovery.call_count == 1
+
+    with pytest.raises(KeyError):
+        client.resource("apps/v1", "Scale")
+
+
+def test_in_cluster(tmp_path, monkeypatch):
+    (tmp_path / "token").write_text("token")
+    (tmp_path / "namespace").write_text("sinfonia")
+    monkeypatch.setenv("KUBERNETES_SERVICE_HOST", "10.43.0.1")
+    monkeypatch.setenv("KUBERNETES_SERVICE_PORT", "443")
+
+    client = KubeClient.in_cluster(tmp_path)
+
+    assert client.server == URL("https://10.43.0.1:443")
+    assert client.namespace == "sinfonia"
+    assert client.session.verify == str(tmp_path / "ca.crt")
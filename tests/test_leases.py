@@ -0,0 +1,81 @@
+# Copyright (c) 2022 Carnegie Mellon University
+# SPDX-License-Identifier: MIT
+
+from typing import Any, Dict
+
+import pendulum
+from wireguard_tools import WireguardKey
+
+from sinfonia.deployment import SUSPENDED, key_to_k8s_label
+from sinfonia.leases import LeaseScheduler
+
+NOW = pendulum.datetime(2022, 10, 17, 12, 0, 0)
+
+
+def make_peer(name, key, created=NOW, suspended=None):
+    peer: Dict[str, Any] = {
+        "metadata": {
+            "name": name,
+            "labels": {"findcloudlet.org/key": key_to_k8s_label(key)},
+            "annotations": {"findcloudlet.org/created": str(created)},
+        }
+    }
+    if suspended is not None:
+        peer["metadata"]["annotations"][SUSPENDED] = str(suspended)
+    return peer
+
+
+def test_due():
+    leases = LeaseScheduler(lease_duration=300, suspend_duration=3600)
+    now = NOW.timestamp()
+    active, idle = WireguardKey.generate(), WireguardKey.generate()
+    leases.peer_changed(None, make_peer("active", active))
+    leases.peer_changed(None, make_peer("idle", idle))
+    leases.peer_changed(None, make_peer("broken", idle, created="garbage"))
+    assert len(leases) == 2
+
+    leases.observe({active}, now + 200)
+    assert leases.due(now + 299) == []
+    assert leases.due(now + 300) == ["idle"]
+    assert leases.due(now + 300) == []
+
+    # a relisted peer keeps its renewed lease
+    leases.peer_changed(None, make_peer("active", active))
+    assert leases.due(now + 499) == []
+    assert leases.due(now + 500) == ["active"]
+
+
+def test_suspended():
+    leases = LeaseScheduler(lease_duration=300, suspend_duration=3600)
+    now = NOW.timestamp()
+    key = WireguardKey.generate()
+    peer = make_peer("test", key)
+    leases.peer_changed(None, peer)
+    assert leases.due(now + 300) == ["test"]
+
+    suspended = make_peer("test", key, suspended=NOW.add(seconds=300))
+    leases.peer_changed(peer, suspended)
+    assert leases.suspended() == ["test"]
+
+    # activity does not renew suspended deployments
+    leases.observe({key}, now + 3000)
+    assert leases.due(now + 3899) == []
+    assert leases.due(now + 3900) == ["test"]
+
+    resumed = make_peer("test", key, created=NOW.add(seconds=3000))
+    leases.peer_changed(suspended, resumed)
+    assert leases.suspended() == []
+    assert leases.deadline("test") == now + 3300
+
+    leases.peer_changed(resumed, None)
+    assert len(leases) == 0
+    assert leases.due(now + 4000) == []
+
+
+def test_sync():
+    leases = LeaseScheduler()
+    key = WireguardKey.generate()
+    leases.sync([make_peer("a", key), make_peer("b", key)])
+    leases.sync([make_peer("b", key)])
+    assert len(leases) == 1
+    assert leases.due(NOW.timestamp() + 300) == ["b"]
@@ -0,0 +1,209 @@
+# Copyright (c) 2022 Carnegie Mellon University
+# SPDX-License-Identifier: MIT
+
+import io
+import tarfile
+from uuid import uuid4
+
+import pytest
+import yaml
+from yarl import URL
+
+from sinfonia.chart_cache import ChartCache
+from sinfonia.deployment_recipe import DeploymentRecipe
+from sinfonia.deployment_repository import DeploymentRepository
+from sinfonia.kube_client import NAMESPACES, KubeClient
+from sinfonia.manifest_cache import PLACEHOLDER, ManifestCache, UnsupportedChart
+
+SERVER = "https://cluster.example:6443"
+NAMESPACE = "sinfonia-abcdefghijklmnop"
+
+SERVICE = {
+    "apiVersion": "v1",
+    "kind": "Service",
+    "metadata": {"name": "example", "labels": {"release": PLACEHOLDER}},
+}
+DEPLOYMENT = {
+    "apiVersion": "apps/v1",
+    "kind": "Deployment",
+    "metadata": {"name": f"{PLACEHOLDER}-example"},
+    "spec": {"replicas": 1},
+}
+CLUSTER_ROLE = {
+    "apiVersion": "rbac.authorization.k8s.io/v1",
+    "kind": "ClusterRole",
+    "metadata": {"name": f"{PLACEHOLDER}-example"},
+}
+
+
+def chart_archive(templates):
+    """Chart archive with the given template files."""
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w:gz") as archive:
+        for name, content in templates.items():
+            data = content.encode()
+            info = tarfile.TarInfo(f"example/templates/{name}")
+            info.size = len(data)
+            archive.addfile(info, io.BytesIO(data))
+    return buffer.getvalue()
+
+
+def discovery(requests_mock):
+    for group, resources in {
+        "/api/v1": [("services", "Service", True), ("namespaces", "Namespace", False)],
+        "/apis/apps/v1": [("deployments", "Deployment", True)],
+        "/apis/rbac.authorization.k8s.io/v1": [("clusterroles", "ClusterRole", False)],
+    }.items():
+        requests_mock.get(
+            f"{SERVER}{group}",
+            json={
+                "resources": [
+                    {"name": name, "kind": kind, "namespaced": namespaced}
+                    for name, kind, namespaced in resources
+                ]
+            },
+        )
+
+
+@pytest.fixture
+def manifests(tmp_path, mocker, requests_mock):
+    discovery(requests_mock)
+    requests_mock.get(
+        "http://test/example-0.1.0.tgz",
+        content=chart_archive({"deployment.yaml": "name: {{ .Release.Name }}"}),
+    )
+    helm = mocker.MagicMock(return_value=yaml.safe_dump_all([DEPLOYMENT, SERVICE]))
+    return ManifestCache(
+        KubeClient(URL(SERVER)), helm, ChartCache(tmp_path), sleep=lambda _: None
+    )
+
+
+def make_recipe(values=None):
+    return DeploymentRecipe(
+        repository=DeploymentRepository("http://test/"),
+        uuid=uuid4(),
+        description=None,
+        chart="example",
+        version="0.1.0",
+        values=values or {},
+        restricted=False,
+    )
+
+
+def test_apply(manifests, requests_mock):
+    requests_mock.patch(f"{SERVER}{NAMESPACES}/{NAMESPACE}", json={})
+    service = requests_mock.patch(
+        f"{SERVER}/api/v1/namespaces/{NAMESPACE}/services/example", json={}
+    )
+    deployment = requests_mock.patch(
+        f"{SERVER}/apis/apps/v1/namespaces/{NAMESPACE}/deployments/{NAMESPACE}-example",
+        json={},
+    )
+
+    manifests.apply(make_recipe(), NAMESPACE)
+    manifests.apply(make_recipe(), NAMESPACE)
+    manifests.helm.assert_called_once()
+    assert manifests.helm.call_args.args[:2] == ("template", PLACEHOLDER)
+
+    applied = service.last_request.json()
+    assert applied["metadata"]["namespace"] == NAMESPACE
+    assert applied["metadata"]["labels"]["release"] == NAMESPACE
+    # services are applied before the deployment that uses them
+    history = requests_mock.request_history
+    assert history.index(service.last_request) < history.index(deployment.last_request)
+
+    # different values render again
+    manifests.render(make_recipe({"replicas": 2}))
+    assert manifests.helm.call_count == 2
+
+
+def test_cluster_scoped(manifests):
+    manifests.helm.return_value = yaml.safe_dump_all([SERVICE, CLUSTER_ROLE])
+
+    with pytest.raises(UnsupportedChart):
+        manifests.apply(make_recipe(), NAMESPACE)
+    with pytest.raises(UnsupportedChart):
+        manifests.apply(make_recipe(), NAMESPACE)
+    manifests.helm.assert_called_once()
+
+
+def test_wait_ready(manifests, requests_mock):
+    deployments = f"{SERVER}/apis/apps/v1/namespaces/{NAMESPACE}/deployments"
+    not_ready = dict(DEPLOYMENT, status={"readyReplicas": 0})
+    ready = dict(DEPLOYMENT, status={"readyReplicas": 1})
+    requests_mock.get(
+        deployments,
+        [{"json": {"items": [not_ready]}}, {"json": {"items": [ready]}}],
+    )
+    requests_mock.get(
+        f"{SERVER}/apis/apps/v1/namespaces/{NAMESPACE}/statefulsets",
+        json={"items": []},
+    )
+
+    manifests.wait_ready(NAMESPACE)
+    assert requests_mock.call_count == 4
+
+    requests_mock.get(deployments, json={"items": [not_ready]})
+    with pytest.raises(TimeoutError):
+        manifests.wait_ready(NAMESPACE, timeout=0)
+
+
+def test_unsupported_templates(manifests, requests_mock):
+    for template in [
+        "password: {{ randAlphaNum 16 | b64enc }}",
+        '{{- $ca := genCA "example-ca" 365 }}',
+        '{{- $secret := lookup "v1" "Secret" .Release.Namespace "example" }}',
+    ]:
+        requests_mock.get(
+            "http://test/example-0.1.0.tgz",
+            content=chart_archive({"secret.yaml": template}),
+        )
+        with pytest.raises(UnsupportedChart):
+            manifests.apply(make_recipe({"template": template}), NAMESPACE)
+    manifests.helm.assert_not_called()
+
+
+def test_hooks(manifests):
+    hook = dict(
+        SERVICE,
+        metadata={"name": "init", "annotations": {"helm.sh/hook": "pre-install"}},
+    )
+    manifests.helm.return_value = yaml.safe_dump_all([SERVICE, hook])
+
+    with pytest.raises(UnsupportedChart):
+        manifests.apply(make_recipe(), NAMESPACE)
+
+
+def test_unknown_api_group(manifests, requests_mock):
+    custom = {
+        "apiVersion": "example.com/v1",
+        "kind": "Example",
+        "metadata": {"name": "example"},
+    }
+    requests_mock.get(f"{SERVER}/apis/example.com/v1", status_code=404)
+    manifests.helm.return_value = yaml.safe_dump_all([SERVICE, custom])
+
+    with pytest.raises(UnsupportedChart):
+        manifests.apply(make_recipe(), NAMESPACE)
+
+
+def test_namespace_length(manifests, requests_mock):
+    namespace = "sinfonia-warm-0123456789"
+    requests_mock.patch(f"{SERVER}{NAMESPACES}/{namespace}", json={})
+    service = requests_mock.patch(
+        f"{SERVER}/api/v1/namespaces/{namespace}/services/example", json={}
+    )
+    requests_mock.patch(
+        f"{SERVER}/apis/apps/v1/namespaces/{namespace}/deployments/{namespace}-example",
+        json={},
+    )
+    manifests.helm.side_effect = lambda *args: yaml.safe_dump_all(
+        [SERVICE, DEPLOYMENT]
+    ).replace(PLACEHOLDER, args[1])
+
+    manifests.apply(make_recipe(), namespace)
+    assert len(manifests.helm.call_args.args[1]) == len(namespace)
+    assert service.last_request.json()["metadata"]["labels"]["release"] == namespace
+
+    with pytest.raises(UnsupportedChart):
+        manifests.apply(make_recipe(), "sinfonia-a")
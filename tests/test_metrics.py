@@ -0,0 +1,48 @@
+# Copyright (c) 2022 Carnegie Mellon University
+# SPDX-License-Identifier: MIT
+
+import pytest
+
+from sinfonia.metrics import Registry
+
+
+def test_render():
+    registry = Registry()
+    requests = registry.counter("test_requests", "Requests", ["method"])
+    inflight = registry.gauge("test_inflight", "In flight")
+    latency = registry.histogram("test_latency", "Latency", buckets=[0.1, 1])
+
+    requests.inc(method="GET")
+    requests.inc(2, method="POST")
+    inflight.set_function(lambda: 3)
+    latency.observe(0.05)
+    latency.observe(0.5)
+
+    assert registry.render() == (
+        "# HELP test_inflight In flight\n"
+        "# TYPE test_inflight gauge\n"
+        "test_inflight 3\n"
+        "# HELP test_latency Latency\n"
+        "# TYPE test_latency histogram\n"
+        'test_latency_bucket{le="0.1"} 1\n'
+        'test_latency_bucket{le="1"} 2\n'
+        'test_latency_bucket{le="+Inf"} 2\n'
+        "test_latency_sum 0.55\n"
+        "test_latency_count 2\n"
+        "# HELP test_requests Requests\n"
+        "# TYPE test_requests counter\n"
+        'test_requests_total{method="GET"} 1\n'
+        'test_requests_total{method="POST"} 2\n'
+    )
+
+
+def test_register():
+    registry = Registry()
+    counter = registry.counter("test", "Test", ["label"])
+    assert registry.counter("test", "Test", ["label"]) is counter
+
+    with pytest.raises(ValueError):
+        registry.gauge("test", "Test")
+
+    with pytest.raises(ValueError):
+        counter.inc(other="label")
@@ -0,0 +1,119 @@
+# Copyright (c) 2022 Carnegie Mellon University
+# SPDX-License-Identifier: MIT
+
+from typing import Any, Dict
+
+import pytest
+
+from sinfonia.node_resources import (
+    HOSTNAME_LABEL,
+    RESOURCE_QUERIES,
+    NodeHeadroom,
+    best_gpu_node,
+    needs_gpu,
+    nodes_from_metrics,
+    over_utilized,
+    place_manifest,
+    place_values,
+    resources_from_metrics,
+    summarize,
+)
+
+
+def samples(**values):
+    return {
+        "resultType": "vector",
+        "result": [
+            {"metric": {"nodename": node}, "value": [0, str(value)]}
+            for node, value in values.items()
+        ],
+    }
+
+
+def test_nodes_from_metrics():
+    nodes = nodes_from_metrics(
+        {
+            "node_cpu": samples(a=0.75, b=0.25),
+            "node_mem": samples(a=0.5, b=1.5),
+            "node_gpu": samples(b=0.1),
+            "cpu_ratio": {"resultType": "scalar", "result": [0, "0.5"]},
+        }
+    )
+    assert nodes[0] == NodeHeadroom("a", cpu=0.25, mem=0.5, gpu=None)
+    assert (nodes[1].cpu, nodes[1].mem) == (0.75, 0.0)
+    assert nodes[1].gpu == pytest.approx(0.9)
+    assert nodes_from_metrics({}) == []
+
+
+def test_resource_utilization():
+    def scalar(value):
+        return {"resultType": "scalar", "result": [0, str(value)]}
+
+    # DCGM reports utilization in percent, the query turns it into a ratio
+    dcgm_gpu_util = 35
+    assert RESOURCE_QUERIES["gpu_ratio"].endswith(" / 100")
+    resources = resources_from_metrics(
+        {
+            "cpu_ratio": scalar(0.5),
+            "gpu_ratio": scalar(dcgm_gpu_util / 100),
+            "mem_ratio": scalar("NaN"),
+        }
+    )
+    assert resources == {"cpu_ratio": 0.5, "gpu_ratio": 0.35}
+    assert not over_utilized(resources, 0.8)
+
+    assert over_utilized({"gpu_ratio": 0.95}, 0.8)
+    assert over_utilized({"mem_ratio": 0.9, "gpu_ratio": 0.1}, 0.8)
+
+
+def test_summarize():
+    nodes = [
+        NodeHeadroom("a", cpu=0.9, mem=0.5),
+        NodeHeadroom("b", cpu=0.1, mem=0.2, gpu=1.0),
+        NodeHeadroom("c", cpu=0.5, mem=0.8, gpu=0.0),
+    ]
+    summary = summarize(nodes, k=2)
+    assert summary["node_count"] == 3
+    assert summary["cpu_headroom_max"] == 0.9
+    assert summary["cpu_headroom_top2"] == pytest.approx(0.7)
+    assert summary["gpu_headroom_max"] == 1.0
+    assert summary["node_headroom_max"] == 0.5
+    assert summarize([]) == {}
+
+    assert best_gpu_node(nodes) == "b"
+    assert best_gpu_node(nodes[:1]) is None
+
+
+def test_needs_gpu():
+    assert needs_gpu({"resources": {"limits": {"nvidia.com/gpu": 1}}})
+    assert needs_gpu({"containers": [{"resources": {"limits": {"amd.com/gpu": 1}}}]})
+    assert not needs_gpu({"resources": {"limits": {"cpu": 1}}, "gpu": False})
+
+
+def test_placement():
+    manifest: Dict[str, Any] = {
+        "kind": "Deployment",
+        "spec": {"template": {"spec": {"containers": []}}},
+    }
+    place_manifest(manifest, "b")
+    affinity = manifest["spec"]["template"]["spec"]["affinity"]
+    preferred = affinity["nodeAffinity"][
+        "preferredDuringSchedulingIgnoredDuringExecution"
+    ]
+    assert preferred[0]["preference"]["matchExpressions"][0] == {
+        "key": HOSTNAME_LABEL,
+        "operator": "In",
+        "values": ["b"],
+    }
+
+    values = {"affinity": affinity}
+    placed = place_values(values, "c")
+    assert (
+        len(
+            placed["affinity"]["nodeAffinity"][
+                "preferredDuringSchedulingIgnoredDuringExecution"
+            ]
+        )
+        == 2
+    )
+    assert len(preferred) == 1  # recipe values are not modified
@@ -0,0 +1,130 @@
+# Copyright (c) 2022 Carnegie Mellon University
+# SPDX-License-Identifier: MIT
+
+from types import SimpleNamespace
+from typing import Any
+
+import pytest
+from yarl import URL
+
+from sinfonia.installer import INSTALLING, InstallStatus
+from sinfonia.ipam import ClientAddressPool
+from sinfonia.kube_client import NAMESPACES, PEERS, KubeClient
+from sinfonia.orphans import NAMESPACE, PEER, RELEASE, OrphanCollector
+from sinfonia.peer_informer import PeerInformer
+from sinfonia.teardown import SECRETS, Teardown
+from sinfonia.warm_pool import CLAIMED, STATE_LABEL
+
+SERVER = "https://cluster.example:6443"
+
+DEPLOYED = "sinfonia-aaaaaaaaaaaaaaaa"
+NO_BACKEND = "sinfonia-bbbbbbbbbbbbbbbb"
+IN_PROGRESS = "sinfonia-cccccccccccccccc"
+NO_PEER = "sinfonia-dddddddddddddddd"
+WARM = "sinfonia-warm-0123"
+
+
+def make_peer(name, namespace=None, client="10.5.0.2"):
+    return {
+        "metadata": {
+            "name": name,
+            "labels": {
+                "findcloudlet.org": "deployment",
+                "findcloudlet.org/uuid": "00000000-0000-0000-0000-000000000000",
+                "findcloudlet.org/key": "wg-YAeK3bR_tD9V66la6byJ2PN_hTR1CvI80D4Q9YOUFlk=-pubkey",  # noqa
+                "findcloudlet.org/client": client,
+            },
+            "annotations": {
+                "findcloudlet.org/created": "2022-10-17T12:00:00+00:00",
+                "findcloudlet.org/namespace": namespace or name,
+            },
+        }
+    }
+
+
+def make_namespace(name, labels=None, phase="Active"):
+    return {
+        "metadata": {"name": name, "labels": labels or {}},
+        "status": {"phase": phase},
+    }
+
+
+@pytest.fixture
+def cluster(mocker):
+    api = KubeClient(URL(SERVER))
+    ipam = ClientAddressPool("10.5.0.0/16")
+    installer = SimpleNamespace(
+        status=lambda name: InstallStatus(INSTALLING) if name == IN_PROGRESS else None,
+        forget=lambda name: None,
+    )
+    cluster: Any = SimpleNamespace(
+        api=api,
+        ipam=ipam,
+        informer=PeerInformer(api),
+        helm=mocker.MagicMock(),
+        installer=installer,
+    )
+    cluster.teardown = Teardown(cluster)
+    return cluster
+
+
+@pytest.fixture
+def resources(requests_mock):
+    requests_mock.get(
+        f"{SERVER}{PEERS}",
+        json={
+            "items": [
+                make_peer(DEPLOYED, client="10.5.0.2"),
+                make_peer(NO_BACKEND, client="10.5.0.3"),
+                make_peer(IN_PROGRESS, client="10.5.0.4"),
+                make_peer("sinfonia-eeeeeeeeeeeeeeee", WARM, client="10.5.0.5"),
+            ]
+        },
+    )
+    requests_mock.get(
+        f"{SERVER}{NAMESPACES}",
+        json={
+            "items": [
+                make_namespace("default"),
+                make_namespace(DEPLOYED),
+                make_namespace(NO_PEER),
+                make_namespace(WARM, {STATE_LABEL: CLAIMED}),
+                make_namespace("sinfonia-warm-4567", {STATE_LABEL: CLAIMED}),
+                make_namespace("sinfonia-ffffffffffffffff", phase="Terminating"),
+            ]
+        },
+    )
+    requests_mock.get(
+        f"{SERVER}{SECRETS}",
+        json={
+            "items": [
+                {"metadata": {"name": "sh.helm.release.v1", "namespace": DEPLOYED}},
+                {"metadata": {"name": "sh.helm.release.v1", "namespace": NO_PEER}},
+            ]
+        },
+    )
+
+
+def test_collect(cluster, resources, requests_mock):
+    clock = [0.0]
+    collector = OrphanCollector(cluster, grace_period=600, clock=lambda: clock[0])
+    deleted = requests_mock.delete(f"{SERVER}{NAMESPACES}/{NO_PEER}", json={})
+    warm = requests_mock.delete(f"{SERVER}{NAMESPACES}/sinfonia-warm-4567", json={})
+
+    collector.collect()
+    assert set(collector._seen) == {
+        (PEER, NO_BACKEND),
+        (NAMESPACE, NO_PEER),
+        (NAMESPACE, "sinfonia-warm-4567"),
+        (RELEASE, NO_PEER),
+    }
+    assert deleted.call_count == 0
+
+    # still orphaned after the grace period
+    clock[0] += 600
+    collector.collect()
+    assert NO_BACKEND in cluster.teardown
+    assert len(cluster.teardown) == 1
+    assert deleted.call_count == 1
+    assert warm.call_count == 1
+    cluster.helm.assert_called_once_with("uninstall", "--namespace", NO_PEER, NO_PEER)
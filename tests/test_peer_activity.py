@@ -0,0 +1,59 @@
+# Copyright (c) 2022 Carnegie Mellon University
+# SPDX-License-Identifier: MIT
+
+from pathlib import Path
+
+import pytest
+from wireguard_tools import WireguardKey
+
+from sinfonia.peer_activity import WireguardDump, parse_wg_dump, prometheus_active_peers
+
+NOW = 1666000000
+ACTIVE = WireguardKey("kDnDqtekZeX8C4DMVTK5RfOS+YiFnpA1IIpavXat0Uk=")
+IDLE = WireguardKey("YAeK3bR/tD9V66la6byJ2PN/hTR1CvI80D4Q9YOUFlk=")
+NEVER = WireguardKey("0BD53oB6V1+VE3So4nSR89Tp89Rq+ZM9VB2XJ1Z513g=")
+
+
+@pytest.fixture
+def dump(request):
+    return (Path(request.fspath.dirname) / "data" / "wg_dump.txt").read_text()
+
+
+def test_parse_wg_dump(dump):
+    peers = parse_wg_dump(dump)
+    assert set(peers) == {ACTIVE, IDLE, NEVER}
+    assert peers[ACTIVE].latest_handshake == 1665999900
+    assert peers[ACTIVE].rx_bytes == 1748
+    assert peers[NEVER].latest_handshake == 0
+
+    # 'wg show all dump' prefixes lines with the interface name
+    all_dump = "".join(f"kilo0\t{line}\n" for line in dump.splitlines())
+    assert parse_wg_dump(all_dump) == peers
+
+
+def test_active_peers(dump):
+    now = [NOW]
+    source = WireguardDump(lambda: dump, clock=lambda: now[0])
+    assert source.active_peers(300) == {ACTIVE}
+
+    # received traffic counts as activity, even without a new handshake
+    dump = dump.replace("\t100\t200\t", "\t150\t200\t")
+    now[0] += 60
+    assert source.active_peers(300) == {ACTIVE, IDLE}
+
+    now[0] += 300
+    assert source.active_peers(300) == set()
+
+
+def test_active_peers_unavailable(tmp_path):
+    assert WireguardDump.from_file(tmp_path / "missing").active_peers(300) is None
+    assert WireguardDump.from_interface("wg-none").active_peers(300) is None
+
+    assert prometheus_active_peers({}) is None
+    metrics = {
+        "active_peers": {
+            "resultType": "vector",
+            "result": [{"metric": {"public_key": str(ACTIVE)}, "value": [0, "1"]}],
+        }
+    }
+    assert prometheus_active_peers(metrics) == {ACTIVE}
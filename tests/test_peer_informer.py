@@ -0,0 +1,182 @@
+# Copyright (c) 2022 Carnegie Mellon University
+# SPDX-License-Identifier: MIT
+
+from typing import Any
+
+import pytest
+import requests
+
+from sinfonia.kube_client import KubeApiError
+from sinfonia.peer_informer import PeerInformer, parse_selector
+
+from .conftest import GOOD_UUID
+
+
+def make_peer(name, client_ip, key="wg-key-pubkey", version="1"):
+    return {
+        "metadata": {
+            "name": name,
+            "resourceVersion": version,
+            "labels": {
+                "findcloudlet.org": "deployment",
+                "findcloudlet.org/uuid": GOOD_UUID,
+                "findcloudlet.org/key": key,
+                "findcloudlet.org/client": client_ip,
+            },
+        }
+    }
+
+
+class FakeApi:
+    def __init__(self, items, events):
+        self.items = items
+        self.events = events
+        self.lists = 0
+        self.watches = []
+
+    def list(self, path, label_selector=""):
+        self.lists += 1
+        return {"metadata": {"resourceVersion": "10"}, "items": self.items}
+
+    def watch(self, path, resource_version, label_selector="", timeout=300):
+        self.watches.append(resource_version)
+        events = self.events.pop(0) if self.events else []
+        if isinstance(events, Exception):
+            raise events
+        yield from events
+
+
+def informer_for(api: Any) -> PeerInformer:
+    return PeerInformer(api=api)
+
+
+def test_parse_selector():
+    assert parse_selector(["a=b,c=d", "e=f"]) == {"a": "b", "c": "d", "e": "f"}
+
+
+def test_select():
+    informer = informer_for(None)
+    informer.replace(
+        [
+            make_peer("one", "10.5.0.1", key="wg-a-pubkey"),
+            make_peer("two", "10.5.0.2", key="wg-b-pubkey"),
+        ],
+        "1",
+    )
+
+    assert len(informer.select("findcloudlet.org=deployment")) == 2
+    assert len(informer.select(f"findcloudlet.org/uuid={GOOD_UUID}")) == 2
+    (peer,) = informer.select(
+        f"findcloudlet.org/uuid={GOOD_UUID}", "findcloudlet.org/key=wg-b-pubkey"
+    )
+    assert peer["metadata"]["name"] == "two"
+    assert informer.select("findcloudlet.org/client=10.5.0.3") == []
+
+    # relabeled peers move between index buckets
+    informer.update(make_peer("two", "10.5.0.3", key="wg-b-pubkey", version="2"))
+    assert informer.select("findcloudlet.org/client=10.5.0.2") == []
+    assert len(informer.select("findcloudlet.org/client=10.5.0.3")) == 1
+
+    # stale updates are ignored
+    informer.update(make_peer("two", "10.5.0.2", key="wg-b-pubkey", version="1"))
+    assert len(informer.select("findcloudlet.org/client=10.5.0.3")) == 1
+
+    informer.remove("one")
+    assert informer.select("findcloudlet.org/key=wg-a-pubkey") == []
+    assert len(informer) == 1
+
+
+def test_list_and_watch():
+    api = FakeApi(
+        [make_peer("one", "10.5.0.1")],
+        [
+            [
+                {"type": "ADDED", "object": make_peer("two", "10.5.0.2", version="11")},
+                {"type": "DELETED", "object": make_peer("one", "10.5.0.1", "12")},
+                {"type": "BOOKMARK", "object": {"metadata": {"resourceVersion": "15"}}},
+            ],
+            [{"type": "ERROR", "object": {"code": 410, "message": "too old"}}],
+        ],
+    )
+    informer = informer_for(api)
+    assert not informer.healthy
+
+    informer.sync_once()
+    assert informer.healthy
+    assert [peer["metadata"]["name"] for peer in informer.peers()] == ["two"]
+
+    # resumes the watch where it left off, 410 Gone forces a relist
+    informer.sync_once()
+    assert api.watches == ["10", "15"]
+    assert api.lists == 1
+
+    informer.sync_once()
+    assert api.lists == 2
+    assert api.watches[-1] == "10"
+
+
+def test_watch_gone():
+    response = requests.Response()
+    response.status_code = 410
+    response.reason = "Gone"
+    response._content = b"{}"
+
+    api = FakeApi([], [KubeApiError(response)])
+    informer = informer_for(api)
+    informer.sync_once()
+    assert api.lists == 1
+
+    informer.sync_once()
+    assert api.lists == 2
+
+
+@pytest.mark.parametrize("error", [RuntimeError, ValueError])
+def test_run_marks_unhealthy(error):
+    class FailingApi:
+        def list(self, path, label_selector=""):
+            informer._stop.set()
+            raise error("boom")
+
+    informer = informer_for(FailingApi())
+    informer._healthy = True
+    informer._run()
+    assert not informer.healthy
+
+
+def test_staleness():
+    clock = [0.0]
+    api = FakeApi([make_peer("one", "10.5.0.1")], [[], []])
+    informer = informer_for(api)
+    informer.clock = lambda: clock[0]
+
+    informer.sync_once()
+    assert informer.healthy
+
+    # quiet watches that end normally still confirm we are in sync
+    clock[0] += 100
+    informer.sync_once()
+    clock[0] += 100
+    assert informer.healthy
+
+    # but not when we haven't heard from the server in a while
+    clock[0] += informer.max_staleness
+    assert not informer.healthy
+
+
+def test_late_delete():
+    changes = []
+    informer = informer_for(FakeApi([], []))
+    informer.listeners.append(lambda old, new: changes.append((old, new)))
+    informer.update(make_peer("one", "10.5.0.1", version="20"))
+
+    # delete of the previous peer with the same name arrives after a redeploy
+    old = make_peer("one", "10.5.0.9", version="12")
+    informer.handle_event({"type": "DELETED", "object": old})
+    assert informer.peers() == [make_peer("one", "10.5.0.1", version="20")]
+    assert len(changes) == 1
+
+    informer.handle_event(
+        {"type": "DELETED", "object": make_peer("one", "10.5.0.1", version="21")}
+    )
+    assert informer.get("one") is None
+    assert changes[-1][1] is None
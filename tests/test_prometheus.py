@@ -0,0 +1,68 @@
+# Copyright (c) 2022 Carnegie Mellon University
+# SPDX-License-Identifier: MIT
+
+import pytest
+
+from sinfonia.prometheus import Prometheus, PrometheusError, scalar, vector
+
+QUERY_URL = "http://prometheus:9090/api/v1/query"
+
+
+def response(result_type, result):
+    return {"status": "success", "data": {"resultType": result_type, "result": result}}
+
+
+@pytest.fixture
+def now():
+    return [0.0]
+
+
+@pytest.fixture
+def prometheus(now):
+    return Prometheus(
+        "http://prometheus:9090", ttl=10, stale_ttl=60, clock=lambda: now[0]
+    )
+
+
+def test_query(prometheus, now, requests_mock):
+    def answer(request, context):
+        if "cpu" in request.text:
+            return response("scalar", [0, "0.5"])
+        return response("vector", [{"metric": {"public_key": "key"}}])
+
+    mock = requests_mock.post(QUERY_URL, json=answer)
+    queries = {"cpu": "scalar(cpu)", "peers": "peers"}
+
+    results = prometheus.query(queries)
+    assert scalar(results["cpu"]) == 0.5
+    assert vector(results["peers"]) == [{"metric": {"public_key": "key"}}]
+    assert mock.call_count == 2
+    assert mock.last_request.timeout == prometheus.timeout
+
+    # results are shared until they expire
+    assert prometheus.query({"cpu": "scalar(cpu)"}) == {"cpu": results["cpu"]}
+    assert mock.call_count == 2
+
+    now[0] += 11
+    prometheus.query(queries)
+    assert mock.call_count == 4
+
+
+def test_query_failed(prometheus, now, requests_mock):
+    requests_mock.post(QUERY_URL, json=response("scalar", [0, "0.5"]))
+    results = prometheus.query({"cpu": "scalar(cpu)"})
+
+    # keep using the last result for a while when prometheus fails
+    requests_mock.post(QUERY_URL, status_code=503)
+    now[0] += 30
+    assert prometheus.query({"cpu": "scalar(cpu)"}) == results
+    now[0] += 60
+    assert prometheus.query({"cpu": "scalar(cpu)"}) == {}
+
+    requests_mock.post(QUERY_URL, json={"status": "error", "error": "bad query"})
+    assert prometheus.query({"bad": "bad"}) == {}
+
+
+def test_result_type():
+    with pytest.raises(PrometheusError):
+        scalar({"resultType": "vector", "result": []})
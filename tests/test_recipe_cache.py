@@ -0,0 +1,156 @@
+# Copyright (c) 2022 Carnegie Mellon University
+# SPDX-License-Identifier: MIT
+
+from uuid import UUID
+
+import pytest
+
+from sinfonia.deployment_repository import DeploymentRepository
+from sinfonia.recipe_cache import RecipeCache
+from sinfonia.recipe_index import RecipeIndex, RecipeIndexEntry, recipe_digest
+
+from .conftest import GOOD_CONTENT, GOOD_UUID
+
+UNKNOWN_UUID = UUID("00000000-0000-0000-0000-0000000000ff")
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+class TestRecipeCache:
+    def test_cached(self, repository, good_uuid, clock, mocker):
+        cache = RecipeCache(repository, ttl=60, clock=clock)
+        fetch = mocker.spy(DeploymentRepository, "fetch")
+
+        recipe = cache.get(good_uuid)
+        assert recipe.chart_version == "example-0.1.0"
+        assert cache.get(good_uuid) is recipe
+        assert fetch.call_count == 1
+
+        # revalidated after ttl expires, unchanged file is not parsed again
+        clock.now = 61
+        cache.stale_ttl = 0
+        assert cache.get(good_uuid) is recipe
+        assert fetch.call_count == 2
+
+    def test_negative(self, repository, bad_uuid, clock, mocker):
+        cache = RecipeCache(repository, negative_ttl=10, clock=clock)
+        fetch = mocker.spy(DeploymentRepository, "fetch")
+
+        for uuid in [UNKNOWN_UUID, bad_uuid]:
+            with pytest.raises(ValueError):
+                cache.get(uuid)
+            with pytest.raises(ValueError):
+                cache.get(uuid)
+        assert fetch.call_count == 2
+
+        clock.now = 11
+        with pytest.raises(ValueError):
+            cache.get(UNKNOWN_UUID)
+        assert fetch.call_count == 3
+
+    def test_remote_revalidate(self, requests_mock, clock):
+        url = f"http://test/{GOOD_UUID}.yaml"
+        requests_mock.get(
+            url,
+            [
+                dict(text=GOOD_CONTENT, headers={"ETag": '"v1"'}),
+                dict(status_code=304),
+                dict(status_code=404),
+            ],
+        )
+        cache = RecipeCache(
+            DeploymentRepository("http://test/"), ttl=60, stale_ttl=0, clock=clock
+        )
+        uuid = UUID(GOOD_UUID)
+
+        recipe = cache.get(uuid)
+        clock.now = 61
+        assert cache.get(uuid) is recipe
+        assert requests_mock.call_count == 2
+
+        clock.now = 122
+        with pytest.raises(ValueError):
+            cache.get(uuid)
+
+    def test_stale_while_revalidate(self, repository, good_uuid, clock, mocker):
+        cache = RecipeCache(repository, ttl=60, stale_ttl=600, clock=clock)
+        recipe = cache.get(good_uuid)
+
+        background = mocker.patch.object(RecipeCache, "_revalidate_in_background")
+        clock.now = 100
+        assert cache.get(good_uuid) is recipe
+        background.assert_called_once_with(good_uuid)
+
+        # too stale to serve while revalidating
+        clock.now = 1000
+        assert cache.get(good_uuid) == recipe
+        background.assert_called_once()
+
+    def test_transient_failure(self, requests_mock, clock):
+        url = f"http://test/{GOOD_UUID}.yaml"
+        requests_mock.get(url, [dict(text=GOOD_CONTENT), dict(status_code=503)])
+        cache = RecipeCache(
+            DeploymentRepository("http://test/"), ttl=60, stale_ttl=0, clock=clock
+        )
+        uuid = UUID(GOOD_UUID)
+
+        recipe = cache.get(uuid)
+        clock.now = 61
+        assert cache.get(uuid) is recipe
+        assert requests_mock.call_count == 2
+
+        # the failed refresh is not retried on every request
+        clock.now = 65
+        assert cache.get(uuid) is recipe
+        assert requests_mock.call_count == 2
+
+    def test_revalidate_keeps_digest(self, requests_mock, clock, mocker):
+        url = f"http://test/{GOOD_UUID}.yaml"
+        requests_mock.get(
+            url,
+            [dict(text=GOOD_CONTENT, headers={"ETag": '"v1"'}), dict(status_code=304)],
+        )
+        cache = RecipeCache(
+            DeploymentRepository("http://test/"), ttl=60, stale_ttl=0, clock=clock
+        )
+        uuid = UUID(GOOD_UUID)
+        recipe = cache.get(uuid)
+
+        clock.now = 61
+        assert cache.get(uuid) is recipe
+        assert requests_mock.call_count == 2
+
+        # an index listing the same digest doesn't cause another fetch
+        index = RecipeIndex(
+            {uuid: RecipeIndexEntry(sha256=recipe_digest(GOOD_CONTENT))}
+        )
+        prefetch = mocker.patch.object(RecipeCache, "_prefetch_in_background")
+        cache.update_index(index)
+        prefetch.assert_not_called()
+        clock.now = 1000
+        assert cache.get(uuid) is recipe
+        assert requests_mock.call_count == 2
+
+    def test_forbidden(self, requests_mock, clock):
+        url = f"http://test/{GOOD_UUID}.yaml"
+        requests_mock.get(url, [dict(text=GOOD_CONTENT), dict(status_code=403)])
+        cache = RecipeCache(
+            DeploymentRepository("http://test/"), ttl=60, stale_ttl=0, clock=clock
+        )
+        uuid = UUID(GOOD_UUID)
+        recipe = cache.get(uuid)
+
+        # not a missing recipe, keep serving the cached one
+        clock.now = 61
+        assert cache.get(uuid) is recipe
@@ -0,0 +1,83 @@
+# Copyright (c) 2022 Carnegie Mellon University
+# SPDX-License-Identifier: MIT
+
+from pathlib import Path
+from uuid import UUID
+
+import pytest
+
+from sinfonia.deployment_repository import DeploymentRepository
+from sinfonia.recipe_cache import RecipeCache
+from sinfonia.recipe_index import INDEX_NAME, RecipeIndex, recipe_digest
+
+from .conftest import BAD_UUID, GOOD_CONTENT, GOOD_UUID, RESTRICTED_UUID
+
+UNKNOWN_UUID = UUID("00000000-0000-0000-0000-0000000000ff")
+
+
+class TestRecipeIndex:
+    def test_from_directory(self, repository):
+        index = RecipeIndex.from_directory(Path(repository.base_url.path))
+        assert len(index) == 3
+        assert UUID(GOOD_UUID) in index
+        assert UNKNOWN_UUID not in index
+
+        entry = index.entries[UUID(GOOD_UUID)]
+        assert entry.sha256 == recipe_digest(GOOD_CONTENT)
+        assert entry.recipe == dict(chart="example", version="0.1.0", restricted=False)
+
+        assert RecipeIndex.from_yaml(index.to_yaml()) == index
+
+        index = RecipeIndex.from_directory(Path(repository.base_url.path), inline=False)
+        assert index.entries[UUID(GOOD_UUID)].recipe is None
+
+    def test_invalid(self):
+        with pytest.raises(ValueError):
+            RecipeIndex.from_yaml(
+                f"version: 1\nrecipes:\n  not-a-uuid: {{sha256: '{'0' * 64}'}}"
+            )
+
+
+class TestRecipeCacheIndex:
+    @pytest.fixture
+    def remote(self, repository, requests_mock):
+        index = RecipeIndex.from_directory(Path(repository.base_url.path))
+        requests_mock.get(f"http://test/{INDEX_NAME}", text=index.to_yaml())
+        return RecipeCache(DeploymentRepository("http://test/"))
+
+    def test_inline(self, remote, requests_mock):
+        assert remote.load_index()
+        assert requests_mock.call_count == 1
+
+        recipe = remote.get(UUID(GOOD_UUID))
+        assert recipe.chart_version == "example-0.1.0"
+        assert remote.get(UUID(RESTRICTED_UUID)).restricted
+
+        for uuid in [UNKNOWN_UUID, UUID(BAD_UUID)]:
+            with pytest.raises(ValueError):
+                remote.get(uuid)
+
+        # all answered from the index
+        assert requests_mock.call_count == 1
+
+    def test_without_index(self, requests_mock):
+        requests_mock.get(f"http://test/{INDEX_NAME}", status_code=404)
+        cache = RecipeCache(DeploymentRepository("http://test/"))
+        assert not cache.load_index()
+        assert cache.index is None
+
+    def test_prefetch(self, repository, mocker):
+        index = RecipeIndex.from_directory(Path(repository.base_url.path), inline=False)
+        (Path(repository.base_url.path) / INDEX_NAME).write_text(index.to_yaml())
+        try:
+            cache = RecipeCache(repository)
+            prefetch = mocker.patch.object(RecipeCache, "_prefetch_in_background")
+            assert cache.load_index()
+        finally:
+            (Path(repository.base_url.path) / INDEX_NAME).unlink()
+
+        uuids = sorted(prefetch.call_args.args[0])
+        assert uuids == sorted(index.entries)
+
+        with pytest.raises(ValueError):
+            cache.get(UNKNOWN_UUID)
@@ -0,0 +1,116 @@
+# Copyright (c) 2022 Carnegie Mellon University
+# SPDX-License-Identifier: MIT
+
+import os
+import time
+from typing import Any
+from uuid import UUID
+
+import pytest
+
+from sinfonia.deployment_repository import DeploymentRepository
+from sinfonia.recipe_cache import RecipeCache
+from sinfonia.recipe_watcher import MAX_DEBOUNCE, MIN_WAIT, RecipeWatcher
+
+from .conftest import BAD_CONTENT, GOOD_CONTENT, GOOD_UUID
+
+UPDATED_CONTENT = """\
+chart: example
+version: 0.2.0
+restricted: false
+"""
+OTHER_UUID = "00000000-0000-0000-0000-000000000003"
+
+
+def configmap_update(root, timestamp, files):
+    """Mimic how kubelet atomically updates a ConfigMap volume."""
+    data_dir = root / f"..{timestamp}"
+    data_dir.mkdir()
+    for name, content in files.items():
+        (data_dir / name).write_text(content)
+        link = root / name
+        if not link.is_symlink():
+            link.symlink_to(f"..data/{name}")
+
+    (root / "..data_tmp").symlink_to(data_dir.name)
+    os.rename(root / "..data_tmp", root / "..data")
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+
+class TestRecipeWatcher:
+    def test_scan(self, tmp_path, mocker):
+        (tmp_path / f"{GOOD_UUID}.yaml").write_text(GOOD_CONTENT)
+        (tmp_path / "README.yaml").write_text("not a recipe")
+        cache = RecipeCache(DeploymentRepository(tmp_path))
+        watcher = RecipeWatcher(cache)
+
+        assert watcher.scan()
+        assert not watcher.scan()
+
+        fetch = mocker.spy(DeploymentRepository, "fetch")
+        assert cache.get(UUID(GOOD_UUID)).version == "0.1.0"
+        with pytest.raises(ValueError):
+            cache.get(UUID(OTHER_UUID))
+        assert fetch.call_count == 0
+
+        (tmp_path / f"{OTHER_UUID}.yaml").write_text(BAD_CONTENT)
+        assert watcher.scan()
+        with pytest.raises(ValueError, match="Failed to validate"):
+            cache.get(UUID(OTHER_UUID))
+
+        (tmp_path / f"{GOOD_UUID}.yaml").unlink()
+        assert watcher.scan()
+        with pytest.raises(ValueError, match="unknown recipe"):
+            cache.get(UUID(GOOD_UUID))
+        assert fetch.call_count == 0
+
+    def test_configmap_update(self, tmp_path):
+        configmap_update(tmp_path, "2022_01_01", {f"{GOOD_UUID}.yaml": GOOD_CONTENT})
+        cache = RecipeCache(DeploymentRepository(tmp_path))
+        watcher = RecipeWatcher(cache)
+        watcher.start()
+        try:
+            recipe = cache.get(UUID(GOOD_UUID))
+            assert recipe.version == "0.1.0"
+
+            configmap_update(
+                tmp_path,
+                "2022_01_02",
+                {f"{GOOD_UUID}.yaml": UPDATED_CONTENT, f"{OTHER_UUID}.yaml": ""},
+            )
+            assert wait_for(lambda: cache.get(UUID(GOOD_UUID)).version == "0.2.0")
+            assert cache.index is not None and UUID(OTHER_UUID) in cache.index
+        finally:
+            watcher.stop()
+
+    def test_event_burst(self, tmp_path):
+        now = [0.0]
+        waits = []
+
+        class BusyInotify:
+            """Events keep arriving, every wait takes the whole timeout."""
+
+            def wait(self, timeout):
+                waits.append(timeout)
+                now[0] += timeout
+                return True
+
+            def read_masks(self):
+                return [1]
+
+        repository = DeploymentRepository(tmp_path)
+        watcher = RecipeWatcher(RecipeCache(repository, clock=lambda: now[0]))
+        inotify: Any = BusyInotify()
+        masks = watcher._collect(inotify)
+
+        assert len(masks) == len(waits) + 1
+        assert min(waits) >= MIN_WAIT
+        assert MAX_DEBOUNCE <= now[0] < MAX_DEBOUNCE + MIN_WAIT
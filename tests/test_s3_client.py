@@ -0,0 +1,129 @@
+# Copyright (c) 2022 Carnegie Mellon University
+# SPDX-License-Identifier: MIT
+
+from datetime import datetime, timezone
+
+import pytest
+import requests
+from yarl import URL
+
+from sinfonia.deployment_repository import DeploymentRepository
+from sinfonia.recipe_cache import RecipeCache
+from sinfonia.s3_client import S3Auth, S3Endpoint
+
+from .conftest import GOOD_CONTENT, GOOD_UUID
+
+ENVIRON = {
+    "AWS_ACCESS_KEY_ID": "AKIDEXAMPLE",
+    "AWS_SECRET_ACCESS_KEY": "wJalrXUtnFEMI/K7MDENG+bPxRfiCYEXAMPLEKEY",
+    "AWS_REGION": "us-east-2",
+    "AWS_ENDPOINT_URL": "http://minio:9000",
+}
+
+LISTING = """\
+<?xml version="1.0" encoding="UTF-8"?>
+<ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">
+  <Name>bucket</Name>
+  <Prefix>recipes/</Prefix>
+  <IsTruncated>{truncated}</IsTruncated>
+  {token}
+  <Contents><Key>recipes/{key}</Key><ETag>&quot;abc&quot;</ETag></Contents>
+</ListBucketResult>
+"""
+
+
+@pytest.fixture
+def s3_repository(monkeypatch):
+    for name, value in ENVIRON.items():
+        monkeypatch.setenv(name, value)
+    return DeploymentRepository("s3://bucket/recipes")
+
+
+class TestS3Auth:
+    def test_matches_botocore(self):
+        botocore_auth = pytest.importorskip("botocore.auth")
+        botocore_awsrequest = pytest.importorskip("botocore.awsrequest")
+        botocore_credentials = pytest.importorskip("botocore.credentials")
+
+        url = "http://minio:9000/bucket/?list-type=2&prefix=recipes%2F"
+        credentials = botocore_credentials.Credentials(
+            ENVIRON["AWS_ACCESS_KEY_ID"], ENVIRON["AWS_SECRET_ACCESS_KEY"]
+        )
+        reference = botocore_awsrequest.AWSRequest(method="GET", url=url)
+        botocore_auth.S3SigV4Auth(credentials, "s3", "us-east-1").add_auth(reference)
+
+        # sign with the same timestamp botocore used
+        timestamp = reference.context["timestamp"]
+        now = datetime.strptime(timestamp, "%Y%m%dT%H%M%SZ")
+        request = requests.Request("GET", url).prepare()
+        S3Auth(ENVIRON["AWS_ACCESS_KEY_ID"], ENVIRON["AWS_SECRET_ACCESS_KEY"]).sign(
+            request, now.replace(tzinfo=timezone.utc)
+        )
+
+        assert request.headers["Authorization"] == reference.headers["Authorization"]
+
+
+class TestS3Repository:
+    def test_endpoint(self):
+        endpoint = S3Endpoint.from_env({"AWS_REGION": "us-west-1"})
+        assert endpoint.auth is None
+        assert endpoint.object_url(URL("s3://bucket/a/b.yaml")) == URL(
+            "https://bucket.s3.us-west-1.amazonaws.com/a/b.yaml"
+        )
+
+    def test_join(self, s3_repository):
+        assert s3_repository.join("x.yaml") == URL("s3://bucket/recipes/x.yaml")
+        assert s3_repository.join("../x.yaml") == URL("s3://bucket/x.yaml")
+        with pytest.raises(AssertionError):
+            s3_repository.join("file:///escaped")
+
+    def test_get(self, s3_repository, requests_mock):
+        url = f"http://minio:9000/bucket/recipes/{GOOD_UUID}.yaml"
+        requests_mock.get(
+            url,
+            [
+                dict(text=GOOD_CONTENT, headers={"ETag": '"v1"'}),
+                dict(status_code=304),
+            ],
+        )
+
+        content, validators = s3_repository.fetch(f"{GOOD_UUID}.yaml")
+        assert content == GOOD_CONTENT
+        assert requests_mock.last_request.headers["Authorization"].startswith(
+            "AWS4-HMAC-SHA256 Credential=AKIDEXAMPLE/"
+        )
+
+        content, _ = s3_repository.fetch(f"{GOOD_UUID}.yaml", validators)
+        assert content is None
+
+    def test_list(self, s3_repository, requests_mock):
+        url = "http://minio:9000/bucket/"
+        requests_mock.get(
+            url,
+            [
+                dict(
+                    text=LISTING.format(
+                        truncated="true",
+                        token="<NextContinuationToken>next</NextContinuationToken>",
+                        key=f"{GOOD_UUID}.yaml",
+                    )
+                ),
+                dict(text=LISTING.format(truncated="false", token="", key="c.tgz")),
+            ],
+        )
+        assert s3_repository.list() == [f"{GOOD_UUID}.yaml", "c.tgz"]
+        assert requests_mock.last_request.qs["continuation-token"] == ["next"]
+
+    def test_prefetch_listed(self, s3_repository, requests_mock, mocker):
+        requests_mock.get(
+            "http://minio:9000/bucket/recipes/index.yaml", status_code=404
+        )
+        requests_mock.get(
+            "http://minio:9000/bucket/",
+            text=LISTING.format(truncated="false", token="", key=f"{GOOD_UUID}.yaml"),
+        )
+        prefetch = mocker.patch.object(RecipeCache, "_prefetch_in_background")
+
+        cache = RecipeCache(s3_repository)
+        assert not cache.load_index()
+        assert [str(uuid) for uuid in prefetch.call_args.args[0]] == [GOOD_UUID]
@@ -0,0 +1,133 @@
+# Copyright (c) 2022 Carnegie Mellon University
+# SPDX-License-Identifier: MIT
+
+import hashlib
+from pathlib import Path
+
+import pytest
+import yaml
+
+from sinfonia.recipe_index import INDEX_NAME
+from sinfonia.s3_upload import SyncPlan, local_etag, parse_args, sync
+
+from .conftest import GOOD_CONTENT, GOOD_UUID
+
+
+class FakeS3Client:
+    """In-memory stand-in for the subset of the boto3 S3 client we use."""
+
+    class exceptions:
+        class NoSuchBucket(Exception):
+            pass
+
+    def __init__(self, objects=None):
+        self.objects = dict(objects or {})
+        self.uploaded = []
+        self.delete_requests = 0
+
+    def get_paginator(self, operation):
+        assert operation == "list_objects_v2"
+        return self
+
+    def paginate(self, Bucket):
+        keys = sorted(self.objects)
+        for start in range(0, len(keys), 2):
+            yield {
+                "Contents": [
+                    {"Key": key, "ETag": local_etag(self.objects[key])}
+                    for key in keys[start : start + 2]
+                ]
+            }
+
+    def upload_fileobj(self, fh, bucket, key, ExtraArgs=None, Config=None):
+        self.objects[key] = fh.read()
+        self.uploaded.append(key)
+
+    def delete_objects(self, Bucket, Delete):
+        self.delete_requests += 1
+        for obj in Delete["Objects"]:
+            self.objects.pop(obj["Key"])
+        return {}
+
+
+def test_local_etag():
+    data = b"x" * 10
+    assert local_etag(data) == f'"{hashlib.md5(data).hexdigest()}"'
+
+    part = hashlib.md5(b"x" * 4).digest()
+    last = hashlib.md5(b"x" * 2).digest()
+    multipart = hashlib.md5(part + part + last).hexdigest()
+    assert local_etag(data, chunksize=4) == f'"{multipart}-3"'
+
+
+def test_sync_plan():
+    local = {"a": b"same", "b": b"changed", "c": b"new"}
+    remote = {"a": local_etag(b"same"), "b": local_etag(b"old"), "d": '"x"'}
+
+    plan = SyncPlan.compare(local, remote)
+    assert set(plan.uploads) == {"b", "c"}
+    assert plan.unchanged == {"a"}
+    assert plan.deletes == {"d"}
+
+    plan = SyncPlan.compare(local, remote, force=True)
+    assert set(plan.uploads) == {"a", "b", "c"}
+
+
+class TestSync:
+    @pytest.fixture
+    def recipes(self, tmp_path):
+        (tmp_path / f"{GOOD_UUID}.yaml").write_text(GOOD_CONTENT)
+        (tmp_path / "charts").mkdir()
+        (tmp_path / "charts" / "example-0.1.0.tgz").write_bytes(b"chart")
+        (tmp_path / "..data").mkdir()
+        (tmp_path / "..data" / "hidden.yaml").write_text("")
+        return tmp_path
+
+    def args(self, recipes: Path, *extra):
+        return parse_args(["--aws-creds", "/dev/null", "bucket", str(recipes), *extra])
+
+    def test_sync(self, recipes, monkeypatch):
+        client = FakeS3Client({"stale.yaml": b"old"})
+        assert sync(client, self.args(recipes)) == 0
+        assert sorted(client.uploaded) == sorted(
+            [f"{GOOD_UUID}.yaml", "charts/example-0.1.0.tgz", INDEX_NAME]
+        )
+        # the index is uploaded after the recipes it lists
+        assert client.uploaded[-1] == INDEX_NAME
+        index = yaml.safe_load(client.objects[INDEX_NAME])
+        assert list(index["recipes"]) == [GOOD_UUID]
+
+        # nothing changed, nothing to upload
+        client.uploaded.clear()
+        assert sync(client, self.args(recipes)) == 0
+        assert client.uploaded == []
+
+        # only changed objects are uploaded, stale objects deleted in bulk
+        (recipes / "charts" / "example-0.1.0.tgz").write_bytes(b"new chart")
+        monkeypatch.setattr("builtins.input", lambda _prompt: "y")
+        assert sync(client, self.args(recipes, "--delete")) == 0
+        assert client.uploaded == ["charts/example-0.1.0.tgz"]
+        assert "stale.yaml" not in client.objects
+        assert client.delete_requests == 1
+
+    def test_dry_run(self, recipes, capsys):
+        client = FakeS3Client({"stale.yaml": b"old"})
+        assert sync(client, self.args(recipes, "--dry-run", "--delete")) == 0
+        assert client.uploaded == []
+        assert client.objects == {"stale.yaml": b"old"}
+
+        output = capsys.readouterr().out
+        assert f"would create {GOOD_UUID}.yaml" in output
+        assert "would delete stale.yaml" in output
+
+    def test_index_after_failure(self, recipes):
+        class FailingS3Client(FakeS3Client):
+            def upload_fileobj(self, fh, bucket, key, ExtraArgs=None, Config=None):
+                if key.startswith("charts/"):
+                    raise OSError("upload failed")
+                super().upload_fileobj(fh, bucket, key, ExtraArgs, Config)
+
+        # the index is not published when recipes it lists failed to upload
+        client = FailingS3Client()
+        assert sync(client, self.args(recipes, "--no-inline")) == 1
+        assert client.uploaded == [f"{GOOD_UUID}.yaml"]
@@ -0,0 +1,95 @@
+# Copyright (c) 2022 Carnegie Mellon University
+# SPDX-License-Identifier: MIT
+
+import json
+import threading
+
+import pytest
+
+from sinfonia.installer import Installer
+from sinfonia.status_events import StatusBroker, TooManyStreams
+
+
+def parse(chunk):
+    lines = dict(line.split(": ", 1) for line in chunk.strip().splitlines())
+    return lines["event"], json.loads(lines["data"])
+
+
+def test_stream():
+    broker = StatusBroker(keepalive=0.01)
+    installer = Installer(listeners=[broker.install_changed])
+    status = {"DeploymentName": "test", "Status": "Pending"}
+
+    events = broker.stream("test", lambda: dict(status))
+    assert parse(next(events)) == ("status", status)
+
+    # without changes we only get keepalives
+    assert next(events) == ": keepalive\n\n"
+
+    ready = threading.Event()
+
+    def install():
+        ready.wait()
+        status["Status"] = "Ready"
+        installer.mark_ready("test")
+
+    thread = threading.Thread(target=install)
+    thread.start()
+    ready.set()
+    chunks = iter(events)
+    event = next(chunk for chunk in chunks if not chunk.startswith(":"))
+    thread.join()
+    assert parse(event)[1]["Status"] == "Ready"
+
+    # the stream ends after the deployment expired
+    status["Status"] = "Expired"
+    broker.peer_changed({"metadata": {"name": "test"}}, None)
+    remaining = [chunk for chunk in events if not chunk.startswith(":")]
+    assert [parse(chunk)[1]["Status"] for chunk in remaining] == ["Expired"]
+    assert broker._streams == 0
+
+
+def test_stream_limits():
+    clock = [0.0]
+    broker = StatusBroker(
+        max_streams=1, keepalive=0.01, max_duration=1, clock=lambda: clock[0]
+    )
+    events = broker.stream("test", lambda: {"Status": "Ready"})
+    next(events)
+    with pytest.raises(TooManyStreams):
+        broker.stream("other", lambda: {"Status": "Ready"})
+
+    # streams are closed after max_duration
+    clock[0] += 1
+    assert list(events) == []
+    broker.stream("other", lambda: {"Status": "Ready"})
+
+
+def test_stream_slots():
+    broker = StatusBroker(max_streams=4, keepalive=0.01)
+
+    # closing a stream that was never iterated frees its slot
+    broker.stream("test", lambda: {"Status": "Ready"}).close()
+    assert broker._streams == 0
+
+    # concurrently opened streams don't exceed the limit
+    barrier = threading.Barrier(16)
+    opened = []
+
+    def open_stream():
+        barrier.wait()
+        try:
+            opened.append(broker.stream("test", lambda: {"Status": "Ready"}))
+        except TooManyStreams:
+            pass
+
+    threads = [threading.Thread(target=open_stream) for _ in range(16)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(opened) == broker._streams == 4
+
+    for events in opened:
+        events.close()
+    assert broker._streams == 0
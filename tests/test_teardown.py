@@ -0,0 +1,149 @@
+# Copyright (c) 2022 Carnegie Mellon University
+# SPDX-License-Identifier: MIT
+
+from ipaddress import ip_address
+from types import SimpleNamespace
+from urllib.parse import unquote
+
+import pytest
+from plumbum.commands.processes import ProcessExecutionError
+from yarl import URL
+
+from sinfonia.kube_client import NAMESPACES, PEERS, KubeClient
+from sinfonia.leases import LeaseScheduler
+from sinfonia.peer_informer import PeerInformer
+from sinfonia.teardown import SECRETS, Teardown
+
+SERVER = "https://cluster.example:6443"
+
+
+@pytest.fixture
+def cluster(mocker):
+    api = KubeClient(URL(SERVER))
+    return SimpleNamespace(
+        api=api,
+        informer=PeerInformer(api),
+        helm=mocker.MagicMock(),
+        installer=None,
+        leases=LeaseScheduler(clock=lambda: 0.0),
+    )
+
+
+def make_deployment(i):
+    name = f"sinfonia-{i}"
+    return SimpleNamespace(
+        name=name, namespace=name, client_ip=ip_address(f"10.5.0.{i}")
+    )
+
+
+def test_teardown(cluster, requests_mock):
+    clock = [0.0]
+    teardown = Teardown(cluster, batch_size=2, clock=lambda: clock[0])
+    for i in range(3):
+        teardown.submit(make_deployment(i))
+    teardown.submit(make_deployment(0))
+    assert len(teardown) == 3
+
+    # cancelled before removal started
+    assert teardown.cancel("sinfonia-2")
+    assert not teardown.cancel("sinfonia-2")
+
+    peers = requests_mock.delete(f"{SERVER}{PEERS}", json={"items": []})
+    requests_mock.get(
+        f"{SERVER}{SECRETS}",
+        json={"items": [{"metadata": {"name": "r", "namespace": "sinfonia-1"}}]},
+    )
+    namespaces = [
+        requests_mock.delete(f"{SERVER}{NAMESPACES}/sinfonia-{i}", json={})
+        for i in range(2)
+    ]
+    teardown.run()
+
+    assert len(teardown) == 0
+    assert peers.call_count == 1
+    selector = unquote(peers.last_request.query).replace("+", " ")
+    assert "findcloudlet.org/client in (10.5.0.0,10.5.0.1)" in selector
+    assert all(ns.call_count == 1 for ns in namespaces)
+    assert "propagationpolicy=background" in namespaces[0].last_request.query
+
+    # only the namespace with a helm release secret is uninstalled
+    cluster.helm.assert_called_once_with(
+        "uninstall", "--namespace", "sinfonia-1", "sinfonia-1"
+    )
+
+
+def test_teardown_retry(cluster, requests_mock):
+    clock = [0.0]
+    teardown = Teardown(cluster, max_attempts=2, clock=lambda: clock[0])
+    teardown.submit(make_deployment(1))
+
+    requests_mock.delete(f"{SERVER}{PEERS}", json={"items": []})
+    requests_mock.get(f"{SERVER}{SECRETS}", status_code=500)
+    namespace = requests_mock.delete(f"{SERVER}{NAMESPACES}/sinfonia-1", json={})
+    cluster.helm.side_effect = ProcessExecutionError(["helm"], 1, "", "failed")
+
+    teardown.run()
+    assert "sinfonia-1" in teardown
+    assert namespace.call_count == 0
+
+    # retried after a delay, and then dropped
+    teardown.run()
+    assert cluster.helm.call_count == 1
+    clock[0] += teardown.retry_delay
+    teardown.run()
+    assert cluster.helm.call_count == 2
+    assert len(teardown) == 0
+
+
+def test_teardown_gives_up(cluster, requests_mock, mocker):
+    clock = [0.0]
+    teardown = Teardown(cluster, max_attempts=2, clock=lambda: clock[0])
+    cluster.leases = mocker.MagicMock()
+    cluster.leases.clock.return_value = 0.0
+    schedule = cluster.leases.schedule
+    teardown.submit(make_deployment(1))
+    requests_mock.delete(f"{SERVER}{PEERS}", status_code=500)
+
+    teardown.run()
+    schedule.assert_not_called()
+    clock[0] += teardown.retry_delay
+    teardown.run()
+    assert len(teardown) == 0
+
+    # the deployment is handed back to be expired again later
+    schedule.assert_called_once_with("sinfonia-1", 4 * teardown.retry_delay)
+
+
+def test_teardown_resume(cluster, requests_mock):
+    clock = [0.0]
+    teardown = Teardown(cluster, clock=lambda: clock[0])
+    teardown.submit(make_deployment(1))
+
+    peers = requests_mock.delete(f"{SERVER}{PEERS}", json={"items": []})
+    requests_mock.get(f"{SERVER}{SECRETS}", json={"items": []})
+    namespace = requests_mock.delete(
+        f"{SERVER}{NAMESPACES}/sinfonia-1", [{"status_code": 500}, {"json": {}}]
+    )
+    teardown.run()
+
+    # the peer is gone, so it can only be removed
+    assert "sinfonia-1" in teardown
+    assert teardown.removing("sinfonia-1")
+    assert not teardown.cancel("sinfonia-1")
+
+    # only the failed step is retried
+    clock[0] += teardown.retry_delay
+    teardown.run()
+    assert peers.call_count == 1
+    assert namespace.call_count == 2
+    assert len(teardown) == 0
+
+    # can't be deployed again until the namespace has actually disappeared
+    terminating = requests_mock.get(
+        f"{SERVER}{NAMESPACES}/sinfonia-1",
+        [{"json": {"status": {"phase": "Terminating"}}}, {"status_code": 404}],
+    )
+    assert teardown.removing("sinfonia-1")
+    assert not teardown.removing("sinfonia-1")
+    assert not teardown.removing("sinfonia-1")
+    assert terminating.call_count == 2
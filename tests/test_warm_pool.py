@@ -0,0 +1,184 @@
+# Copyright (c) 2022 Carnegie Mellon University
+# SPDX-License-Identifier: MIT
+
+from types import SimpleNamespace
+
+import pytest
+from wireguard_tools import WireguardKey
+from yarl import URL
+
+from sinfonia.deployment import Deployment
+from sinfonia.deployment_recipe import DeploymentRecipe
+from sinfonia.ipam import ClientAddressPool
+from sinfonia.kube_client import NAMESPACES, PEERS, KubeClient
+from sinfonia.peer_informer import PeerInformer
+from sinfonia.warm_pool import (
+    CLAIMED,
+    INSTALLING,
+    READY,
+    STATE_LABEL,
+    WARM_LABEL,
+    WarmPool,
+)
+
+SERVER = "https://cluster.example:6443"
+
+
+def make_namespace(name, uuid, state=READY, version="1", created="2022-01-01"):
+    return {
+        "metadata": {
+            "name": name,
+            "resourceVersion": version,
+            "creationTimestamp": created,
+            "labels": {WARM_LABEL: str(uuid), STATE_LABEL: state},
+        }
+    }
+
+
+@pytest.fixture
+def cluster(mocker):
+    api = KubeClient(URL(SERVER))
+    ipam = ClientAddressPool("10.5.0.0/16")
+    return SimpleNamespace(
+        api=api,
+        ipam=ipam,
+        informer=PeerInformer(api, listeners=[ipam.peer_changed]),
+        helm=mocker.MagicMock(),
+        installer=None,
+        warm_pool=None,
+        teardown=None,
+        charts=None,
+        manifests=None,
+        placement=lambda recipe: None,
+        get_unique_client_address=ipam.allocate,
+        get_resources=lambda: {"cpu_ratio": 0.1, "mem_ratio": 0.1},
+    )
+
+
+@pytest.fixture
+def recipe(flask_app, repository, good_uuid):
+    with flask_app.app_context():
+        flask_app.config["deployment_repository"] = repository
+        yield DeploymentRecipe.from_repo(repository, good_uuid)
+
+
+def test_claim(cluster, recipe, example_wgkey, requests_mock):
+    cluster.warm_pool = WarmPool(cluster, {recipe.uuid: 1})
+    requests_mock.get(
+        f"{SERVER}{NAMESPACES}",
+        json={
+            "items": [
+                make_namespace("warm-b", recipe.uuid, created="2022-01-02"),
+                make_namespace("warm-a", recipe.uuid, version="7"),
+            ]
+        },
+    )
+    # the oldest was just claimed by somebody else
+    claim_a = requests_mock.patch(
+        f"{SERVER}{NAMESPACES}/warm-a", status_code=409, json={"reason": "Conflict"}
+    )
+    claim_b = requests_mock.patch(f"{SERVER}{NAMESPACES}/warm-b", json={})
+
+    deployment = Deployment.from_recipe(cluster, recipe, WireguardKey(example_wgkey))
+    requests_mock.get(f"{SERVER}{PEERS}/{deployment.name}", status_code=404)
+    requests_mock.post(f"{SERVER}{PEERS}", json=deployment.peer_manifest())
+
+    assert deployment.deploy() is deployment
+    assert deployment.namespace == "warm-b"
+    assert claim_a.last_request.json()["metadata"]["resourceVersion"] == "7"
+    metadata = claim_b.last_request.json()["metadata"]
+    assert metadata["labels"] == {STATE_LABEL: CLAIMED}
+    assert metadata["annotations"]["findcloudlet.org/claimed-by"] == deployment.name
+
+    # the warm backend is already installed
+    cluster.helm.assert_not_called()
+    peer = requests_mock.request_history[-1].json()
+    assert peer["metadata"]["annotations"]["findcloudlet.org/namespace"] == "warm-b"
+
+
+def test_claim_miss(cluster, recipe, example_wgkey, requests_mock):
+    cluster.warm_pool = WarmPool(cluster, {recipe.uuid: 1})
+    requests_mock.get(f"{SERVER}{NAMESPACES}", json={"items": []})
+
+    deployment = Deployment.from_recipe(cluster, recipe, WireguardKey(example_wgkey))
+    requests_mock.get(f"{SERVER}{PEERS}/{deployment.name}", status_code=404)
+    requests_mock.post(f"{SERVER}{PEERS}", json=deployment.peer_manifest())
+
+    deployment.deploy()
+    assert deployment.namespace == deployment.name
+    assert cluster.helm.call_args.args[0] == "install"
+
+
+def test_target_follows_demand(cluster, good_uuid):
+    now = [0.0]
+    pool = WarmPool(
+        cluster, {good_uuid: 1}, max_size=3, provision_time=60, clock=lambda: now[0]
+    )
+    assert pool.target(good_uuid) == 1
+
+    for _ in range(25):  # 25 claims in 10 minutes, ~2.5 per provisioning time
+        pool._record_demand(good_uuid)
+    assert pool.target(good_uuid) == 3
+
+    now[0] += 3600
+    assert pool.target(good_uuid) == 1
+
+
+def test_refill(cluster, recipe, flask_app, requests_mock):
+    pool = WarmPool(cluster, {recipe.uuid: 2})
+    requests_mock.get(
+        f"{SERVER}{NAMESPACES}",
+        json={"items": [make_namespace("warm-a", recipe.uuid)]},
+    )
+    create = requests_mock.post(
+        f"{SERVER}{NAMESPACES}",
+        json=make_namespace("warm-new", recipe.uuid, state="installing"),
+    )
+    # applying manifests updates the namespace while installing
+    requests_mock.get(
+        f"{SERVER}{NAMESPACES}/warm-new",
+        json=make_namespace("warm-new", recipe.uuid, state="installing", version="3"),
+    )
+    ready = requests_mock.patch(f"{SERVER}{NAMESPACES}/warm-new", json={})
+
+    cluster.get_resources = lambda: {"cpu_ratio": 0.9, "mem_ratio": 0.1}
+    pool.refill()
+    assert not create.called
+
+    # a busy, but not saturated, GPU doesn't stop us
+    cluster.get_resources = lambda: {"cpu_ratio": 0.1, "gpu_ratio": 0.35}
+    with flask_app.app_context():
+        pool.refill()
+    assert create.call_count == 1
+
+    # the chart is installed in the background
+    pool._executor.shutdown(wait=True)
+    assert "--wait" in cluster.helm.call_args.args
+    metadata = ready.last_request.json()["metadata"]
+    assert metadata["labels"] == {STATE_LABEL: READY}
+    assert metadata["resourceVersion"] == "3"
+
+
+def test_abandoned_installs(cluster, recipe, flask_app, requests_mock):
+    now = [0.0]
+    pool = WarmPool(cluster, {recipe.uuid: 1}, clock=lambda: now[0])
+    requests_mock.get(
+        f"{SERVER}{NAMESPACES}",
+        json={"items": [make_namespace("warm-a", recipe.uuid, state=INSTALLING)]},
+    )
+    delete = requests_mock.delete(f"{SERVER}{NAMESPACES}/warm-a", json={})
+    create = requests_mock.post(
+        f"{SERVER}{NAMESPACES}",
+        json=make_namespace("warm-new", recipe.uuid, state=INSTALLING),
+    )
+
+    # left behind by a restart, counts as installing for a while
+    pool.refill()
+    assert not delete.called and not create.called
+
+    now[0] += pool.install_timeout
+    with flask_app.app_context():
+        pool.refill()
+    assert delete.call_count == 1
+    assert create.call_count == 1
+    pool._executor.shutdown(wait=True)